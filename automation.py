@@ -0,0 +1,220 @@
+import numpy as np
+
+
+class AutomationLane:
+    "Recorded (time in samples, value) breakpoints, joined by straight lines on playback."
+
+    def __init__(self):
+        self.times = []
+        self.values = []
+
+    def append(self, time, value):
+        self.times.append(time)
+        self.values.append(value)
+
+    def arrays(self):
+        return np.array(self.times, dtype=float), np.array(self.values, dtype=float)
+
+
+class AutomatedParameter:
+    "Generates a per-sample control signal for one parameter (ramps, smoothing, lane playback)."
+
+    def __init__(self, sample_rate, container, name):
+        self.sample_rate = sample_rate
+        self.container = container
+        self.name = name
+        # Modules list the parameters that accept a per-sample array; everything else is updated once per block.
+        self.signal = name in getattr(container, "SIGNAL_PARAMETERS", ())
+        self.value = float(getattr(container, name))
+        self.target = self.value
+        self.time_constant = 0
+        self.ramp_remaining = 0
+        self.lane = None
+        # Whether the module still needs the settled scalar value (e.g. it holds last block's array).
+        self.dirty = False
+        self.index = np.zeros(0)
+        self.buffer = np.zeros(0)
+        self.decay = np.zeros(0)
+
+    def _grow(self, n):
+        self.index = np.arange(1, n + 1, dtype=float)
+        self.buffer = np.zeros(n)
+        self.smooth(self.time_constant)
+
+    def set_sample_rate(self, sample_rate):
+        "Convert ramps and lane playback in progress (counted in samples) to a new sample rate."
+        ratio = sample_rate / self.sample_rate
+        self.sample_rate = sample_rate
+        if self.ramp_remaining > 0:
+            self.ramp_remaining = max(int(self.ramp_remaining * ratio), 1)
+            self.ramp_step /= ratio
+        if self.lane is not None:
+            times, values = self.lane
+            self.lane = (times * ratio, values)
+            self.lane_time *= ratio
+            self.lane_length = self.lane_length and self.lane_length * ratio
+        self.smooth(self.time_constant)
+
+    def smooth(self, time_constant):
+        "Set the one-pole smoothing time constant (in seconds) applied to subsequent `set` calls."
+        self.time_constant = time_constant
+        if time_constant > 0:
+            # Closed-form one-pole response, so smoothing a block is a single multiply-add.
+            self.decay = np.exp(-self.index / (time_constant * self.sample_rate))
+
+    def set(self, value):
+        self.lane = None
+        self.ramp_remaining = 0
+        self.target = value
+        if self.time_constant <= 0:
+            self.value = value
+            self.dirty = True
+
+    def ramp(self, target, duration, shape='linear'):
+        "Ramp from the current value to `target` over `duration` seconds."
+        self.lane = None
+        duration = max(int(duration * self.sample_rate), 1)
+        if shape == 'linear':
+            self.ramp_step = (target - self.value) / duration
+        elif shape == 'exp':
+            if self.value <= 0 or target <= 0:
+                raise ValueError("Exponential ramps need positive start and end values.")
+            self.ramp_step = np.log(target / self.value) / duration
+        else:
+            raise ValueError(f"Unknown ramp shape '{shape}'.")
+        self.ramp_shape = shape
+        self.ramp_start = self.value
+        self.ramp_remaining = duration
+        self.target = target
+
+    def play(self, lane, length=None):
+        "Play back a recorded lane, looping every `length` samples if given."
+        self.lane = lane.arrays()
+        self.lane_time = 0
+        self.lane_length = length
+        self.ramp_remaining = 0
+
+    def process(self, n):
+        "Write the next `n` control values to the parameter; returns False once it has settled."
+        if len(self.buffer) < n:
+            self._grow(n)
+        out = self.buffer[:n]
+        index = self.index[:n]
+        if self.lane is not None:
+            times, values = self.lane
+            t = self.lane_time + index - 1
+            if self.lane_length:
+                t %= self.lane_length
+            elif self.lane_time >= times[-1]:
+                self.lane = None
+            out[:] = np.interp(t, times, values)
+            self.lane_time += n
+            self.value = self.target = out[-1]
+        elif self.ramp_remaining > 0:
+            index = np.minimum(index, self.ramp_remaining)
+            if self.ramp_shape == 'linear':
+                np.multiply(index, self.ramp_step, out=out)
+                out += self.ramp_start
+            else:
+                np.multiply(index, self.ramp_step, out=out)
+                np.exp(out, out=out)
+                out *= self.ramp_start
+            self.ramp_remaining -= n
+            self.ramp_start = out[-1]
+            if self.ramp_remaining <= 0:
+                out[-1] = self.target
+            self.value = out[-1]
+        elif self.value != self.target:
+            np.multiply(self.decay[:n], self.value - self.target, out=out)
+            out += self.target
+            self.value = out[-1]
+            if abs(self.value - self.target) <= 1e-6 * max(abs(self.target), 1):
+                self.value = self.target
+        else:
+            if self.dirty:
+                setattr(self.container, self.name, self.value)
+                self.dirty = False
+            return False
+        setattr(self.container, self.name, out if self.signal else self.value)
+        self.dirty = self.signal
+        return True
+
+
+class Automation:
+    "Drives automated parameters once per block and records/plays back automation lanes."
+
+    def __init__(self, sample_rate, resolve):
+        self.sample_rate = sample_rate
+        # Maps a parameter spec (e.g. "moog.freq") to its container and attribute name.
+        self.resolve = resolve
+        self.parameters = {}
+        self.lanes = {}
+        self.recording = False
+        self.record_start = 0
+        self.record_length = None
+        self.time = 0
+
+    def set_sample_rate(self, sample_rate):
+        "Convert automation in progress and recorded lanes (timed in samples) to a new sample rate."
+        ratio = sample_rate / self.sample_rate
+        self.sample_rate = sample_rate
+        for parameter in list(self.parameters.values()):
+            parameter.set_sample_rate(sample_rate)
+        for lane in self.lanes.values():
+            lane.times = [time * ratio for time in lane.times]
+        self.time *= ratio
+        self.record_start *= ratio
+        self.record_length = self.record_length and self.record_length * ratio
+
+    def get(self, spec):
+        if spec not in self.parameters:
+            container, name = self.resolve(spec)
+            self.parameters[spec] = AutomatedParameter(self.sample_rate, container, name)
+        return self.parameters[spec]
+
+    def set(self, spec, value):
+        "Route a parameter change through automation; returns False if the parameter is not automated."
+        if self.recording and isinstance(value, (int, float)):
+            if spec not in self.lanes:
+                self.lanes[spec] = AutomationLane()
+                self.lanes[spec].append(0, self.get(spec).value)
+            self.lanes[spec].append(self.time - self.record_start, value)
+        if spec in self.parameters:
+            self.parameters[spec].set(value)
+            return True
+        return False
+
+    def smooth(self, spec, time_constant):
+        self.get(spec).smooth(time_constant)
+
+    def ramp(self, spec, target, duration, shape='linear'):
+        self.get(spec).ramp(target, duration, shape)
+
+    def record(self):
+        self.lanes = {}
+        self.recording = True
+        self.record_start = self.time
+
+    def stop(self):
+        if self.recording:
+            self.recording = False
+            self.record_length = self.time - self.record_start
+        for parameter in self.parameters.values():
+            parameter.lane = None
+
+    def play(self, loop=False):
+        for spec, lane in self.lanes.items():
+            self.get(spec).play(lane, self.record_length if loop else None)
+
+    def active(self):
+        "Whether anything is recording or moving parameters (as opposed to settled, smoothed parameters)."
+        return self.recording or any(parameter.lane is not None or parameter.ramp_remaining > 0 or parameter.value != parameter.target
+                                     for parameter in list(self.parameters.values()))
+
+    def process(self, n):
+        # NOTE: Copy the values, as control threads (OSC) may add parameters while we iterate.
+        for spec, parameter in list(self.parameters.items()):
+            if not parameter.process(n) and not parameter.time_constant and not parameter.dirty:
+                # Settled and not smoothed; stop tracking so `set` goes straight to the module.
+                self.parameters.pop(spec, None)
+        self.time += n
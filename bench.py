@@ -0,0 +1,180 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from main import SynthEngine
+import module
+from module import Module
+
+
+class Probe(Module):
+    "Records when each value of `sent` (a send time, in seconds since `epoch`) is applied."
+
+    PARAMETERS = ("sent",)
+
+    def __init__(self, epoch):
+        super().__init__(None)
+        self.epoch = epoch
+        self.applied = []
+        self._sent = 0
+
+    @property
+    def sent(self):
+        return self._sent
+
+    @sent.setter
+    def sent(self, value):
+        self._sent = value
+        self.applied.append((value, time.perf_counter() - self.epoch))
+
+    def latencies(self, sent):
+        """Time from each send in `sent` until the engine reflects it, i.e. until it or a later update is applied.
+
+        (With coalescing, most updates are superseded before they are applied.)"""
+        values, times = np.array(self.applied).reshape(-1, 2).T
+        # Send times increase, so the first applied value at or after each send is the update that covered it.
+        index = np.searchsorted(values, sent)
+        covered = index < len(values)
+        return times[index[covered]] - sent[covered]
+
+
+def run_blocks(engine, stop):
+    "Stand-in for the audio callback: process blocks in real time until `stop` is set. Returns the number of late blocks."
+    outdata = np.zeros((engine.blocksize, engine.channels))
+    period = engine.blocksize / engine.samplerate
+    deadline = time.perf_counter()
+    late = 0
+    while not stop.is_set():
+        engine.process(outdata)
+        deadline += period
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            late += 1
+    return late
+
+
+def bench_osc(args):
+    "Send OSC messages at a fixed rate to a running engine, and measure throughput and end-to-end latency."
+    from oscpy.client import OSCClient
+
+    engine = SynthEngine()
+    epoch = time.perf_counter()
+    probe = engine.modules["probe"] = Probe(epoch)
+    engine.osc_control.log = args.log
+    engine.osc_control.coalesce = not args.immediate
+    engine.handle_osc_command("start", str(args.port))
+    stop = threading.Event()
+    result = {}
+    audio = threading.Thread(target=lambda: result.update(late=run_blocks(engine, stop)))
+    audio.start()
+
+    client = OSCClient("127.0.0.1", args.port)
+    rng = np.random.default_rng(0)
+    interval = args.bundle / args.rate
+    sent = 0
+    probes = []
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    next_send = start_time
+    while next_send - start_time < args.duration:
+        # Each packet carries one probe message; the rest are parameter updates, as from a controller.
+        # NOTE: OSC floats are 32-bit, so send times are relative to `epoch` to keep them precise.
+        probes.append(np.float32(time.perf_counter() - epoch))
+        messages = [(b"/probe/sent", [float(probes[-1])])]
+        messages += [(b"/tremolo/rate", [float(rng.uniform(1, 10))]) for _ in range(args.bundle - 1)]
+        if args.bundle > 1:
+            client.send_bundle(messages)
+        else:
+            client.send_message(*messages[0])
+        sent += len(messages)
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    # Let the last updates land.
+    time.sleep(3 * engine.blocksize / engine.samplerate)
+    elapsed = time.perf_counter() - start_time
+    cpu = time.process_time() - start_cpu
+    stop.set()
+    audio.join()
+    # Stop the listener thread before closing its socket.
+    engine.osc.terminate_server()
+    engine.osc.join_server()
+    engine.osc.stop_all()
+
+    stats = engine.osc_control.stats
+    latencies = probe.latencies(np.array(probes, dtype=float)) * 1000
+    print(f"Sent {sent} messages in {elapsed:.2f}s ({sent / elapsed:.0f}/s, {args.bundle} per packet).")
+    print(f"Received {stats['received']}, applied {stats['applied']}, coalesced {stats['coalesced']}, errors {stats['errors']}.")
+    if len(latencies):
+        print(f"End-to-end latency (ms): median {np.median(latencies):.2f}, 95th percentile {np.percentile(latencies, 95):.2f}, max {latencies.max():.2f}.")
+    print(f"CPU: {cpu / elapsed * 100:.0f}% of one core; {result['late']} late blocks.")
+
+
+def decay_costs(protect, duration, window):
+    "Median seconds per block over each `window` seconds of a note decaying into silence, from a fresh engine."
+    threshold = module.DENORMAL_THRESHOLD
+    if not protect:
+        module.DENORMAL_THRESHOLD = 0
+    try:
+        engine = SynthEngine()
+        engine.chain.skip_silence = protect
+        # The tail rings out through the auto-wah's filter and the feedback delay.
+        for name in ("envelope", "autowah", "delay"):
+            engine.modules[name].mix = 1
+        engine.modules["delay"].preset = "flanger_feedback"
+        engine.handle_midi(60, 127)
+        outdata = np.zeros((engine.blocksize, engine.channels))
+        blocks_per_window = max(1, round(window * engine.samplerate / engine.blocksize))
+        costs = []
+        for _ in range(int(duration / window)):
+            times = []
+            for _ in range(blocks_per_window):
+                start = time.perf_counter()
+                engine.process(outdata)
+                times.append(time.perf_counter() - start)
+            costs.append(np.median(times))
+        return np.array(costs)
+    finally:
+        module.DENORMAL_THRESHOLD = threshold
+
+
+def bench_denormal(args):
+    "Per-block cost while a note decays into silence, without and with denormal flushing and silence skipping."
+    before = decay_costs(False, args.duration, args.window)
+    after = decay_costs(True, args.duration, args.window)
+    print("Median ms per block, from a note's onset at 0s through its tail into silence:")
+    print("   time  unprotected  protected")
+    for i, (b, a) in enumerate(zip(before, after)):
+        print(f"{i * args.window:6.1f}s  {b * 1000:11.2f}  {a * 1000:9.2f}")
+    tail = len(before) // 2
+    print(f"Last {len(before) - tail} windows: {before[tail:].mean() * 1000:.2f} ms unprotected, "
+          f"{after[tail:].mean() * 1000:.2f} ms protected.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the synth engine.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    osc = commands.add_parser("osc", help="OSC control throughput and latency")
+    osc.add_argument("--rate", type=float, default=1000, help="messages per second (default: 1000)")
+    osc.add_argument("--duration", type=float, default=5, help="seconds (default: 5)")
+    osc.add_argument("--bundle", type=int, default=1, help="messages per packet, sent as a bundle if more than 1 (default: 1)")
+    osc.add_argument("--port", type=int, default=9000)
+    osc.add_argument("--log", action="store_true", help="print every message")
+    osc.add_argument("--immediate", action="store_true", help="apply updates as they arrive instead of once per block")
+    denormal = commands.add_parser("denormal", help="block cost during decaying tails and silence")
+    denormal.add_argument("--duration", type=float, default=20, help="seconds of audio (default: 20)")
+    denormal.add_argument("--window", type=float, default=1, help="seconds per reported median (default: 1)")
+    args = parser.parse_args()
+    if args.command == "osc":
+        bench_osc(args)
+    elif args.command == "denormal":
+        bench_denormal(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+import state
+
+
+# Bump when the computation behind any cached array changes, to invalidate everything cached before.
+VERSION = 1
+DIRECTORY = os.environ.get("SYNTH_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "synth"))
+MAX_BYTES = 256 * 1024**2
+RENDER_MAX_BYTES = 1024**3
+# Eviction frees space down to this fraction of the maximum, so a full cache isn't rescanned on every write.
+LOW_WATER = 0.9
+
+
+class DiskCache:
+    """Content-addressed cache of NumPy arrays, stored as .npy files and memory-mapped back (read-only).
+
+    Keys hash everything the array depends on (parameters, sample rate, source file contents) plus VERSION.
+    Entries live in a per-version directory (`<directory>/versions/v<VERSION>`), so a version bump discards old
+    entries; nothing is created or removed until the first write. When the cache grows past `max_bytes`, the least
+    recently used entries are evicted (down to LOW_WATER of it). The total size is tallied as entries are written
+    (after one scan of the directory), so the directory is only scanned again to evict."""
+
+    NAME = "Disk cache"
+    SUFFIXES = (".npy",)
+
+    def __init__(self, directory=DIRECTORY, max_bytes=MAX_BYTES):
+        self.root = directory
+        # Only this subdirectory is the cache's own to clean up, so `directory` can be shared with anything else.
+        self.versions = os.path.join(directory, "versions")
+        self.directory = os.path.join(self.versions, f"v{VERSION}")
+        self.max_bytes = max_bytes
+        self.enabled = bool(directory)
+        self.prepared = False
+        self.hits = self.misses = 0
+        self.file_hashes = {}
+        # Bytes in the cache, or None until the directory is first scanned.
+        self.size = None
+
+    def _prepare(self):
+        "Create the cache directory and remove the entries of other versions (on the first write)."
+        if self.prepared:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError:
+            # Reported by the caller; don't try again.
+            self.enabled = False
+            raise
+        for name in os.listdir(self.versions):
+            if re.fullmatch(r"v\d+", name) and name != f"v{VERSION}":
+                shutil.rmtree(os.path.join(self.versions, name), ignore_errors=True)
+        self.prepared = True
+
+    def key(self, *parts):
+        return hashlib.sha256(repr((VERSION,) + parts).encode()).hexdigest()
+
+    def file_hash(self, filename):
+        "Hash of a file's contents (memoized while its size and modification time are unchanged)."
+        info = os.stat(filename)
+        signature = (os.path.abspath(filename), info.st_size, info.st_mtime_ns)
+        if signature not in self.file_hashes:
+            digest = hashlib.sha256()
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            self.file_hashes[signature] = digest.hexdigest()
+        return self.file_hashes[signature]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            # A plain ndarray view (not np.memmap), which keeps the mapping alive and pickles like any other array.
+            array = np.load(path, mmap_mode="r").view(np.ndarray)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used, for eviction.
+        os.utime(path)
+        return array
+
+    def put(self, key, array):
+        if not self.enabled:
+            return
+        try:
+            # Write to a temporary file and rename, so readers (e.g. other processes) never see partial files.
+            self._write(self._path(key), lambda f: np.save(f, array))
+            self.evict()
+        except OSError as e:
+            print(f"Failed to write to the disk cache ({e}).")
+
+    def _write(self, path, write):
+        self._prepare()
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        growth = os.path.getsize(temporary)
+        try:
+            growth -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.replace(temporary, path)
+        if self.size is not None:
+            self.size += growth
+
+    def cached(self, compute, *parts):
+        "Return the array for `parts`, from the cache or by calling `compute()` and storing its result."
+        key = self.key(*parts)
+        array = self.get(key)
+        if array is not None:
+            self.hits += 1
+            return array
+        self.misses += 1
+        array = np.asarray(compute())
+        self.put(key, array)
+        return array
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        with os.scandir(self.directory) as it:
+            return [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in it if entry.name.endswith(self.SUFFIXES)]
+
+    def evict(self):
+        "If the cache is over `max_bytes`, remove the least recently used entries until it is under LOW_WATER of it."
+        if self.size is not None and self.size <= self.max_bytes:
+            return
+        # (A fresh scan also picks up entries written by other processes.)
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in entries:
+                if total <= self.max_bytes * LOW_WATER:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        self.size = total
+
+    def clear(self):
+        if not self.enabled:
+            return
+        for _, _, path in self.entries():
+            os.remove(path)
+        self.size = 0
+
+    def info(self):
+        if not self.enabled:
+            return f"{self.NAME} disabled."
+        entries = self.entries()
+        size = sum(size for _, size, _ in entries)
+        return (f"{self.NAME} at '{self.directory}': {len(entries)} files, {size / 1024**2:.1f} of {self.max_bytes / 1024**2:.0f} MB "
+                f"({self.hits} hits, {self.misses} misses this session).")
+
+
+class RenderCache(DiskCache):
+    """Cache of rendered WAV files, each stored with a snapshot of the engine state the render ended in.
+
+    Keys hash the engine state the render started from (see `SynthEngine.get_state`) and the render's other inputs."""
+
+    NAME = "Render cache"
+    SUFFIXES = (".wav", ".state")
+
+    def key(self, buffers, *parts):
+        digest = hashlib.sha256(repr((VERSION,) + parts).encode())
+        for buffer in buffers:
+            digest.update(buffer)
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        "Paths of the cached WAV file and final state for `key`, or None."
+        if not self.enabled:
+            return None
+        paths = [os.path.join(self.directory, key + suffix) for suffix in self.SUFFIXES]
+        if not all(os.path.exists(path) for path in paths):
+            self.misses += 1
+            return None
+        for path in paths:
+            os.utime(path)
+        self.hits += 1
+        return paths
+
+    def store(self, key, filename, snapshot):
+        if not self.enabled:
+            return
+        wav, snapshot_path = (os.path.join(self.directory, key + suffix) for suffix in self.SUFFIXES)
+        try:
+            with open(filename, "rb") as source:
+                self._write(wav, lambda f: shutil.copyfileobj(source, f))
+            self._write(snapshot_path, lambda f: state.write(snapshot, f))
+            self.evict()
+        except OSError as e:
+            print(f"Failed to write to the render cache ({e}).")
+
+
+cache = DiskCache()
+renders = RenderCache(os.path.join(DIRECTORY, "renders") if DIRECTORY else "", RENDER_MAX_BYTES)
@@ -0,0 +1,112 @@
+import numpy as np
+
+from module import control
+
+
+class Chain:
+    """Serial signal chain, compiled into an execution plan that is rebuilt when the modules or their mix values change.
+
+    The plan skips modules with mix 0, runs modules with mix 1 without a crossfade, lets modules that
+    support it fold the crossfade into their own output write (`process_mixed`), and runs modules in place
+    wherever possible. Buffer slots are reused as soon as the signal in them is no longer live.
+
+    While a module's input is silent and it is at rest (see `Module.at_rest`), it is skipped and only advanced, so a
+    chain that has gone quiet costs next to nothing. (`skip_silence` turns this off.)"""
+
+    def __init__(self, modules):
+        self.modules = list(modules)
+        self.skip_silence = True
+        self.buffers = []
+        self.shape = None
+        self.key = None
+
+    def allocate(self, shape):
+        """Set the largest (frames, channels) block shape the chain will process.
+
+        The buffers are replaced, not resized, so a block already running keeps the ones it started with."""
+        self.shape = shape
+        self.buffers = [np.zeros(shape) for _ in self.buffers]
+        for module in self.modules:
+            # Graph nodes (see graph.py) own buffers too.
+            if hasattr(module, "allocate"):
+                module.allocate(shape)
+
+    def _key(self, external):
+        # Per-sample (automated) mix values always need a full crossfade, whatever their values.
+        return external, tuple((module, module.mix if np.ndim(module.mix) == 0 else None) for module in self.modules)
+
+    def compile(self, external=False):
+        """Build the list of (step kind, module, input slot, output slot) steps and the slot holding the result.
+
+        If `external` is set, slot 0 holds a buffer the chain does not own (e.g. shared by parallel branches) and is never written."""
+        plan = []
+        current, slots = 0, 1
+        first_writable = 1 if external else 0
+        for module in self.modules:
+            mix = module.mix if getattr(module, "DRY_WET", True) else 1
+            if np.ndim(mix) == 0 and mix == 0:
+                continue
+            if np.ndim(mix) == 0 and mix == 1:
+                kind = "wet"
+            elif hasattr(module, "process_mixed"):
+                kind = "fused"
+            else:
+                kind = "crossfade"
+            if kind != "crossfade" and getattr(module, "IN_PLACE", False) and current >= first_writable:
+                output = current
+            else:
+                # The input is dead once this step has run, so a two-slot ping-pong is all a serial chain needs.
+                output = first_writable if current != first_writable else first_writable + 1
+                slots = max(slots, output + 1)
+            plan.append((kind, module, current, output))
+            current = output
+        return plan, current, slots
+
+    def _prepare(self, external):
+        key = self._key(external)
+        if key != self.key:
+            self.plan, self.result, self.slots = self.compile(external)
+            self.key = key
+        # (Checked every block, as `allocate` may replace the buffers from another thread.)
+        while len(self.buffers) < self.slots:
+            self.buffers.append(np.zeros(self.shape))
+
+    def advance(self, n, channels, external=False):
+        "Advance the modules that `process` would run (see `Module.advance`)."
+        self._prepare(external)
+        for _, module, _, _ in self.plan:
+            module.advance(n, channels)
+
+    def process(self, n, input_buffer=None):
+        """Run the chain on the first `n` frames of its input buffer (see `input`), returning a view of the result.
+
+        If `input_buffer` is given, it is read instead and left untouched. The result may be the input buffer itself."""
+        external = input_buffer is not None
+        self._prepare(external)
+        buffers = [buffer[:n] for buffer in self.buffers]
+        if external:
+            buffers[0] = input_buffer
+        for kind, module, source, destination in self.plan:
+            input_buffer, output_buffer = buffers[source], buffers[destination]
+            if self.skip_silence and module.at_rest() and not input_buffer.any():
+                module.advance(n, input_buffer.shape[1])
+                if destination != source:
+                    output_buffer[:] = 0
+                continue
+            if kind == "wet":
+                module.process(input_buffer, output_buffer)
+            elif kind == "fused":
+                module.process_mixed(input_buffer, output_buffer, module.mix)
+            else:
+                module.process(input_buffer, output_buffer)
+                # output = mix * wet + (1 - mix) * dry, in three in-place passes.
+                output_buffer -= input_buffer
+                output_buffer *= control(module.mix, output_buffer.shape)
+                output_buffer += input_buffer
+        return buffers[self.result]
+
+    def input(self, n):
+        "The buffer the first module reads from."
+        if not self.buffers:
+            self.buffers.append(np.zeros(self.shape))
+        return self.buffers[0][:n]
@@ -0,0 +1,350 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
+import importlib.util
+import os
+import sys
+
+import mido
+
+from cache import cache, renders
+from virtual import VirtualStream
+
+
+class OSCProtocol(asyncio.DatagramProtocol):
+    "Reads OSC packets (messages or bundles) on the event loop, in place of oscpy's server thread."
+
+    def __init__(self, console):
+        from oscpy.parser import format_message, read_packet
+        self.format_message = format_message
+        self.read_packet = read_packet
+        self.console = console
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def reply(self, sender, address, values):
+        "Send a message back to `sender` (from any thread)."
+        message, _ = self.format_message(address, values)
+        self.console.loop.call_soon_threadsafe(self.transport.sendto, message, sender)
+
+    def datagram_received(self, data, sender):
+        try:
+            messages = self.read_packet(data)
+        except Exception as e:
+            self.console.engine.osc_control.stats["errors"] += 1
+            print(f"Invalid OSC packet from {sender[0]}: {e}")
+            return
+        reply = functools.partial(self.reply, sender)
+        for address, _, values, _ in messages:
+            self.console.osc_message(address, values, reply)
+
+
+class Console:
+    """Control plane on an asyncio event loop: the CLI, OSC, MIDI file playback, background renders and status reports.
+
+    Nothing on the loop blocks. Commands that change the engine (which may redesign filters or load samples) run
+    in order on a single control thread, and renders run on a thread of their own, so the prompt, OSC and MIDI
+    playback stay responsive meanwhile. Renders run on a copy of the engine taken when they start, so changes made
+    meanwhile apply to the live engine only, and never to a render (or the render cache)."""
+
+    # Commands that drive the engine themselves, and so can't run during a render.
+    EXCLUSIVE = ("start", "record", "render", "sweep", "load", "pcm")
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.control = ThreadPoolExecutor(1, thread_name_prefix="control")
+        self.background = ThreadPoolExecutor(1, thread_name_prefix="render")
+        # OSC updates to slow parameters are applied on the control thread too.
+        engine.osc_control.executor = self.control
+        # Task name -> (task, function returning a status line).
+        self.tasks = {}
+        # Futures for prompts waiting on the next line of input, which they take before the command loop does.
+        self.questions = []
+        self.osc = None
+        self.running = False
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            # Allow Ctrl+C to exit.
+            print()
+        self.engine.stop_stream()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.lines = asyncio.Queue()
+        self.engine.ask = self.ask_from_thread
+        try:
+            self.loop.add_reader(sys.stdin, self._read_stdin)
+        except NotImplementedError:
+            # Event loops without reader callbacks (e.g. on Windows) read the console on a thread instead.
+            self.spawn("stdin", self._read_stdin_blocking(), lambda: None)
+        self.running = True
+        try:
+            while self.running:
+                print("> ", end="", flush=True)
+                line = await self.lines.get()
+                if line is None:
+                    # Allow Ctrl+D to exit.
+                    print()
+                    break
+                command, *params = line.rstrip("\n").split(" ", 1)
+                await self.handle_command(command, params[0] if params else '')
+        finally:
+            await self.shutdown()
+
+    def _read_stdin(self):
+        line = sys.stdin.readline()
+        if not line:
+            # End of input stays readable; stop watching it.
+            self.loop.remove_reader(sys.stdin)
+        self._receive_line(line)
+
+    async def _read_stdin_blocking(self):
+        while True:
+            line = await self.loop.run_in_executor(None, sys.stdin.readline)
+            self._receive_line(line)
+            if not line:
+                return
+
+    def _receive_line(self, line):
+        if not line:
+            # End of input: decline any open prompts and exit.
+            for answer in self.questions:
+                answer.set_result("")
+            self.questions.clear()
+            self.lines.put_nowait(None)
+        elif self.questions:
+            self.questions.pop(0).set_result(line.rstrip("\n"))
+        else:
+            self.lines.put_nowait(line)
+
+    async def ask(self, question):
+        "Prompt for a line of input without blocking the loop."
+        print(question, end="", flush=True)
+        answer = self.loop.create_future()
+        self.questions.append(answer)
+        return await answer
+
+    def ask_from_thread(self, question):
+        "`SynthEngine.ask` for commands running on the control or render threads."
+        return asyncio.run_coroutine_threadsafe(self.ask(question), self.loop).result()
+
+    def spawn(self, name, coroutine, status):
+        "Run `coroutine` as a background task; `status` returns a line describing its progress."
+        task = self.loop.create_task(coroutine)
+        self.tasks[name] = (task, status)
+
+        def done(task):
+            if self.tasks.get(name, (None,))[0] is task:
+                del self.tasks[name]
+            if not task.cancelled() and task.exception():
+                print(f"{name} failed: {task.exception()!r}")
+
+        task.add_done_callback(done)
+        return task
+
+    def run_control(self, function, *args):
+        "Run a function that changes the engine on the control thread (in order with other changes)."
+        return self.loop.run_in_executor(self.control, function, *args)
+
+    async def copy_engine(self):
+        "A copy of the engine, as of the changes queued so far, for a background render to run on."
+        engine = await self.run_control(copy.deepcopy, self.engine)
+        engine.ask = self.ask_from_thread
+        return engine
+
+    async def handle_command(self, command, params):
+        if command in self.EXCLUSIVE and "render" in self.tasks:
+            print(f"Can't '{command}' while rendering (see 'status').")
+        elif command == "render":
+            await self.render(params)
+        elif command == "sweep":
+            async def sweep(engine):
+                await self.loop.run_in_executor(self.background, engine.handle_command, command, params)
+            if self.engine.stop_stream():
+                print("Stopping the stream to render to file. (Restart with 'start'.)")
+            self.spawn("render", sweep(await self.copy_engine()), lambda: "sweep: rendering")
+        elif command == "midi" and params.split(" ")[0] in ("file", "stop"):
+            await self.handle_midi_command(*params.split(" ", 1))
+        elif command == "osc" and params.split(" ")[0] in ("start", "stop"):
+            self.handle_osc_command(*params.split(" ", 1))
+        elif command == "status":
+            self.handle_status_command(params)
+        elif command in ["exit", "quit"]:
+            print("Farewell.")
+            self.running = False
+        else:
+            await self.run_control(self.engine.handle_command, command, params)
+
+    async def render(self, params):
+        try:
+            duration, *params = params.split(" ")
+            duration = float(duration)
+            jobs = int(params[1]) if len(params) > 1 else 1
+        except ValueError:
+            print("Usage: render <duration in seconds> [filename] [parallel jobs] [MIDI file]")
+            return
+        filename = params[0] if params else "out.wav"
+        midi_file = params[2] if len(params) > 2 else None
+        if not filename.endswith(".wav"):
+            filename += ".wav"
+        if not await self.run_control(self.engine.confirm_overwrite, [filename]):
+            return
+        if midi_file and not os.path.exists(midi_file):
+            print(f"No MIDI file '{midi_file}'.")
+            return
+        if self.engine.stop_stream():
+            print("Stopping the stream to render to file. (Restart with 'start'.)")
+        progress = [0]
+
+        def report(fraction):
+            # Called on the render thread.
+            progress[0] = fraction
+
+        async def render(engine):
+            await self.loop.run_in_executor(self.background, engine.render_file, filename, duration, jobs, midi_file, report)
+
+        self.spawn("render", render(await self.copy_engine()), lambda: f"render '{filename}': {progress[0] * 100:.0f}% of {duration:.2f}s")
+        print(f"Rendering '{filename}' in the background (see 'status').")
+
+    async def handle_midi_command(self, command, params=""):
+        if command == "stop":
+            if "midi file" in self.tasks:
+                self.tasks["midi file"][0].cancel()
+            else:
+                print("No MIDI file playing.")
+            return
+        if not params:
+            print("Usage: midi file <filename>")
+            return
+        try:
+            midi = await self.run_control(mido.MidiFile, params)
+        except Exception:
+            print(f"Failed to open MIDI file '{params}'.")
+            return
+        if "midi file" in self.tasks:
+            self.tasks["midi file"][0].cancel()
+        position = [0]
+        self.spawn("midi file", self.play_midi(midi, position),
+                   lambda: f"midi file '{params}': {position[0]:.1f}/{midi.length:.1f}s")
+
+    async def play_midi(self, midi, position):
+        "Play the note-ons of a MIDI file in real time (scheduled against the loop's clock, so delays don't accumulate)."
+        engine = self.engine
+        engine.envelope.mix = 1
+        start = self.loop.time()
+        try:
+            for message in midi:
+                position[0] += message.time
+                delay = start + position[0] - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not message.is_meta and message.type == 'note_on':
+                    engine.handle_midi(message.note, message.velocity)
+        finally:
+            if not engine.midi:
+                engine.envelope.mix = 0
+
+    def handle_osc_command(self, command, params=""):
+        if command == "stop":
+            if self.osc:
+                self.osc.close()
+                self.osc = None
+                print("Stopped server.")
+            else:
+                print("Not running!")
+            return
+        try:
+            port = int(params) if params else 8000
+        except ValueError:
+            print("Usage: osc start [port, defaults to 8000]")
+            return
+        if importlib.util.find_spec("oscpy") is None:
+            print("OSC commands require oscpy (run `pip install oscpy`).")
+            return
+        if self.osc:
+            self.osc.close()
+            print("Stopped server.")
+
+        async def listen():
+            try:
+                self.osc, _ = await self.loop.create_datagram_endpoint(lambda: OSCProtocol(self), local_addr=('0.0.0.0', port))
+            except OSError as e:
+                print(f"Failed to start server on port {port}: {e}")
+                return
+            print(f"Started server on port {port}.")
+
+        self.loop.create_task(listen())
+
+    def osc_message(self, address, values, reply):
+        control = self.engine.osc_control
+        if self.engine.stream is not None:
+            # Queued for the next block (or the control thread); cheap enough to handle on the loop. (So are the cached responses.)
+            control.receive(address, *values, reply=reply)
+        else:
+            # Applied immediately, which may redesign a filter or load a file.
+            self.run_control(functools.partial(control.receive, address, *values, reply=reply))
+
+    def handle_status_command(self, params):
+        if "status" in self.tasks:
+            self.tasks["status"][0].cancel()
+        if params == "off":
+            return
+        if not params:
+            self.print_status()
+            return
+        try:
+            interval = float(params)
+        except ValueError:
+            print("Usage: status [interval in seconds|off]")
+            return
+
+        async def report():
+            while True:
+                await asyncio.sleep(interval)
+                print()
+                self.print_status()
+
+        self.spawn("status", report(), lambda: f"reporting status every {interval:g}s")
+
+    def print_status(self):
+        engine = self.engine
+        if engine.stream:
+            print(f"Streaming{' and recording' if engine.recording_out else ''}: {engine.external_samplerate} Hz, "
+                  f"{engine.blocksize} frames, {engine.channels} channels.")
+        else:
+            print("Not streaming.")
+        for _, status in list(self.tasks.values()):
+            line = status()
+            if line:
+                print("  " + line)
+        if engine.stream:
+            print("  " + engine.quality.info())
+        if engine.pcm:
+            print("  " + engine.pcm.info())
+        if isinstance(engine.stream, VirtualStream):
+            print("  " + engine.stream.info())
+        if self.osc:
+            print("  " + engine.osc_control.info())
+        print(f"  Disk cache: {cache.hits} hits, {cache.misses} misses; render cache: {renders.hits} hits, {renders.misses} misses.")
+
+    async def shutdown(self):
+        self.running = False
+        try:
+            self.loop.remove_reader(sys.stdin)
+        except (NotImplementedError, ValueError):
+            pass
+        if self.osc:
+            self.osc.close()
+        for name, (task, _) in list(self.tasks.items()):
+            if name == "render":
+                print("Waiting for the render to finish...")
+                await task
+            else:
+                task.cancel()
+        self.control.shutdown()
+        self.background.shutdown()
@@ -1,29 +1,47 @@
 import numpy as np
 from scipy import signal
 
-from module import Module
+from cache import cache
+from module import Module, control, current
 import utility
 
 
 class ShortConvolver(Module):
     "Short convolution, for impulse responses shorter than the block size."
 
+    IN_PLACE = True
+
     def __init__(self, sample_rate, impulse_response):
         super().__init__(sample_rate)
         self.impulse_response = impulse_response
         self.history = np.zeros(len(impulse_response) - 1)
 
-    def process(self, input_buffer, output_buffer):
+    def process(self, input_buffer, output_buffer, impulse_response=None):
+        # Per-channel history, reset when the channel layout changes.
+        if self.history.shape[1:] != input_buffer.shape[1:]:
+            self.history = np.zeros((len(self.history),) + input_buffer.shape[1:])
         buffer_with_history = np.concatenate((self.history, input_buffer))
         # NOTE: The order is important here, since output_buffer refer to the same memory as input_buffer.
         self.history[:] = input_buffer[-len(self.history):]
-        output_buffer[:] = np.convolve(buffer_with_history, self.impulse_response, mode='valid')
+        # Convolve along time only, for all channels at once.
+        if impulse_response is None:
+            impulse_response = self.impulse_response
+        if impulse_response.ndim == 2:
+            # One impulse response per channel (batch rendering).
+            for j in range(input_buffer.shape[1]):
+                output_buffer[:, j] = signal.convolve(buffer_with_history[:, j], impulse_response[:, j], mode='valid')
+            return
+        impulse_response = impulse_response.reshape((-1,) + (1,)*(input_buffer.ndim - 1))
+        output_buffer[:] = signal.convolve(buffer_with_history, impulse_response, mode='valid')
  
 
 class ConvolutionFilter(Module):
     "Filter audio by convolving with Parks-McClellan/Remez exchange algorithm-designed FIR."
 
     PARAMETERS = ("order", "freq", "bandwidth", "transition_width", "type", "mix")
+    BATCH_PARAMETERS = PARAMETERS
+    SLOW_PARAMETERS = ("order", "freq", "bandwidth", "transition_width", "type")
+    IN_PLACE = True
 
     def __init__(self, sample_rate, order=28, freq=1000, bandwidth=400, transition_width=300, type="bpf"):
         super().__init__(sample_rate)
@@ -33,8 +51,18 @@ class ConvolutionFilter(Module):
         self._transition_width = transition_width
         self._type = type
         self._rebuild()
+
+    def set_sample_rate(self, sample_rate):
+        super().set_sample_rate(sample_rate)
+        # The band edges are in Hz, so the taps are redesigned for the new rate.
+        self._rebuild()
     
     def _rebuild(self):
+        # TODO: Maybe preserve input history post-rebuild?
+        self.convolver = ShortConvolver(self.sample_rate, self._design())
+        self.mixed_taps = (None, None)
+
+    def _design(self):
         if self._type == 'lpf':
             bands = [0, self._freq, self._freq + self._transition_width, self.sample_rate/2]
             weights = [1, 0]
@@ -49,13 +77,38 @@ class ConvolutionFilter(Module):
             band = (self.freq - self._bandwidth/2, self.freq + self._bandwidth/2)
             bands = [0, band[0] - self._transition_width, band[0], band[1], band[1] + self._transition_width, self.sample_rate/2]
             weights = [1, 0, 1]
-        taps = signal.remez(self._order + 1, bands, weights, Hz=self.sample_rate)
-        # TODO: Maybe preserve input history post-rebuild?
+        bands = [float(band) for band in bands]
+        # Remez is slow at high orders; designs are cached on disk by their parameters.
+        return cache.cached(lambda: signal.remez(self._order + 1, bands, weights, Hz=self.sample_rate),
+                            "remez", self._order + 1, bands, weights, float(self.sample_rate))
+
+    def set_batch(self, name, values, channels):
+        if name == "mix" or name not in self.BATCH_PARAMETERS:
+            return super().set_batch(name, values, channels)
+        # Design one filter per variant, zero-padded to the longest, with a column per channel.
+        original = getattr(self, "_" + name)
+        designs = []
+        for value in values:
+            setattr(self, "_" + name, value)
+            designs.append(self._design())
+        setattr(self, "_" + name, original)
+        taps = np.zeros((max(map(len, designs)), len(designs) * channels))
+        for k, design in enumerate(designs):
+            taps[:len(design), k*channels:(k + 1)*channels] = design[:, None]
         self.convolver = ShortConvolver(self.sample_rate, taps)
+        self.mixed_taps = (None, None)
     
+    def frequency_response(self, points=2048):
+        """(Frequencies in Hz, magnitude, phase) of the current taps.
+
+        Batched filters give the last variant's response."""
+        taps = self.convolver.impulse_response
+        if taps.ndim == 2:
+            taps = taps[:, -1]
+        return utility.frequency_response(taps, [1], self.sample_rate, points, current(self.mix))
+
     def visualize_filter(self):
-        w, h = signal.freqz(self.convolver.impulse_response, worN=2048)
-        utility.plot_response(self.sample_rate, w, h, "FIR Frequency Response")
+        utility.plot_response(self.frequency_response(), "FIR Frequency Response")
 
     @property
     def order(self):
@@ -102,5 +155,25 @@ class ConvolutionFilter(Module):
         self._type = value
         self._rebuild()
     
+    def at_rest(self):
+        return not self.convolver.history.any()
+
     def process(self, input_buffer, output_buffer):
-        self.convolver.process(input_buffer, output_buffer)
\ No newline at end of file
+        self.convolver.process(input_buffer, output_buffer)
+
+    def process_mixed(self, input_buffer, output_buffer, mix):
+        "Filter crossfaded with the dry input, in a single convolution."
+        if np.ndim(mix):
+            # Per-sample mix can't be folded into the taps. (Copy the dry signal, as we may be running in place.)
+            dry = input_buffer.copy()
+            self.convolver.process(input_buffer, output_buffer)
+            output_buffer -= dry
+            output_buffer *= control(mix, output_buffer.shape)
+            output_buffer += dry
+            return
+        if self.mixed_taps[0] != mix:
+            # The dry signal is a unit impulse at lag 0, so mix * taps + (1 - mix) * dry is another FIR.
+            taps = mix * self.convolver.impulse_response
+            taps[0] += 1 - mix
+            self.mixed_taps = (mix, taps)
+        self.convolver.process(input_buffer, output_buffer, self.mixed_taps[1])
\ No newline at end of file
@@ -1,63 +1,214 @@
 import numpy as np
 
-from module import Module
+from lfo import LFO
+from module import Module, batch, control, flush
+
+
+def capacity(frames):
+    "Smallest power of two holding `frames` frames."
+    return 1 << max(int(np.ceil(frames)) - 1, 0).bit_length()
+
+
+class DelayLine(Module):
+    """Ring buffer of past samples, for delay-based modules.
+
+    The capacity is a power of two, so positions wrap with a bitmask. `reserve` grows it as longer delays are
+    needed, keeping what's buffered, and `read` gathers any number of taps over a whole block in one go."""
+
+    def __init__(self, sample_rate, frames=1):
+        super().__init__(sample_rate)
+        self.buffer = np.zeros(capacity(frames))
+        # Position of the next frame written.
+        self.index = 0
+
+    @property
+    def mask(self):
+        return len(self.buffer) - 1
+
+    def ordered(self):
+        "The buffered frames, oldest first."
+        return np.roll(self.buffer, -self.index, axis=0)
+
+    def resize(self, frames):
+        "Set the capacity to hold `frames` frames, keeping the most recent ones."
+        size = capacity(frames)
+        if size == len(self.buffer):
+            return
+        kept = self.ordered()[-size:]
+        self.buffer = np.zeros((size,) + self.buffer.shape[1:])
+        self.buffer[size - len(kept):] = kept
+        self.index = 0
+
+    def reserve(self, frames):
+        "Grow (never shrink) to hold `frames` frames."
+        if frames > len(self.buffer):
+            self.resize(frames)
+
+    def set_sample_rate(self, sample_rate):
+        # Keep the same length of time, resampling the buffered signal so that it carries on.
+        old = self.ordered()
+        length = max(int(len(old) * sample_rate / self.sample_rate), 1)
+        super().set_sample_rate(sample_rate)
+        times = np.arange(length) * len(old) / length
+        columns = old.reshape(len(old), -1).T
+        resampled = np.stack([np.interp(times, np.arange(len(old)), column) for column in columns], axis=1)
+        self.buffer = np.zeros((capacity(length),) + old.shape[1:])
+        self.buffer[:length] = resampled.reshape((length,) + old.shape[1:])
+        self.index = length & self.mask
+
+    def channels(self, shape):
+        "Match the channel layout of blocks with `shape` (after the frame axis), clearing the buffer if it changes."
+        if self.buffer.shape[1:] != shape:
+            self.buffer = np.zeros((len(self.buffer),) + shape)
+
+    def write(self, block):
+        "Append a block of frames."
+        positions = (self.index + np.arange(len(block))) & self.mask
+        self.buffer[positions] = block
+        self.index = (self.index + len(block)) & self.mask
+
+    def read(self, delays):
+        """Samples `delays` frames before each frame of the block just written (linearly interpolated).
+
+        `delays` has a row for each frame of that block, with any number of taps in each; the result adds the
+        channel axes. Delays of up to the capacity minus the block length can be read."""
+        delays = np.asarray(delays, dtype=float)
+        n = len(delays)
+        whole = delays.astype(np.intp)
+        frac = delays - whole
+        frames = np.arange(self.index - n, self.index).reshape((n,) + (1,)*(delays.ndim - 1))
+        newer = (frames - whole) & self.mask
+        older = (newer - 1) & self.mask
+        frac = frac.reshape(frac.shape + (1,)*(self.buffer.ndim - 1))
+        return (1 - frac) * self.buffer[newer] + frac * self.buffer[older]
+
+    def at_rest(self):
+        return not self.buffer.any()
 
 
 class ModulatedDelay(Module):
 
     PARAMETERS = ("duration", "feedback", "mix")
+    BATCH_PARAMETERS = ("feedback", "mix")
 
     def __init__(self, sample_rate, duration, mix, feedback):
         super().__init__(sample_rate, mix=mix)
-        self.buffer = np.zeros(int(duration * sample_rate))
+        self.line = DelayLine(sample_rate, int(duration * sample_rate) + 1)
         self.feedback = feedback
-        self.buffer_index = 0
     
     @property
     def duration(self):
-        return len(self.buffer)/self.sample_rate
+        "Longest delay the line holds, in seconds (at least what was set)."
+        return (len(self.line.buffer) - 1) / self.sample_rate
     
     @duration.setter
     def duration(self, value):
-        # NOTE: Changing the max delay clears the buffer.
-        self.buffer = np.zeros(int(duration * sample_rate))
-    
+        # Keeps the most recent part of the buffered signal.
+        self.line.resize(int(np.ceil(value * self.sample_rate)) + 1)
+
+    def reserve(self, duration):
+        "Make sure delays of up to `duration` seconds fit, growing the line if needed."
+        self.line.reserve(int(np.ceil(duration * self.sample_rate)) + 1)
+
     def process(self, delays, input_buffer, output_buffer):
-        buffer, buffer_index, feedback = self.buffer, self.buffer_index, self.feedback
-        for i in range(len(input_buffer)):
-            delay = delays[i]
-            d = int(delay)
-            frac = delay - d
-            out = frac * buffer[(buffer_index - d - 1) % len(buffer)] + (1 - frac) * buffer[(buffer_index - d) % len(buffer)]
-            buffer[buffer_index] = (1 - feedback) * input_buffer[i] + feedback * out
-            output_buffer[i] = out
-            buffer_index += 1
-            if buffer_index >= len(buffer):
-                buffer_index %= len(buffer)
-        self.buffer_index = buffer_index
+        line = self.line
+        line.channels(input_buffer.shape[1:])
+        buffer, mask, feedback, n = line.buffer, line.mask, self.feedback, len(input_buffer)
+        if np.ndim(feedback):
+            # Per-channel feedback (batch rendering).
+            feedback = np.ravel(feedback) if np.size(feedback) > 1 else np.ravel(feedback)[0]
+        # Compute all read/write positions up front; only the feedback recursion runs per sample.
+        delays = np.asarray(delays)
+        d = delays.astype(int)
+        frac = delays - d
+        positions = np.arange(line.index, line.index + n)
+        writes = positions & mask
+        newer = (positions.reshape((n,) + (1,)*(d.ndim - 1)) - d) & mask
+        older = (newer - 1) & mask
+        if d.ndim > 1 and d.shape[1] > 1:
+            # Per-channel delays (e.g. stereo presets): gather one sample per channel.
+            columns = np.arange(buffer.shape[1])
+            for i in range(n):
+                out = frac[i] * buffer[older[i], columns] + (1 - frac[i]) * buffer[newer[i], columns]
+                buffer[writes[i]] = (1 - feedback) * input_buffer[i] + feedback * out
+                output_buffer[i] = out
+        else:
+            older, newer, frac, writes = older.reshape(n), newer.reshape(n), frac.reshape(n), writes.tolist()
+            if input_buffer.shape[1:] == (1,):
+                # Mono: iterate over plain floats, which is much faster than over one-element rows.
+                buffer, input_buffer, output_buffer = buffer[:, 0], input_buffer[:, 0], output_buffer[:, 0]
+                older, newer, frac = older.tolist(), newer.tolist(), frac.tolist()
+            for i in range(n):
+                out = frac[i] * buffer[older[i]] + (1 - frac[i]) * buffer[newer[i]]
+                buffer[writes[i]] = (1 - feedback) * input_buffer[i] + feedback * out
+                output_buffer[i] = out
+        # Only the frames written this block can have decayed since the last flush.
+        writes = positions & mask
+        written = line.buffer[writes]
+        flush(written)
+        line.buffer[writes] = written
+        line.index = (line.index + n) & mask
+
+    def at_rest(self):
+        return self.line.at_rest()
 
 
 class Delay(Module):
 
-    PARAMETERS = ("mod_amp", "fixed_delay", "rate", "preset", "delay", "mix")
+    PARAMETERS = ("mod_amp", "fixed_delay", "rate", "taps", "preset", "delay", "lfo", "mix")
+    SIGNAL_PARAMETERS = ("rate", "mix")
+    BATCH_PARAMETERS = ("mod_amp", "fixed_delay", "rate", "preset", "mix")
+    IN_PLACE = True
+    # Presets inspired by examples from class. In terms of the slides: fixed_delay is M, mod_amp is A
+    # (but in seconds instead of samples), rate is f_mod, and mix is FF/(BL+FF).
+    # Each also has a stereo variant, e.g. "stereo_chorus". Multi-tap presets add taps: (seconds, gain) pairs read
+    # from the same delay line (so they repeat with the feedback too).
+    PRESETS = {
+        "vibrato": {"fixed_delay": .005, "mod_amp": .005, "rate": 1, "mix": 1, "feedback": 0},
+        "flanger": {"fixed_delay": .002, "mod_amp": .002, "rate": 0.2, "mix": 0.5, "feedback": 0},
+        "flanger_feedback": {"fixed_delay": .002, "mod_amp": .002, "rate": 0.2, "mix": 0.5, "feedback": 0.7},
+        "chorus": {"fixed_delay": .002, "mod_amp": .002, "rate": 1.5, "mix": 0.4, "feedback": 0},
+        "chorus_feedback": {"fixed_delay": .002, "mod_amp": .002, "rate": 1.5, "mix": 0.4, "feedback": 0.7},
+        "slapback": {"fixed_delay": 0.02, "mod_amp": 0, "rate": 0, "mix": 0.5, "feedback": 0},
+        "echo": {"fixed_delay": 0.05, "mod_amp": 0, "rate": 0, "mix": 0.5, "feedback": 0},
+        "multitap_echo": {"fixed_delay": 0.125, "mod_amp": 0, "rate": 0, "mix": 0.5, "feedback": 0.3,
+                          "taps": ((0.25, 0.5), (0.375, 0.35), (0.5, 0.25))},
+        # Dotted eighths against quarters at 120 bpm.
+        "rhythmic_echo": {"fixed_delay": 0.375, "mod_amp": 0, "rate": 0, "mix": 0.5, "feedback": 0.4,
+                          "taps": ((0.5, 0.5), (0.75, 0.3), (1.125, 0.2))},
+    }
 
     def __init__(self, sample_rate):
         super().__init__(sample_rate)
         self.delay = ModulatedDelay(sample_rate, 1.0, 1.0, 0)
-        self.time = 0
+        self.lfo = LFO(sample_rate)
         self._fixed_delay = 0
         self._mod_amp = 0
+        self.taps = ()
         self.preset = "chorus"
     
+    @property
+    def rate(self):
+        return self.lfo.rate
+
+    @rate.setter
+    def rate(self, value):
+        self.lfo.rate = value
+
+    def advance(self, n, channels):
+        self.lfo.advance(n)
+
+    def at_rest(self):
+        return self.delay.at_rest()
+
     @property
     def mod_amp(self):
         return self._mod_amp
     
     @mod_amp.setter
     def mod_amp(self, value):
-        if self.delay.duration < (self._fixed_delay + abs(self._mod_amp)):
-            self.delay.duration = self._fixed_delay + abs(self._mod_amp)
         self._mod_amp = value
+        self.delay.reserve(np.max(self._fixed_delay + np.abs(self._mod_amp)))
     
     @property
     def fixed_delay(self):
@@ -65,9 +216,24 @@ class Delay(Module):
 
     @fixed_delay.setter
     def fixed_delay(self, value):
-        if self.delay.duration < (self._fixed_delay + abs(self._mod_amp)):
-            self.delay.duration = self._fixed_delay + abs(self._mod_amp)
         self._fixed_delay = value
+        self.delay.reserve(np.max(self._fixed_delay + np.abs(self._mod_amp)))
+
+    @property
+    def taps(self):
+        return self._taps
+
+    @taps.setter
+    def taps(self, value):
+        self._taps = [tuple(tap) for tap in value]
+        self._set_taps([seconds for seconds, _ in self._taps], [gain for _, gain in self._taps])
+
+    def _set_taps(self, times, gains):
+        "Set the tap times (seconds) and gains (one per tap, or a row of per-channel gains per tap)."
+        self._tap_times = np.array(times, dtype=float)
+        self._tap_gains = np.array(gains, dtype=float)
+        if len(self._tap_times):
+            self.delay.reserve(self._tap_times.max())
     
     @property
     def preset(self):
@@ -75,56 +241,62 @@ class Delay(Module):
 
     @preset.setter
     def preset(self, value):
-        # Presets inspired by examples from class.
-        if value == "vibrato":
-            # Comments connect these to the slides:
-            self.fixed_delay = .005  # M
-            self.mod_amp = .005      # A, but in seconds instead of samples
-            self.rate = 1            # f_mod
-            self.delay.mix = 1       # FF/(BL+FF)
-            self.delay.feedback = 0
-        elif value == "flanger":
-            self.fixed_delay = .002
-            self.mod_amp = .002
-            self.rate = 0.2
-            self.delay.mix = 0.5
-            self.delay.feedback = 0
-        elif value == "flanger_feedback":
-            self.fixed_delay = .002
-            self.mod_amp = .002
-            self.rate = 0.2
-            self.delay.mix = 0.5
-            self.delay.feedback = 0.7
-        elif value == "chorus":
-            self.fixed_delay = .002
-            self.mod_amp = .002
-            self.rate = 1.5
-            self.delay.mix = 0.4
-            self.delay.feedback = 0
-        elif value == "chorus_feedback":
-            self.fixed_delay = .002
-            self.mod_amp = .002
-            self.rate = 1.5
-            self.delay.mix = 0.4
-            self.delay.feedback = 0.7
-        elif value == "slapback":
-            self.fixed_delay = 0.02
-            self.mod_amp = 0
-            self.rate = 0
-            self.delay.mix = 0.5
-            self.delay.feedback = 0
-        elif value == "echo":
-            self.fixed_delay = 0.05
-            self.mod_amp = 0
-            self.rate = 0
-            self.delay.mix = 0.5
-            self.delay.feedback = 0
-        else:
-            raise NotImplementedError(f"Unknown preset '{value}'")
+        self._apply(self._preset_settings(value))
         self._preset = value
-    
+
+    def _preset_settings(self, name):
+        if name.startswith("stereo_"):
+            # Stereo variants offset the modulation by a quarter cycle between channels.
+            return dict(self._preset_settings(name[len("stereo_"):]), spread=0.25)
+        if name not in self.PRESETS:
+            raise NotImplementedError(f"Unknown preset '{name}'")
+        return dict({"taps": ()}, **self.PRESETS[name], spread=0)
+
+    def _apply(self, settings):
+        self.fixed_delay = settings["fixed_delay"]
+        self.mod_amp = settings["mod_amp"]
+        self.rate = settings["rate"]
+        self.delay.mix = settings["mix"]
+        self.delay.feedback = settings["feedback"]
+        self.lfo.spread = settings["spread"]
+        if isinstance(settings["taps"], tuple):
+            self.taps = settings["taps"]
+        else:
+            self._taps = None
+            self._set_taps(*settings["taps"])
+
+    def set_batch(self, name, values, channels):
+        if name != "preset":
+            return super().set_batch(name, values, channels)
+        presets = [self._preset_settings(value) for value in values]
+        settings = {key: batch([preset[key] for preset in presets], channels) for key in presets[0] if key != "taps"}
+        # Phase offsets between channels restart for each variant.
+        settings["spread"] = settings["spread"] * (np.arange(settings["spread"].shape[1]) % channels)
+        # Every variant reads the taps of all of them, with gain 0 where it doesn't have one.
+        times = sorted({seconds for preset in presets for seconds, _ in preset["taps"]})
+        gains = np.zeros((len(times), len(presets) * channels))
+        for k, preset in enumerate(presets):
+            for seconds, gain in preset["taps"]:
+                gains[times.index(seconds), k*channels:(k + 1)*channels] = gain
+        settings["taps"] = [times, gains]
+        self._apply(settings)
+        self._preset = list(values)
+
     def process(self, input_buffer, output_buffer):
-        times = self.time + np.arange(len(input_buffer))/self.sample_rate
-        delays = (np.sin(2*np.pi*times*self.rate)*self._mod_amp + self._fixed_delay)*self.sample_rate
-        self.time += len(input_buffer)/self.sample_rate
-        return self.delay.process(delays, input_buffer, output_buffer)
\ No newline at end of file
+        delays = self.lfo.process(len(input_buffer), input_buffer.shape[1:])
+        if np.ndim(self._mod_amp) == 2 or np.ndim(self._fixed_delay) == 2:
+            # Per-channel delays (batch rendering).
+            delays = control(delays, input_buffer.shape).copy()
+        delays *= self._mod_amp * self.sample_rate
+        delays += self._fixed_delay * self.sample_rate
+        n = len(input_buffer)
+        if len(self._tap_times):
+            taps = self._tap_times * self.sample_rate
+            # Taps are read after the block is written, so the line also needs room for the block.
+            self.delay.line.reserve(int(np.ceil(taps.max())) + n + 1)
+        self.delay.process(delays, input_buffer, output_buffer)
+        if len(self._tap_times):
+            # All taps for the whole block in one gather: (frames, taps, channels).
+            values = self.delay.line.read(np.broadcast_to(taps, (n, len(taps))))
+            gains = self._tap_gains.reshape(self._tap_gains.shape + (1,)*(values.ndim - 1 - self._tap_gains.ndim))
+            output_buffer += np.sum(values * gains, axis=1)
\ No newline at end of file
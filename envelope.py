@@ -1,10 +1,14 @@
-from module import Module
+import numpy as np
+
+from module import Module, control
 
 
 class Envelope(Module):
     "Simple Attack/Decay Envelope"
 
     PARAMETERS = ("attack", "decay", "mix")
+    IN_PLACE = True
+    TRANSIENT = ("gains",)
 
     def __init__(self, sample_rate, attack=0.01, decay=0.3):
         super().__init__(sample_rate)
@@ -13,18 +17,31 @@ class Envelope(Module):
         self.triggered = False
         self.velocity = 0
         self.amp = 0
+        self.gains = np.zeros(0)
 
     def trigger(self, velocity):
         self.triggered = True
         self.velocity = velocity    
 
+    def at_rest(self):
+        # A triggered envelope is silent too, but must still run its attack.
+        return self.amp == 0 and not self.triggered
+
     def process(self, input_buffer, output_buffer):
+        self.process_mixed(input_buffer, output_buffer, 1)
+
+    def process_mixed(self, input_buffer, output_buffer, mix):
+        "Apply the envelope crossfaded with the dry input, folding `mix` into the gain."
         amp = self.amp
         attack = self.attack * self.sample_rate
         decay = self.decay * self.sample_rate
         velocity = self.velocity
         triggered = self.triggered
         self.triggered = False
+        if len(self.gains) < len(input_buffer):
+            self.gains = np.zeros(len(input_buffer))
+        gains = self.gains[:len(input_buffer)]
+        # The envelope is shared by all channels: compute it once, then apply it in one vectorized multiply.
         for i in range(len(input_buffer)):
             if triggered:
                 if amp < velocity / 127:
@@ -38,7 +55,15 @@ class Envelope(Module):
                     amp -= velocity / 127 / decay
                 if amp < 0:
                     amp = 0
-            output_buffer[i] = input_buffer[i] * amp
+            gains[i] = amp
+        if np.ndim(mix) == 2:
+            # Per-channel mix (batch rendering).
+            gains = gains[:, None] * mix + (1 - mix)
+        elif np.ndim(mix) or mix != 1:
+            # mix * gain + (1 - mix) is still a gain, so the crossfade costs nothing on the full block.
+            gains *= mix
+            gains += 1 - mix
+        np.multiply(input_buffer, control(gains, input_buffer.shape), out=output_buffer)
         if not self.triggered:
             self.triggered = triggered
         self.amp = amp
\ No newline at end of file
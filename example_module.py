@@ -1,5 +1,5 @@
 import numpy as np
-from module import Module
+from module import Module, control
 
 class ExampleModule(Module):
     "Just an example; generates a sine wave."
@@ -13,7 +13,8 @@ class ExampleModule(Module):
     def process(self, input_buffer, output_buffer):
         # Fill the output buffer with samples.
         # Note that other modules (such as filters) will also take an input_buffer of samples to process.
-        output_buffer[:,0] = np.sin(2*np.pi*self.freq*np.arange(len(output_buffer))/self.sample_rate + self.phase)
+        # Buffers are (frames, channels); `control` broadcasts a mono signal to every channel.
+        output_buffer[:] = control(np.sin(2*np.pi*self.freq*np.arange(len(output_buffer))/self.sample_rate + self.phase), output_buffer.shape)
         # Update state as needed.
         self.phase += 2*np.pi*self.freq*len(output_buffer)/self.sample_rate
         self.phase %= 2*np.pi
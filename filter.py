@@ -1,74 +1,282 @@
+import functools
+
 import numpy as np
 from scipy import signal
 
-from module import Module
+from module import Module, control, current, flush
 import utility
 
 
-class StateVariableFilter(Module):
+def _svf_transfer_function(f1, q1, mode):
+    "Transfer function (b, a) of one state variable filter, in the lfilter form of `FilterBank._process_block`."
+    # Padded to a common length.
+    a = np.array([1, f1*f1 + f1*q1 - 2, 1 - f1*q1, 0])
+    low = np.array([0, f1*f1, 0, 0])
+    # high = input - low - q1*(previous band); notch = low + high.
+    previous_band = np.array([0, f1, -f1, 0])
+    b = {'lpf': low, 'bpf': np.array([f1, -f1, 0, 0]),
+         'hpf': a - low - q1*previous_band, 'notch': a - q1*previous_band}[mode]
+    return b, a
 
-    PARAMETERS = ("resonance", "freq", "mode", "mix")
 
-    def __init__(self, sample_rate, freq, resonance, mode='lpf'):
+class FilterBank(Module):
+    """State variable filters in parallel, one per band, summed with `gains` (e.g. a graphic EQ or a resonator bank).
+
+    Coefficients and state are arrays with a band axis, so all the bands run together: with fixed coefficients each
+    band is filtered as a block, and with per-sample ones the recursion advances every channel and band in each step."""
+
+    PARAMETERS = ("freqs", "resonance", "gains", "mode", "mix")
+    SIGNAL_PARAMETERS = ("mix",)
+    BATCH_PARAMETERS = ("resonance", "mix")
+    IN_PLACE = True
+
+    def __init__(self, sample_rate, freqs, resonance=1, gains=1, mode='bpf'):
         super().__init__(sample_rate)
-        assert (resonance >= 0.5)
         self.resonance = resonance
-        self.freq = freq
-        self.band, self.low = 0, 0
+        self.freqs = freqs
+        self.gains = gains
+        self.band, self.low = np.zeros(()), np.zeros(())
         self.mode = mode
-    
+
     @property
-    def freq(self):
-        return self._freq
+    def freqs(self):
+        return self._freqs
 
-    @freq.setter
-    def freq(self, value):
-        self._freq = value
-        self.f1 = 2*np.sin(np.pi * value / self.sample_rate)
+    @freqs.setter
+    def freqs(self, value):
+        self._freqs = value
+        self.f1 = 2*np.sin(np.pi * np.asarray(value, dtype=float) / self.sample_rate)
 
     @property
     def resonance(self):
         return self._resonance
-    
+
     @resonance.setter
     def resonance(self, value):
         self._resonance = value
-        self.q1 = 1/value
-    
+        self.q1 = 1/np.asarray(value, dtype=float)
+
+    def set_sample_rate(self, sample_rate):
+        super().set_sample_rate(sample_rate)
+        self.freqs = self.freqs
+
+    def _axes(self, value):
+        "Reshape a coefficient to (frames or 1, channels or 1, bands or 1), for broadcasting."
+        # Lists and 1-D arrays are per band; (1, channels) arrays are per channel (batch rendering).
+        value = np.asarray(value, dtype=float)
+        return value.reshape(1, 1, -1) if value.ndim <= 1 else value[..., None]
+
+    def _state(self, channels):
+        "(band, low) state of shape (channels, bands), reset when the channel layout or number of bands changes."
+        shape = channels + (np.size(self.f1),)
+        if self.low.shape != shape:
+            self.band, self.low = np.zeros(shape), np.zeros(shape)
+        return self.band, self.low
+
+    def frequency_response(self, points=2048):
+        """(Frequencies in Hz, magnitude, phase) of the weighted sum of the bands at the current settings.
+
+        Batched parameters use the last variant's values."""
+        bands = np.size(self.f1)
+        f1, q1, gains = (np.broadcast_to(self._axes(c)[-1, -1], (bands,)) for c in (self.f1, self.q1, self.gains))
+        response = 0
+        for k in range(bands):
+            w, h = signal.freqz(*_svf_transfer_function(f1[k], q1[k], self.mode), worN=points)
+            response = response + gains[k] * h
+        mix = current(self.mix)
+        response = mix * response + (1 - mix)
+        return w * self.sample_rate / (2 * np.pi), np.abs(response), np.angle(response)
+
     def visualize_filter(self):
-        # Create a clean copy with the same settings.
-        filter = StateVariableFilter(self.sample_rate, self._freq, self._resonance, self.mode)
-        # Compute the impulse response
-        impulse = np.zeros(2048)
-        impulse[0] = 1
-        filter.process(impulse, impulse)
-        w, h = signal.freqz(impulse, worN=2048)
-        utility.plot_response(self.sample_rate, w, h, "SVF Frequency Response")
+        utility.plot_response(self.frequency_response(), "Filter Bank Frequency Response")
 
     def process(self, input_buffer, output_buffer):
-        mode, q1, f1, band, low = self.mode, self.q1, self.f1, self.band, self.low
-        for i in range(len(input_buffer)):
-            low += f1 * band
-            high = input_buffer[i] - low - q1*band
-            band += f1 * high
+        band, low = self._state(input_buffer.shape[1:])
+        f1, q1, gains = self._axes(self.f1), self._axes(self.q1), self._axes(self.gains)
+        if len(f1) == 1 and len(q1) == 1:
+            self._process_fixed(input_buffer, output_buffer, f1[0], q1[0], gains[0], band, low)
+        else:
+            self._process_samples(input_buffer, output_buffer, f1, q1, gains[0], band, low)
+        flush(band)
+        flush(low)
+
+    def at_rest(self):
+        return not (self.band.any() or self.low.any())
+
+    def _process_fixed(self, input_buffer, output_buffer, f1, q1, gains, band, low):
+        "Filter with fixed (channels or 1, bands or 1) coefficients, one band at a time."
+        bands = band.shape[-1]
+        rows = max(len(f1), len(q1))
+        f1, q1 = np.broadcast_to(f1, (rows, bands)), np.broadcast_to(q1, (rows, bands))
+        gains = np.broadcast_to(gains, (len(gains), bands))
+        # A single band at unit gain is written straight to the output; otherwise the bands are summed aside, as
+        # the input may be the output buffer.
+        single = bands == 1 and np.all(gains == 1)
+        if not single:
+            out, total = np.empty_like(input_buffer), np.zeros_like(input_buffer)
+        for k in range(bands):
+            destination = output_buffer if single else out
+            if rows == 1:
+                band[..., k], low[..., k] = self._process_block(input_buffer, destination, f1[0, k], q1[0, k], band[..., k], low[..., k])
+            else:
+                # Per-channel coefficients (batch rendering): still time-invariant, so filter each channel as a block.
+                for j in range(rows):
+                    band[j, k], low[j, k] = self._process_block(input_buffer[:, j], destination[:, j], f1[j, k], q1[j, k], band[j, k], low[j, k])
+            if not single:
+                out *= gains[:, k]
+                total += out
+        if not single:
+            output_buffer[:] = total
+
+    def _process_block(self, input_buffer, output_buffer, f1, q1, band, low):
+        "Filter with fixed coefficients, returning the final (band, low) state."
+        # With fixed coefficients the filter is linear time-invariant, so compute its low and band
+        # outputs with lfilter, vectorized over time and channels.
+        a = [1, f1*f1 + f1*q1 - 2, 1 - f1*q1]
+        # Initial conditions: the zero-input response over the next two samples determines lfilter's state.
+        low1 = low + f1*band
+        band1 = band - f1*(low1 + q1*band)
+        low2 = low1 + f1*band1
+        band2 = band1 - f1*(low2 + q1*band1)
+        lows = signal.lfilter([0, f1*f1, 0], a, input_buffer, axis=0, zi=np.stack((low1, low2 + a[1]*low1)))[0]
+        bands = signal.lfilter([f1, -f1, 0], a, input_buffer, axis=0, zi=np.stack((band1, band2 + a[1]*band1)))[0]
+
+        if self.mode == 'lpf':
+            output_buffer[:] = lows
+        elif self.mode == 'bpf':
+            output_buffer[:] = bands
+        elif self.mode in ('hpf', 'notch'):
+            # high = input - low - q1*(previous band); notch = low + high.
+            previous = np.empty_like(bands)
+            previous[0] = band
+            previous[1:] = bands[:-1]
+            previous *= q1
+            np.subtract(input_buffer, previous, out=output_buffer)
+            if self.mode == 'hpf':
+                output_buffer -= lows
+        return np.array(bands[-1]), np.array(lows[-1])
+
+    # Up to this many filters (channels times bands), the recursion runs over plain floats one filter at a time,
+    # which is much faster than stepping small arrays of them.
+    SCALAR_FILTERS = 8
+
+    def _process_samples(self, input_buffer, output_buffer, f1, q1, gains, band, low):
+        # Coefficients are per-sample arrays (see SIGNAL_PARAMETERS), so run the recursion one frame at a time.
+        n = len(input_buffer)
+        f1s = np.broadcast_to(f1, (n,) + band.shape)
+        q1s = np.broadcast_to(q1, (n,) + band.shape)
+        single = band.shape[-1] == 1 and np.all(gains == 1)
+        if band.size <= self.SCALAR_FILTERS:
+            gains = np.broadcast_to(gains, band.shape)
+            total = None if single else np.zeros_like(input_buffer)
+            for j, k in np.ndindex(band.shape):
+                outputs, band[j, k], low[j, k] = self._recurse(input_buffer[:, j].tolist(), f1s[:, j, k].tolist(), q1s[:, j, k].tolist(), float(band[j, k]), float(low[j, k]))
+                if single:
+                    output_buffer[:, j] = outputs
+                else:
+                    total[:, j] += gains[j, k] * np.array(outputs)
+            if not single:
+                output_buffer[:] = total
+            return
+        # Many filters: step all the channels and bands at once.
+        mode = self.mode
+        inputs = input_buffer[..., None]
+        b, l = band, low
+        for i in range(n):
+            f1 = f1s[i]
+            l = l + f1 * b
+            high = inputs[i] - l - q1s[i]*b
+            b = b + f1 * high
+            if mode == 'lpf':
+                y = l
+            elif mode == 'bpf':
+                y = b
+            elif mode == 'hpf':
+                y = high
+            elif mode == 'notch':
+                y = l + high
+            output_buffer[i] = (y * gains).sum(-1)
+        band[...] = b
+        low[...] = l
+
+    def _recurse(self, inputs, f1s, q1s, band, low):
+        "Run one filter over lists of floats, returning (outputs, band, low)."
+        mode = self.mode
+        outputs = [0.0] * len(inputs)
+        for i in range(len(inputs)):
+            f1 = f1s[i]
+            low = low + f1 * band
+            high = inputs[i] - low - q1s[i]*band
+            band = band + f1 * high
 
             # TODO: If necessary, optimize by lifting the branch.
             if mode == 'lpf':
-                output_buffer[i] = low
+                outputs[i] = low
             elif mode == 'bpf':
-                output_buffer[i] = band
+                outputs[i] = band
             elif mode == 'hpf':
-                output_buffer[i] = high
+                outputs[i] = high
             elif mode == 'notch':
-                output_buffer[i] = low + high
-        self.band = band
-        self.low = low
+                outputs[i] = low + high
+        return outputs, band, low
+
+
+class StateVariableFilter(FilterBank):
+    """A single state variable filter: a `FilterBank` of one band.
+
+    Its coefficients may also be per-sample arrays (see SIGNAL_PARAMETERS) and per-channel ones (batch rendering)."""
+
+    PARAMETERS = ("resonance", "freq", "mode", "mix")
+    SIGNAL_PARAMETERS = ("resonance", "freq", "mix")
+    BATCH_PARAMETERS = ("resonance", "freq", "mix")
+    # Also the default for snapshots saved before the filter was a bank.
+    gains = 1
+
+    def __init__(self, sample_rate, freq, resonance, mode='lpf'):
+        assert (resonance >= 0.5)
+        super().__init__(sample_rate, freq, resonance, mode=mode)
+
+    @property
+    def freq(self):
+        return self._freq
+
+    @freq.setter
+    def freq(self, value):
+        self._freq = value
+        self.f1 = 2*np.sin(np.pi * value / self.sample_rate)
+
+    # The bank's band frequencies are this one frequency.
+    freqs = freq
+
+    def _axes(self, value):
+        # Parameter values follow `control`: 1-D arrays are per sample, not per band.
+        value = np.asarray(value, dtype=float)
+        return value.reshape(-1, 1, 1) if value.ndim <= 1 else value[..., None]
+
+    def _state(self, channels):
+        # Per-channel state, reset when the channel layout changes.
+        if np.shape(self.low) != channels:
+            self.band, self.low = np.zeros(channels), np.zeros(channels)
+        return self.band[..., None], self.low[..., None]
+
+    def frequency_response(self, points=2048):
+        """(Frequencies in Hz, magnitude, phase) at the current settings, from the filter's transfer function.
+
+        Automated parameters use their latest value; batched ones, the last variant's."""
+        b, a = _svf_transfer_function(current(self.f1), current(self.q1), self.mode)
+        return utility.frequency_response(b, a, self.sample_rate, points, current(self.mix))
+
+    def visualize_filter(self):
+        utility.plot_response(self.frequency_response(), "SVF Frequency Response")
 
 
 # Adapted from http://www.musicdsp.org/showone.php?id=24
 class MoogLPF(Module):
 
     PARAMETERS = ("resonance", "freq", "mix")
+    SIGNAL_PARAMETERS = ("resonance", "freq", "mix")
+    BATCH_PARAMETERS = ("resonance", "freq", "mix")
+    IN_PLACE = True
 
     def __init__(self, sample_rate, freq=10000, resonance=0.1):
         super().__init__(sample_rate)
@@ -78,20 +286,63 @@ class MoogLPF(Module):
         self.freq = freq
         self.resonance = resonance
 
+    def set_sample_rate(self, sample_rate):
+        super().set_sample_rate(sample_rate)
+        self._update()
+
+    def frequency_response(self, points=2048):
+        """(Frequencies in Hz, magnitude, phase) at the current settings, for small signals (i.e. without the clipper).
+
+        Automated parameters use their latest value; batched ones, the last variant's."""
+        b, a = _moog_transfer_function(float(self.sample_rate), current(self._freq), current(self._resonance))
+        return utility.frequency_response(b, a, self.sample_rate, points, current(self.mix))
+
     def visualize_filter(self):
-        # Create a clean copy with the same settings.
-        filter = MoogLPF(self.sample_rate, self._freq, self._resonance)
-        # Compute the impulse response
-        impulse = np.zeros(2048)
-        impulse[0] = 1
-        filter.process(impulse, impulse)
-        w, h = signal.freqz(impulse, worN=2048)
-        utility.plot_response(self.sample_rate, w, h, "MoogLPF Frequency Response")
+        utility.plot_response(self.frequency_response(), "MoogLPF Frequency Response")
     
     def process(self, input_buffer, output_buffer):
-        resonance, stage, delay, p, k, t1, t2 = self._resonance, self.stage, self.delay, self.p, self.k, self.t1, self.t2
+        # Per-channel state, reset when the channel layout changes.
+        if self.stage.shape[1:] != input_buffer.shape[1:]:
+            self.stage = np.zeros((4,) + input_buffer.shape[1:])
+            self.delay = np.zeros((4,) + input_buffer.shape[1:])
+        if input_buffer.shape[1:] not in ((), (1,)) and np.ndim(self.p) == 0 and np.ndim(self._resonance) == 0:
+            self._process_linear(input_buffer, output_buffer)
+        else:
+            self._process_samples(input_buffer, output_buffer)
+        flush(self.stage)
+        flush(self.delay)
+
+    def at_rest(self):
+        return not (self.stage.any() or self.delay.any())
+
+    def _process_linear(self, input_buffer, output_buffer):
+        # With fixed coefficients everything but the clipper is one linear map of (stage, delay), so each
+        # sample costs a handful of NumPy calls however many channels there are.
+        # (For mono, the plain-float loop in `_process_samples` is faster.)
+        transition, input_gain = self.transition, self.input_gain
+        state = np.concatenate((self.stage, self.delay))
+        inputs = np.multiply.outer(input_gain, input_buffer)
+        for i in range(len(input_buffer)):
+            state = transition @ state
+            state += inputs[:, i]
+            # Clipping band-limited sigmoid
+            state[3] -= state[3]*state[3]*state[3] / 6
+            output_buffer[i] = state[3]
+        self.stage, self.delay = state[:4], state[4:]
+
+    def _process_samples(self, input_buffer, output_buffer):
+        stage, delay = self.stage, self.delay
+        # Coefficients may be scalars, per-sample arrays (see SIGNAL_PARAMETERS) or per-channel arrays (batch rendering).
+        resonances = control(self._resonance, input_buffer.shape)
+        ps = control(self.p, input_buffer.shape)
+        ks = control(self.k, input_buffer.shape)
+        if input_buffer.shape[1:] == (1,):
+            # Mono: iterate over plain floats, which is much faster than over one-element rows.
+            input_buffer, output_buffer, stage, delay = input_buffer[:, 0], output_buffer[:, 0], stage[:, 0], delay[:, 0]
+            resonances, ps, ks = resonances[:, 0].tolist(), ps[:, 0].tolist(), ks[:, 0].tolist()
         for i, sample in enumerate(input_buffer):
-            x = sample - resonance * stage[3]
+            p, k = ps[i], ks[i]
+            x = sample - resonances[i] * stage[3]
 
             # Four cascaded one-pole filters (bilinear transform)
             stage[0] = x*p - k*stage[0]
@@ -133,3 +384,29 @@ class MoogLPF(Module):
         self.t1 = (1 - self.p) * 1.386249
         self.t2 = 12 + self.t1**2
         self.r = self._resonance * (self.t2 + 6.0 * self.t1) / (self.t2 - 6.0 * self.t1)
+        if np.ndim(self.p) == 0 and np.ndim(self._resonance) == 0:
+            # Columns of the linear part of one step (see `_step`), for `_process_linear`.
+            self.transition = np.stack([self._step(state, 0) for state in np.eye(8)], axis=1)
+            self.input_gain = self._step(np.zeros(8), 1)
+
+    def _step(self, state, sample):
+        "One step of the filter without the clipper, on (stage, delay) stacked into `state`."
+        p, k = self.p, self.k
+        x = sample - self._resonance * state[3]
+        stage = np.zeros(4)
+        stage[0] = x*p - k*state[0]
+        stage[1] = stage[0]*p - k*state[1]
+        stage[2] = stage[1]*p - k*state[2]
+        stage[3] = stage[2]*p - k*state[3]
+        stage += state[4:]*p
+        return np.concatenate((stage, [x], stage[:-1]))
+
+
+@functools.lru_cache(maxsize=256)
+def _moog_transfer_function(sample_rate, freq, resonance):
+    "Transfer function (b, a) of MoogLPF's linear part."
+    filter = MoogLPF(sample_rate, freq, resonance)
+    # In state-space form, with the previous (stage, delay) as the state: the output is stage[3] of the next one.
+    transition, input_gain = filter.transition, filter.input_gain
+    b, a = signal.ss2tf(transition, input_gain[:, None], transition[3:4], input_gain[3:4, None])
+    return b[0], a
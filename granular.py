@@ -1,25 +1,37 @@
 import math
-import random
 
 import numpy as np
 from scipy.io import wavfile
 
-from module import Module
+from cache import cache
+from module import Module, control
 
 
 class Granular(Module):
 
-    PARAMETERS = ("speed", "grain_size", "filename", "overlap", "mix")
+    PARAMETERS = ("speed", "grain_size", "filename", "overlap", "seed", "mix")
+    SLOW_PARAMETERS = ("grain_size", "filename", "overlap", "seed")
+    IN_PLACE = True
+    TRANSIENT = ("mono",)
 
-    def __init__(self, sample_rate, speed=1, filename="example.wav", grain_size=0.1):
+    def __init__(self, sample_rate, speed=1, filename="example.wav", grain_size=0.1, seed=None):
         super().__init__(sample_rate)
+        self._seed = seed
+        self.rng = np.random.default_rng(seed)
         self.time = 0
         self.speed = speed
         self._grain_size = 100
         self.filename = filename
         self.grain_size = grain_size
         self.overlap = False
+        self.mono = np.zeros(0)
     
+    def set_sample_rate(self, sample_rate):
+        # Grains are slices of the file at its own rate, so only the playback speed and grain lengths change.
+        self.wav_factor *= self.sample_rate / sample_rate
+        super().set_sample_rate(sample_rate)
+        self.grain()
+
     @property
     def grain_size(self):
         return self._grain_size
@@ -36,8 +48,9 @@ class Granular(Module):
     @filename.setter
     def filename(self, value):
         self._filename = value
-        fs, data = wavfile.read(value)
-        self.data = data[:, 0].astype(np.float) / np.iinfo(data.dtype).max
+        # Only the header is parsed here; the decoded samples are cached on disk by the file's contents.
+        fs, data = wavfile.read(value, mmap=True)
+        self.data = cache.cached(lambda: data[:, 0].astype(float) / np.iinfo(data.dtype).max, "wav", cache.file_hash(value))
         self.wav_factor = fs / self.sample_rate
         self.grain()
 
@@ -49,33 +62,80 @@ class Granular(Module):
     def overlap(self, value):
         self._overlap = value
         self.grain()
-        self.current_grain = random.choice(self.grains)
+        self.choose_grain()
 
-    def grain(self, overlap=False):
-        self.grains = []
+    @property
+    def seed(self):
+        return self._seed
+
+    @seed.setter
+    def seed(self, value):
+        # NOTE: The seed determines both the grain partition and the order grains are played in.
+        self._seed = value
+        self.rng = np.random.default_rng(value)
+        self.grain()
+        self.choose_grain()
+
+    def choose_grain(self):
+        self.current_grain = self.grains[self.rng.integers(len(self.grains))]
+
+    def _partition(self, overlap):
+        "Random (start, size) bounds of each grain."
+        # A generator of its own, so the playback sequence doesn't depend on whether the partition was cached.
+        rng = np.random.default_rng(self._seed)
+        bounds = []
         jump = 0
         while jump < len(self.data):
-            winSize = min(int(np.random.rand() * int(self._grain_size * self.sample_rate - 2)) + 2, len(self.data) - jump)
-            self.grains.append(self.data[jump:jump + winSize] * np.hanning(winSize))
+            winSize = min(int(rng.random() * int(self._grain_size * self.sample_rate - 2)) + 2, len(self.data) - jump)
+            bounds.append((jump, winSize))
             if overlap:
-                hopSize = int(np.random.rand() * winSize)
+                hopSize = int(rng.random() * winSize)
             else:
                 hopSize = winSize
             jump += hopSize
+        return np.array(bounds, dtype=np.int64).reshape(-1, 2)
+
+    def grain(self, overlap=False):
+        # NOTE: The partition is cached on disk with the windowed grains (concatenated), so the same file and
+        # settings give the same grains across sessions.
+        key = ("grains", cache.file_hash(self._filename), float(self._grain_size), float(self.sample_rate), overlap, self._seed)
+        bounds = cache.cached(lambda: self._partition(overlap), *key, "bounds")
+        samples = cache.cached(lambda: np.concatenate([self.data[start:start + size] * np.hanning(size) for start, size in bounds]), *key, "samples")
+        offsets = np.concatenate(([0], np.cumsum(bounds[:, 1])))
+        self.grains = [samples[offsets[i]:offsets[i + 1]] for i in range(len(bounds))]
+
+    def advance(self, n, channels):
+        # Step through the grains as `process` would, choosing the same ones, without reading them.
+        speed = self.speed * self.wav_factor
+        time = self.time
+        for _ in range(n):
+            if time < 0:
+                self.choose_grain()
+                time = len(self.current_grain) - 1.00001
+            elif time >= len(self.current_grain) - 1:
+                time = 0
+                self.choose_grain()
+            time += speed
+        self.time = time
 
     def process(self, input_buffer, output_buffer):
         speed = self.speed * self.wav_factor
         time = self.time
+        if len(self.mono) < len(output_buffer):
+            self.mono = np.zeros(len(output_buffer))
+        # Grains are mono; generate them once and copy to every channel at the end.
+        mono = self.mono[:len(output_buffer)]
         for i in range(len(output_buffer)):
             if time < 0:
-                self.current_grain = random.choice(self.grains)
+                self.choose_grain()
                 time = len(self.current_grain) - 1.00001
             elif time >= len(self.current_grain) - 1:
                 time = 0
-                self.current_grain = random.choice(self.grains)
+                self.choose_grain()
             index = math.floor(time)
             frac = time - index
             sample = (1-frac)*self.current_grain[index] + frac*self.current_grain[index+1]
-            output_buffer[i] = sample
+            mono[i] = sample
             time += speed
+        output_buffer[:] = control(mono, output_buffer.shape)
         self.time = time
\ No newline at end of file
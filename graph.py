@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import numpy as np
+
+from chain import Chain
+from module import Module, control
+
+
+_pool = None
+
+
+def thread_pool():
+    "Shared worker pool for parallel branches. (NumPy and SciPy kernels release the GIL.)"
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="graph")
+    return _pool
+
+
+def _forget_pool():
+    # A forked process (e.g. a segment render) inherits the pool but not its threads, so it starts a pool of its own.
+    global _pool
+    _pool = None
+
+
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+class Scheduler:
+    """Chooses serial or parallel execution of a Parallel node from measured block costs.
+
+    Costs are exponential moving averages of seconds per frame for each mode. The cheaper mode runs
+    most blocks, and the other is re-measured every `probe_interval` blocks, as costs change with the
+    parameters (e.g. pure Python loops hold the GIL and don't benefit from threads)."""
+
+    MODES = ("serial", "parallel")
+
+    def __init__(self, probe_interval=64, smoothing=0.1):
+        self.probe_interval = probe_interval
+        self.smoothing = smoothing
+        self.costs = dict.fromkeys(self.MODES)
+        self.blocks = 0
+
+    def choose(self):
+        self.blocks += 1
+        for mode, cost in self.costs.items():
+            if cost is None:
+                return mode
+        best, other = sorted(self.MODES, key=self.costs.get)
+        return other if self.blocks % self.probe_interval == 0 else best
+
+    def record(self, mode, n, elapsed):
+        cost = elapsed / n
+        previous = self.costs[mode]
+        self.costs[mode] = cost if previous is None else previous + self.smoothing * (cost - previous)
+
+
+class Parallel(Module):
+    """Split node: feeds the same input to several branches (each a Chain) and merges their outputs as a weighted sum.
+
+    `parallel` is "auto" (let the scheduler decide per block), True or False."""
+
+    PARAMETERS = ("gains", "parallel", "mix")
+    SIGNAL_PARAMETERS = ("mix",)
+    # The branches' modules are saved by the engine, by name.
+    TRANSIENT = ("branches", "scheduler")
+
+    def __init__(self, branches, gains=None, parallel="auto"):
+        super().__init__(None)  # NOTE: Sample rate is irrelevant for this module; the branches have their own.
+        self.branches = [branch if isinstance(branch, Chain) else Chain([branch]) for branch in branches]
+        self.gains = [1] * len(self.branches) if gains is None else gains
+        self.parallel = parallel
+        self.scheduler = Scheduler()
+
+    def allocate(self, shape):
+        for branch in self.branches:
+            branch.allocate(shape)
+
+    def weights(self):
+        "Merge gain for each branch."
+        return self.gains
+
+    def advance(self, n, channels):
+        for branch, gain in zip(self.branches, self.weights()):
+            if np.ndim(gain) or gain != 0:
+                branch.advance(n, channels, external=True)
+
+    def process(self, input_buffer, output_buffer):
+        n = len(input_buffer)
+        # Branches merged with zero gain are not run at all.
+        active = [(branch, gain) for branch, gain in zip(self.branches, self.weights()) if np.ndim(gain) or gain != 0]
+        if not active:
+            output_buffer[:] = 0
+            return
+        mode = self.parallel
+        if mode == "auto":
+            mode = self.scheduler.choose() if len(active) > 1 else "serial"
+        elif mode:
+            mode = "parallel"
+        else:
+            mode = "serial"
+        start = time.perf_counter()
+        if mode == "parallel":
+            pool = thread_pool()
+            futures = [pool.submit(branch.process, n, input_buffer) for branch, _ in active]
+            results = [future.result() for future in futures]
+        else:
+            results = [branch.process(n, input_buffer) for branch, _ in active]
+        self.scheduler.record(mode, n, time.perf_counter() - start)
+        # Merge.
+        for i, (result, (_, gain)) in enumerate(zip(results, active)):
+            if i == 0:
+                np.multiply(result, control(gain, output_buffer.shape), out=output_buffer)
+            elif np.ndim(gain) == 0 and gain == 1:
+                output_buffer += result
+            else:
+                output_buffer += result * control(gain, output_buffer.shape)
+
+
+class Crossfade(Parallel):
+    "Merge two sources, `mix` moving from only the first (0) to only the second (1)."
+
+    PARAMETERS = ("mix", "parallel")
+    # `mix` balances the two branches; it is not a dry/wet crossfade with the input.
+    DRY_WET = False
+
+    def __init__(self, a, b, mix=0.5, parallel="auto"):
+        super().__init__([a, b], parallel=parallel)
+        self.mix = mix
+
+    def weights(self):
+        return [1 - self.mix, self.mix]
@@ -0,0 +1,180 @@
+import numpy as np
+
+from module import Module, interpolate
+
+
+TABLE_SIZE = 4096
+# Frames between the points where smooth waveforms are evaluated; the samples in between are interpolated.
+CONTROL_INTERVAL = 32
+
+
+def _make_tables():
+    phases = np.arange(TABLE_SIZE + 1) / TABLE_SIZE
+    tables = {
+        "triangle": 1 - 4*np.abs(((phases + 0.25) % 1) - 0.5),
+        "square": np.where(phases % 1 < 0.5, 1.0, -1.0),
+    }
+    # Store (value, slope) pairs so a lookup is one take for each plus a multiply-add.
+    return {name: (table[:-1].copy(), np.diff(table)) for name, table in tables.items()}
+
+
+TABLES = _make_tables()
+
+
+class LFO(Module):
+    "Low-frequency oscillator with a wrapped phase accumulator, table-based waveforms and optional tempo sync."
+
+    PARAMETERS = ("rate", "waveform", "spread", "bpm", "beats", "seed", "control_interval")
+    SIGNAL_PARAMETERS = ("rate",)
+    BATCH_PARAMETERS = ("rate", "spread")
+    TRANSIENT = ("ramp", "phases", "indices", "scratch", "buffer", "points")
+    WAVEFORMS = ("sine", "triangle", "square", "sample_hold")
+    # Waveforms computed with transcendentals, which run at control rate. (Interpolating between points would round
+    # the corners of the table-based waveforms, and save little.)
+    SMOOTH = ("sine",)
+
+    def __init__(self, sample_rate, rate=1, waveform="sine", phase=0, seed=None):
+        super().__init__(sample_rate)
+        self.rate = rate
+        self.waveform = waveform
+        # Tempo sync: if `beats` is set, one cycle lasts that many beats at `bpm`, overriding `rate`.
+        self.bpm = 120
+        self.beats = None
+        # Phase is measured in cycles and kept in [0, 1), so precision does not degrade over long sessions.
+        self.phase = phase
+        # Phase offset (in cycles) between adjacent channels, for stereo modulation.
+        # (Or a (1, channels) array of per-channel offsets, e.g. for batch rendering.)
+        self.spread = 0
+        self.seed = seed
+        # Smooth waveforms at fixed rates are evaluated every `control_interval` frames (1 for every frame).
+        self.control_interval = CONTROL_INTERVAL
+        self._allocate(0, 1)
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @seed.setter
+    def seed(self, value):
+        # Sample & hold values are drawn from this generator.
+        self._seed = value
+        self.rng = np.random.default_rng(value)
+        self.held = self.rng.uniform(-1, 1)
+
+    @property
+    def waveform(self):
+        return self._waveform
+
+    @waveform.setter
+    def waveform(self, value):
+        if value not in self.WAVEFORMS:
+            raise ValueError(f"Unknown waveform '{value}' (options: {', '.join(self.WAVEFORMS)}).")
+        self._waveform = value
+
+    @property
+    def control_interval(self):
+        return self._control_interval
+
+    @control_interval.setter
+    def control_interval(self, value):
+        # Integral floats (e.g. from OSC or JSON) are accepted.
+        if (isinstance(value, bool) or not isinstance(value, (int, float, np.integer, np.floating))
+                or not np.isfinite(value) or value != int(value) or value < 1):
+            raise ValueError(f"Invalid control interval {value!r} (must be a whole number of frames, at least 1).")
+        self._control_interval = int(value)
+
+    def _allocate(self, n, channels):
+        self.ramp = np.arange(n, dtype=float)[:, None]
+        self.phases = np.zeros((n, channels))
+        self.indices = np.zeros((n, channels), dtype=np.intp)
+        self.scratch = np.zeros((n, channels))
+        self.buffer = np.zeros((n, channels))
+        self.points = np.zeros((n, channels))
+
+    def frequency(self):
+        "Effective rate in Hz (scalar or per-sample array)."
+        if self.beats:
+            return self.bpm / 60 / self.beats
+        return self.rate
+
+    def advance(self, n, channels=None):
+        "Move the phase forward by `n` samples without generating output."
+        frequency = self.frequency()
+        increment = (np.sum(frequency[:n]) if np.ndim(frequency) == 1 else n * frequency) / self.sample_rate
+        if self._waveform == "sample_hold":
+            # One draw per cycle boundary crossed, as in `process`, so the generator stays in step.
+            wraps = int(self.phase + increment)
+            if wraps:
+                self.held = self.rng.uniform(-1, 1, wraps)[-1]
+        self.phase = (self.phase + increment) % 1
+
+    def process(self, n, channels=()):
+        """Return the next `n` samples in [-1, 1]. The result is an internal buffer, valid until the next call.
+
+        The result has shape (n,), or (n, channels) if `spread` is set or the rate is per-channel, and a channel shape is given."""
+        points, interval = self.control_points(n, channels)
+        if interval == 1:
+            return points
+        out = self.buffer[:n] if points.ndim > 1 else self.buffer[:n, 0]
+        return interpolate(points, interval, out)
+
+    def control_points(self, n, channels=()):
+        """Return (values, interval): the waveform every `interval` frames over the next `n` samples, from the first frame
+        up to the first at or after the end (see `module.interpolate`). The values are in an internal buffer.
+
+        The interval is `control_interval` for smooth waveforms at a fixed rate, and 1 (every frame) otherwise."""
+        frequency = self.frequency()
+        # Per-channel rates (a (1, channels) array) or phase offsets need one column per channel.
+        per_channel = np.ndim(frequency) == 2 or np.any(self.spread)
+        if np.ndim(frequency) == 2 and self._waveform == "sample_hold":
+            raise ValueError("Per-channel rates are not supported for the sample_hold waveform.")
+        channels = channels[0] if per_channel and channels and self._waveform != "sample_hold" else 1
+        if len(self.buffer) < n or self.buffer.shape[1] != channels:
+            self._allocate(n, channels)
+        if np.ndim(self.phase) and np.shape(self.phase)[-1] != channels:
+            # Per-channel phases from a different channel layout.
+            self.phase = float(np.ravel(self.phase)[0])
+        interval = self.control_interval if self._waveform in self.SMOOTH and np.ndim(frequency) != 1 and n > 1 else 1
+        # (With an interval, `process` interpolates the points into the buffer.)
+        m = n if interval == 1 else -(-n // interval) + 1
+        phases, indices, scratch = self.phases[:m], self.indices[:m], self.scratch[:m]
+        out = self.buffer[:m] if interval == 1 else self.points[:m]
+        if np.ndim(frequency) != 1:
+            np.multiply(self.ramp[:m], interval * frequency / self.sample_rate, out=phases)
+            next_phase = self.phase + n * frequency / self.sample_rate
+        else:
+            # Per-sample rate: accumulate the increments.
+            np.cumsum(frequency[:n], out=phases[:, 0])
+            phases[:, 0] /= self.sample_rate
+            next_phase = self.phase + phases[-1, 0]
+            phases[:, 0] -= phases[0, 0]
+            phases[:] = phases[:, :1]
+        phases += self.phase
+        if channels > 1:
+            phases += self.spread if np.ndim(self.spread) else np.arange(channels) * self.spread
+
+        if self._waveform == "sample_hold":
+            # Hold a new random value each time the (unwrapped) phase crosses a cycle boundary.
+            np.copyto(indices, phases, casting='unsafe')
+            wraps = int(next_phase)
+            held = np.empty(wraps + 1)
+            held[0] = self.held
+            held[1:] = self.rng.uniform(-1, 1, wraps)
+            np.take(held, indices, out=out)
+            self.held = held[-1]
+        elif self._waveform == "sine":
+            # NOTE: NumPy's vectorized sin is cheaper than a table lookup with interpolation.
+            phases *= 2*np.pi
+            np.sin(phases, out=out)
+        else:
+            values, slopes = TABLES[self._waveform]
+            np.remainder(phases, 1, out=phases)
+            phases *= TABLE_SIZE
+            np.copyto(indices, phases, casting='unsafe')
+            phases -= indices
+            np.take(values, indices, out=out)
+            np.take(slopes, indices, out=scratch)
+            scratch *= phases
+            out += scratch
+        self.phase = next_phase % 1
+        return (out if channels > 1 else out[:, 0]), interval
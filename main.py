@@ -1,63 +1,134 @@
 import ast
+from concurrent.futures import ProcessPoolExecutor
 import os
 import readline
+import shutil
+import threading
 import time
 import wave
 
 import mido
 import numpy as np
-import sounddevice as sd
+try:
+    import sounddevice as sd
+except (ImportError, OSError):
+    # No PortAudio (e.g. on a headless machine): only the PCM and virtual outputs work.
+    sd = None
 
+from automation import Automation
+from cache import cache, renders
+from chain import Chain
+from console import Console
 from convolution import ConvolutionFilter
 from delay import Delay
 from envelope import Envelope
-from filter import MoogLPF
+from filter import FilterBank, MoogLPF
+from graph import Crossfade
 from granular import Granular
 from example_module import ExampleModule
 from midi import MIDISource
 from module import Module
+from osc import OSCControl
+from pcm import PCMSink, PCMStream, StreamError
+from quality import QualityGovernor
 from quantize import Quantizer
-from resample import CubicResampler as Resampler
+from resample import CubicResampler as Resampler, IdentityResampler
+import state
 from subtractive import SubtractiveSynth
 from tremolo import Tremolo
+import utility
+from virtual import VirtualStream, inject, load_script
 from wah import AutoWah
 
 
 INTERNAL_SAMPLERATE = 48000
+# Errors opening a stream, from the stand-in streams or from PortAudio.
+STREAM_ERRORS = (StreamError,) if sd is None else (StreamError, sd.PortAudioError)
+NO_DEVICES = "Audio devices need sounddevice and the PortAudio library (without them, use 'start virtual' or 'pcm start')."
 
 
-# One-off module to combine our two synth sources.
-class Mixer(Module):
-    def __init__(self, a, b, mix=0.5):
-        self.a = a
-        self.b = b
-        self.mix = mix
-    
-    def process(self, input_buffer, output_buffer):
-        # NOTE: Overwrites input_buffer.
-        self.a.process(input_buffer, input_buffer)
-        self.b.process(input_buffer, output_buffer)
-        input_buffer *= (1 - self.mix)
-        output_buffer *= self.mix
-        output_buffer += input_buffer
+def render_segment(engine, start, blocks, remainder, preroll, head, tail):
+    """Render `blocks` blocks (plus `remainder` frames) starting at block `start`, in a worker process.
+
+    `engine` is a copy of the engine at the start of the render. Time-dependent state (phases, generators) is
+    advanced to `preroll` blocks before `start`, and rendering the pre-roll warms up the rest (filters, delay lines).
+    Returns the PCM bytes, plus the first `head` blocks and the `tail` blocks after the segment before quantization,
+    for measuring the seams between segments."""
+    blocksize, channels = engine._blocksize, engine._channels
+    preroll = min(preroll, start)
+    engine.advance(start - preroll)
+    outdata = np.zeros((blocksize, channels))
+    for _ in range(preroll):
+        engine.synthesize(outdata)
+        engine.quantizer.advance(blocksize, channels)
+    sample_width = engine.quantizer.sample_width
+    chunks, heads, tails = [], [], []
+    for block in range(blocks):
+        engine.synthesize(outdata)
+        if block < head:
+            heads.append(outdata.copy())
+        chunks.append(engine.quantizer.encode(outdata, sample_width).tobytes())
+    if remainder:
+        engine.synthesize(outdata[:remainder])
+        chunks.append(engine.quantizer.encode(outdata[:remainder], sample_width).tobytes())
+    for _ in range(tail):
+        engine.synthesize(outdata)
+        tails.append(outdata.copy())
+    return b"".join(chunks), np.concatenate(heads or [outdata[:0]]), np.concatenate(tails or [outdata[:0]])
+
+
+def midi_events(filename):
+    "(time in seconds, note, velocity) for each note-on in a MIDI file."
+    events, time = [], 0
+    for message in mido.MidiFile(filename):
+        time += message.time
+        if not message.is_meta and message.type == 'note_on':
+            events.append((time, message.note, message.velocity))
+    return events
 
 
 class SynthEngine:
-    PARAMETERS = ("gain", "samplerate")
+    PARAMETERS = ("gain", "samplerate", "native", "channels", "preroll", "seed")
+    # These restart the stream or rebuild modules (see `Module.SLOW_PARAMETERS`).
+    SLOW_PARAMETERS = ("native", "channels", "seed")
+    # Seconds faded out and back in when the stream switches over to a new sample rate or block size.
+    SWAP_FADE = 0.005
 
     def __init__(self):
         self.device = None
         self.stream = None
         self.recording_out = None
+        # Resampler for a recording that kept its sample rate when the stream's changed (see `reconfigure`).
+        self.recording_resampler = None
+        # Pending switch to a new sample rate or block size, made by the audio callback.
+        self.swap = None
+        self.swap_lock = threading.Lock()
+        self.fade_in = False
+        self.audio_thread = None
+        # Raw PCM output, used instead of the audio device while set (see `start_pcm`).
+        self.pcm = None
+        self.pcm_realtime = True
+        # Control events still to be played into the simulated device (`start virtual`), as (seconds, address, values).
+        self.virtual_script = []
         self.midi = None
         self.osc = None
+        self.osc_control = OSCControl(self)
+        # Prompt for a line of input (replaced by the console, which must not block).
+        self.ask = input
+        # The rate the modules run at: INTERNAL_SAMPLERATE, or in native mode, the external rate (see `native`).
+        self.internal_samplerate = INTERNAL_SAMPLERATE
+        self._native = False
+        self.automation = Automation(INTERNAL_SAMPLERATE, self.resolve_param)
         self.quantizer = Quantizer()
         self.envelope = Envelope(INTERNAL_SAMPLERATE)
         self.subtractive = SubtractiveSynth(INTERNAL_SAMPLERATE)
         granular = Granular(INTERNAL_SAMPLERATE)
-        mixer = Mixer(self.subtractive, granular, 0)
+        # The two synth sources are parallel branches of the graph, merged with a crossfade.
+        mixer = Crossfade(self.subtractive, granular, 0)
         moog = MoogLPF(INTERNAL_SAMPLERATE)
         convfilter = ConvolutionFilter(INTERNAL_SAMPLERATE)
+        # Octave bands, each at about unit gain at its center (the band output peaks at the resonance).
+        bank = FilterBank(INTERNAL_SAMPLERATE, [62.5 * 2**k for k in range(7)], 1.5, [1/1.5] * 7)
         autowah = AutoWah(INTERNAL_SAMPLERATE, (100, 2000), 0.5, 0.5)
         tremolo = Tremolo(INTERNAL_SAMPLERATE)
         delay = Delay(INTERNAL_SAMPLERATE)
@@ -65,6 +136,7 @@ class SynthEngine:
             "subtractive": self.subtractive,
             "moog": moog,
             "convfilter": convfilter,
+            "bank": bank,
             "envelope": self.envelope,
             "autowah": autowah,
             "delay": delay,
@@ -77,32 +149,316 @@ class SynthEngine:
         # Disable most modules by default:
         moog.mix = 0
         convfilter.mix = 0
+        bank.mix = 0
         autowah.mix = 0
         delay.mix = 0
         tremolo.mix = 0
         # Disable envelope by default, until a MIDI source is specified.
         self.envelope.mix = 0
         # NOTE: Chain implicity ends with resampler, quantizer.
-        self.chain = [mixer, moog, convfilter, self.envelope, autowah, tremolo, delay]
+        self.chain = Chain([mixer, moog, convfilter, bank, self.envelope, autowah, tremolo, delay])
         self._blocksize = 2048
+        self._channels = 1
         self.samplerate = 44100
         self.gain = 1
+        # Warm-up (in seconds) before each segment of a parallel render.
+        self.preroll = 2.0
+        self._seed = None
+        self.quality = QualityGovernor(self)
+
+    def __getstate__(self):
+        # Devices, ports and servers stay with the live engine; copies (e.g. for parallel rendering) are offline.
+        state = self.__dict__.copy()
+        state.update(stream=None, recording_out=None, recording_resampler=None, swap=None, swap_lock=None,
+                     audio_thread=None, pcm=None, midi=None, osc=None, ask=input)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.swap_lock = threading.Lock()
+
+    def confirm_overwrite(self, filenames):
+        "Ask before overwriting any of `filenames` that exist."
+        existing = [filename for filename in filenames if os.path.exists(filename)]
+        if not existing:
+            return True
+        if len(existing) == 1:
+            question = f"File '{existing[0]}' already exists. Overwrite? [y/N] "
+        else:
+            question = f"Files {', '.join(existing)} already exist. Overwrite? [y/N] "
+        if not self.ask(question).lower().startswith('y'):
+            print("Not overwriting.")
+            return False
+        return True
 
     def process(self, outdata, *ignored):
+        buf = self.synthesize(outdata)
+        if self.recording_out and self.recording_resampler:
+            # The recording kept its sample rate when the stream's changed, so it is resampled separately.
+            frames = self.recording_resampler.resample(buf)
+            self.recording_out.writeframes(self.quantizer.encode(frames, self.recording_out.getsampwidth()))
+        elif self.recording_out:
+            # Quantize once, straight to PCM for the file and to floats for the device.
+            self.recording_out.writeframes(self.quantizer.encode(outdata, self.recording_out.getsampwidth(), outdata))
+            return
+        self.quantizer.process(outdata, outdata)
+
+    def stream_callback(self, stream, outdata):
+        "Audio callback of `stream`. Only the active stream runs the engine; others (opened ahead of a swap, or closing) play silence."
+        self.audio_thread = threading.current_thread()
+        if stream is not self.stream:
+            outdata.fill(0)
+            return
+        start = time.perf_counter()
+        self.process(outdata)
+        self.quality.record(time.perf_counter() - start, len(outdata) / self.external_samplerate)
+        fade = min(len(outdata), int(self.SWAP_FADE * self.external_samplerate))
+        if self.fade_in:
+            self.fade_in = False
+            outdata[:fade] *= np.linspace(0, 1, fade, endpoint=False)[:, None]
+        swap = self.swap
+        if swap is not None:
+            # This was the last block of this stream; the next one runs with the new settings.
+            outdata[len(outdata) - fade:] *= np.linspace(1, 0, fade, endpoint=False)[:, None]
+            self._commit_swap(swap)
+
+    def synthesize(self, outdata):
+        "Run the chain and resample into `outdata`, before quantization. Returns the block at the internal rate."
         internal_blocksize = self.resampler.get_source_blocksize(len(outdata))
-        buf = self.buffer[:internal_blocksize]
-        scratch_buf = self.scratch_buffer[:internal_blocksize]
-        buf[:] = 0
-        for module in self.chain:
-            module.process(buf, scratch_buf)
-            scratch_buf *= module.mix
-            buf *= (1 - module.mix)
-            buf += scratch_buf
-        buf *= self.gain
+        self.chain.input(internal_blocksize)[:] = 0
+        # Control updates land at block boundaries, before automation runs.
+        self.osc_control.apply()
+        self.automation.process(internal_blocksize)
+        buf = self.chain.process(internal_blocksize)
+        if self.gain != 1:
+            buf *= self.gain
         self.resampler.process(buf, outdata)
-        self.quantizer.process(outdata, outdata)
-        if self.recording_out:
-            self.recording_out.writeframes((outdata * np.iinfo(np.int16).max).astype(np.int16))
+        return buf
+
+    def setup_wave(self, w, channels):
+        w.setnchannels(channels)
+        # NOTE: Wave files can only store bit depths in multiples of 8, so lower depths are stored in the
+        # smallest container that fits (16 or 24-bit).
+        w.setsampwidth(self.quantizer.sample_width)
+        w.setframerate(self.external_samplerate)
+
+    def render_blocks(self, duration, events=(), progress=None):
+        """Synthesize `duration` seconds block by block (printing progress), yielding each block before quantization.
+
+        `events` are (time in seconds, note, velocity) MIDI notes, applied at the start of the block they fall in.
+        If `progress` is given, it is called with the fraction rendered after each block instead of printing."""
+        # Convert duration to samples.
+        duration = int(duration * self.external_samplerate)
+        blocksize = self._blocksize
+        outdata = np.zeros((blocksize, self._channels))
+        events = iter(sorted(events))
+        event = next(events, None)
+        for block in range(duration // blocksize + 1):
+            end = min((block + 1) * blocksize, duration)
+            while event and event[0] * self.external_samplerate < end:
+                self.handle_midi(*event[1:])
+                event = next(events, None)
+            if block == duration // blocksize:
+                break
+            self.synthesize(outdata)
+            yield outdata
+            if progress:
+                progress((block + 1) * blocksize / duration)
+                continue
+            p = int(block * blocksize / duration * 50)
+            bar = '=' * p + ' ' * (50 - p)
+            print(f"{block * blocksize / duration * 100:6.2f}% [{bar}] {block * blocksize / self.external_samplerate:6.2f}/{duration / self.external_samplerate:.2f}", end='\r')
+        # Last block:
+        remainder = duration % blocksize
+        if remainder:
+            outdata = outdata[:remainder]
+            self.synthesize(outdata)
+            yield outdata
+        if progress:
+            progress(1)
+            return
+        rendered_time = duration / self.external_samplerate
+        print(f"{100:6.2f}% [{'=' * 50}] {rendered_time:6.2f}/{rendered_time:.2f}")
+
+    def render_key(self, duration, jobs, midi_file):
+        "Hash of everything a render depends on: the engine state (parameters, DSP state, generators), the duration and the MIDI input."
+        frames = int(duration * self.external_samplerate)
+        midi_hash = cache.file_hash(midi_file) if midi_file else None
+        # Parallel renders can differ from serial ones at segment seams, and advance the live engine differently.
+        return renders.key(state.pack(self.get_state()), frames, jobs > 1, midi_hash)
+
+    def render_file(self, filename, duration, jobs=1, midi_file=None, progress=None):
+        """Render `duration` seconds to a wave file, or copy a cached render of the same engine state and inputs.
+
+        Returns whether the render came from the cache. `progress` is as in `render_blocks` (serial renders only)."""
+        events = midi_events(midi_file) if midi_file else ()
+        if events and jobs > 1:
+            print("Parallel rendering doesn't support MIDI input; rendering serially.")
+            jobs = 1
+        key = None
+        if renders.enabled:
+            if self.automation.active():
+                # Automation isn't part of the engine state, so it can't be part of the key.
+                print("Automation is active; not using the render cache.")
+            else:
+                key = self.render_key(duration, jobs, midi_file)
+        start_time = time.time()
+        entry = key and renders.lookup(key)
+        if entry:
+            wav, snapshot = entry
+            shutil.copyfile(wav, filename)
+            # Leave the engine where the cached render left it. (Settled, smoothed parameters stay smoothed.)
+            parameters = dict(self.automation.parameters)
+            self.set_state(state.load(snapshot))
+            self.automation.parameters.update(parameters)
+            print(f"Copied a cached render of {duration:.2f}s to '{filename}' in {time.time() - start_time:.2f}s.")
+            return True
+        if events:
+            self.envelope.mix = 1
+        with wave.open(filename, 'wb') as w:
+            self.setup_wave(w, self._channels)
+            if jobs > 1:
+                deviation = self.render_parallel(duration, w, jobs)
+                if deviation:
+                    print(f"Largest deviation from a serial render at segment boundaries: {deviation:.3g} ({20*np.log10(deviation):.1f} dBFS).")
+                else:
+                    print("Segment boundaries match a serial render exactly.")
+            else:
+                for outdata in self.render_blocks(duration, events, progress):
+                    # NOTE: (frames, channels) arrays are C-contiguous, so their bytes are already interleaved.
+                    w.writeframes(self.quantizer.encode(outdata, w.getsampwidth()))
+        if events and not self.midi:
+            self.envelope.mix = 0
+        real_time = time.time() - start_time
+        print(f"Rendered {duration:.2f}s to '{filename}' in {real_time:.2f}s ({duration/real_time:.2f}x).")
+        if key:
+            renders.store(key, filename, self.get_state())
+        return False
+
+    def render_sweep(self, param_spec, values, duration, prefix):
+        """Render one file per value of a parameter, in a single pass.
+
+        The variants are folded into the channel axis: parameters become (1, variants * channels) arrays and every
+        module processes all variants at once, so K variants cost far less than K renders. Each variant is dithered
+        from its own copy of the quantizer's generator, as its separate render would be. (Noise sources draw across
+        all variants at once, so with noise the variants differ from separate renders.)"""
+        try:
+            container, param = self.resolve_param(param_spec)
+        except (KeyError, AttributeError) as e:
+            print(f"No such parameter '{param_spec}' ({e}).")
+            return
+        if not hasattr(container, "set_batch"):
+            print(f"Parameter '{param_spec}' can't be swept.")
+            return
+        filenames = [f"{prefix}_{value}.wav" for value in values]
+        if not self.confirm_overwrite(filenames):
+            return
+        if self.stop_stream():
+            print("Stopping the stream to render to file. (Restart with 'start'.)")
+        channels = self._channels
+        original = getattr(container, param)
+        # Automation would overwrite the batched values.
+        self.automation.parameters.pop(param_spec, None)
+        try:
+            container.set_batch(param, values, channels)
+        except ValueError as e:
+            print(e)
+            return
+        quantizer_state = self.quantizer.get_state()
+        quantizers = [Quantizer() for _ in values]
+        for quantizer in quantizers:
+            quantizer.set_state(quantizer_state)
+        writers = [wave.open(filename, 'wb') for filename in filenames]
+        # Widen the layout directly (as `set_state` does), without a full `setup`. The sweep runs on a resampler
+        # that carries on from the engine's, with its history repeated for each variant, and the engine's own
+        # resampler is put back afterwards.
+        resampler = self.resampler
+        sweep_resampler = resampler.convert(type(resampler))
+        if sweep_resampler.last_samples.ndim == 2:
+            sweep_resampler.last_samples = np.tile(sweep_resampler.last_samples, len(values))
+        self._channels = len(values) * channels
+        self.resampler = self.modules["resampler"] = sweep_resampler
+        self.chain.allocate(sweep_resampler.make_source_buffer(self._blocksize, self._channels).shape)
+        try:
+            for w in writers:
+                self.setup_wave(w, channels)
+            start_time = time.time()
+            for outdata in self.render_blocks(duration):
+                for k, (quantizer, w) in enumerate(zip(quantizers, writers)):
+                    w.writeframes(quantizer.encode(outdata[:, k*channels:(k + 1)*channels], w.getsampwidth()))
+            real_time = time.time() - start_time
+            print(f"Rendered {len(values)} x {duration:.2f}s to {', '.join(filenames)} in {real_time:.2f}s ({len(values)*duration/real_time:.2f}x).")
+        finally:
+            for w in writers:
+                w.close()
+            setattr(container, param, original)
+            self._channels = channels
+            self.resampler = self.modules["resampler"] = resampler
+            self.chain.allocate(resampler.make_source_buffer(self._blocksize, channels).shape)
+
+    def get_state(self):
+        "Snapshot of the engine settings and every module's parameters and DSP state (see `Module.get_state`)."
+        return {
+            "engine": {name: getattr(self, name) for name in ("gain", "external_samplerate", "_native", "_blocksize", "_channels", "preroll", "_seed")},
+            "modules": {name: module.get_state() for name, module in self.modules.items() if module is not self},
+        }
+
+    def set_state(self, snapshot):
+        "Restore a `get_state` snapshot without running any module setters."
+        settings = dict({"_native": False}, **snapshot["engine"])
+        layout = ("external_samplerate", "_native", "_blocksize", "_channels")
+        changed = any(settings[name] != getattr(self, name) for name in layout)
+        restart = changed and self.stop_stream()
+        self.__dict__.update(settings)
+        if changed:
+            self.setup()
+        # Automation would overwrite the restored values.
+        self.automation.parameters.clear()
+        for name, module_state in snapshot["modules"].items():
+            self.modules[name].set_state(module_state)
+        self.osc_control.invalidate()
+        if restart:
+            self.start_stream()
+
+    def advance(self, blocks):
+        "Skip `blocks` output blocks without rendering them, moving only time-dependent state (see `Module.advance`)."
+        for _ in range(blocks):
+            internal_blocksize = self.resampler.advance_block(self._blocksize)
+            self.automation.process(internal_blocksize)
+            self.chain.advance(internal_blocksize, self._channels)
+            self.quantizer.advance(self._blocksize, self._channels)
+
+    def render_parallel(self, duration, w, jobs):
+        """Render `duration` seconds to the wave file `w` in segments, on `jobs` processes.
+
+        Segments are stitched together in order. Each worker also renders a little past the end of its segment,
+        which is compared to the start of the next one to report how far the seams deviate from a serial render."""
+        frames = int(duration * self.external_samplerate)
+        blocks, remainder = divmod(frames, self._blocksize)
+        block_duration = self._blocksize / self.external_samplerate
+        preroll = int(np.ceil(self.preroll / block_duration))
+        overlap = 2
+        # Use segments of at most a minute, so finished segments are written (and freed) as the render goes.
+        count = min(max(jobs, int(np.ceil(blocks * block_duration / 60))), blocks)
+        bounds = np.linspace(0, blocks, count + 1).astype(int)
+        deviation = 0
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = [pool.submit(render_segment, self, start, end - start, remainder if i == count - 1 else 0,
+                                   preroll, overlap if i else 0, overlap if i < count - 1 else 0)
+                       for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+            tail = None
+            for i, future in enumerate(futures):
+                pcm, head, next_tail = future.result()
+                w.writeframes(pcm)
+                if tail is not None:
+                    deviation = max(deviation, np.max(np.abs(head - tail[:len(head)]), initial=0))
+                tail = next_tail
+                p = int((i + 1) / count * 50)
+                print(f"{(i + 1) / count * 100:6.2f}% [{'=' * p}{' ' * (50 - p)}] segment {i + 1}/{count}", end='\r')
+        print()
+        # Move the live engine's phases and generators past the render, as a serial render would have.
+        self.advance(blocks)
+        return deviation
 
     def handle_midi(self, pitch, velocity):
         self.subtractive.freq = 2**((pitch-69)/12)*440
@@ -114,6 +470,9 @@ class SynthEngine:
     
     @samplerate.setter
     def samplerate(self, value):
+        if self.stream:
+            self.reconfigure(samplerate=value)
+            return
         restart = self.stop_stream()
         if restart:
             print("Stopping the stream to change the sample rate. (This will interrupt recording.)")
@@ -123,12 +482,54 @@ class SynthEngine:
             print("Restarting stream.")
             self.start_stream()
     
+    @property
+    def native(self):
+        return self._native
+
+    @native.setter
+    def native(self, value):
+        "In native mode, the modules run at the external sample rate (rebuilt whenever it changes) and nothing is resampled."
+        value = bool(value)
+        if value == self._native:
+            return
+        restart = self.stop_stream()
+        if restart:
+            print("Stopping the stream to change the internal sample rate. (This will interrupt recording.)")
+        self._native = value
+        self.setup()
+        if restart:
+            print("Restarting stream.")
+            self.start_stream()
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @seed.setter
+    def seed(self, value):
+        "Seed every random source (noise, grains, sample & hold LFOs, dither), so renders are repeatable."
+        self._seed = value
+
+        def visit(module):
+            for name in module.PARAMETERS:
+                if name == "seed":
+                    module.seed = value
+                elif isinstance(getattr(module, name), Module):
+                    visit(getattr(module, name))
+
+        for module in self.modules.values():
+            if module is not self:
+                visit(module)
+
     @property
     def blocksize(self):
         return self._blocksize
     
     @blocksize.setter
     def blocksize(self, value):
+        if self.stream:
+            self.reconfigure(blocksize=value)
+            return
         restart = self.stop_stream()
         if restart:
             print("Stopping the stream to change the block size. (This will interrupt recording.)")
@@ -138,12 +539,148 @@ class SynthEngine:
             print("Restarting stream.")
             self.start_stream()
 
+    @property
+    def channels(self):
+        return self._channels
+
+    @channels.setter
+    def channels(self, value):
+        restart = self.stop_stream()
+        if restart:
+            print("Stopping the stream to change the number of channels. (This will interrupt recording.)")
+        self._channels = value
+        self.setup()
+        if restart:
+            print("Restarting stream.")
+            self.start_stream()
+
+    def internal_rate(self, samplerate):
+        "The internal sample rate that goes with the external `samplerate`."
+        return samplerate if self._native else INTERNAL_SAMPLERATE
+
+    def make_resampler(self, internal, external):
+        return IdentityResampler(internal, external) if internal == external else Resampler(internal, external)
+
+    def set_internal_samplerate(self, samplerate):
+        "Rebuild every module (and automation in progress) for a new internal sample rate (see `Module.set_sample_rate`)."
+        for module in self.modules.values():
+            if module is not self and module is not self.modules.get("resampler") and module.sample_rate is not None:
+                module.set_sample_rate(samplerate)
+        self.automation.set_sample_rate(samplerate)
+        self.internal_samplerate = samplerate
+
     def setup(self):
-        print(f"Setup: internal sample rate = {INTERNAL_SAMPLERATE}, external sample rate = {self.external_samplerate}, block size = {self._blocksize}")
-        self.resampler = Resampler(INTERNAL_SAMPLERATE, self.external_samplerate)
-        self.buffer = self.resampler.make_source_buffer(self._blocksize)
-        self.scratch_buffer = self.resampler.make_source_buffer(self._blocksize)
+        internal = self.internal_rate(self.external_samplerate)
+        if internal != self.internal_samplerate:
+            self.set_internal_samplerate(internal)
+        print(f"Setup: internal sample rate = {self.internal_samplerate}, external sample rate = {self.external_samplerate}, block size = {self._blocksize}, channels = {self._channels}")
+        self.resampler = self.make_resampler(self.internal_samplerate, self.external_samplerate)
+        # Buffers are (frames, channels); modules keep per-channel state and process all channels at once.
+        self.chain.allocate(self.resampler.make_source_buffer(self._blocksize, self._channels).shape)
         self.modules["resampler"] = self.resampler
+        self.osc_control.invalidate()
+
+    def reconfigure(self, samplerate=None, blocksize=None):
+        """Change the sample rate and/or block size while streaming, without stopping the audio or a recording.
+
+        The new resampler, buffers and stream are prepared on another thread, then the old stream fades out at the
+        end of a block and the new one fades in. (Called from the audio callback, e.g. by OSC, this doesn't wait.)"""
+        thread = threading.Thread(target=self._swap, args=(samplerate, blocksize), name="swap", daemon=True)
+        thread.start()
+        if threading.current_thread() is not self.audio_thread:
+            thread.join()
+
+    def _swap(self, samplerate, blocksize):
+        with self.swap_lock:
+            samplerate = samplerate or self.external_samplerate
+            blocksize = blocksize or self._blocksize
+            old = self.stream
+            if old is None:
+                # The stream stopped meanwhile.
+                self.external_samplerate, self._blocksize = samplerate, blocksize
+                self.setup()
+                return
+            resampler = self.make_resampler(self.internal_rate(samplerate), samplerate) if samplerate != self.external_samplerate else None
+            shape = (resampler or self.resampler).make_source_buffer(blocksize, self._channels).shape
+            if shape[0] > self.chain.shape[0]:
+                # The buffers only grow, so they fit blocks of both the old and the new size.
+                self.chain.allocate(shape)
+            try:
+                # Open the new stream alongside the old one, where the device allows it, so the gap is under one block.
+                stream = self.open_stream(channels=self._channels, samplerate=samplerate, blocksize=blocksize)
+                stream.start()
+            except STREAM_ERRORS:
+                stream = None
+            swap = {"samplerate": samplerate, "blocksize": blocksize, "resampler": resampler, "stream": stream,
+                    "done": threading.Event()}
+            self.swap = swap
+            # The old stream's callback switches over at its next block boundary.
+            if not swap["done"].wait(1 + 4 * self._blocksize / self.external_samplerate):
+                # No callbacks (e.g. the device stalled): switch here instead.
+                old.stop()
+                self._commit_swap(swap)
+            old.stop()
+            old.close()
+            if stream is None:
+                # The device takes one stream at a time, so reopen it now.
+                try:
+                    self.stream = self.open_stream(channels=self._channels, samplerate=samplerate, blocksize=blocksize)
+                    self.stream.start()
+                except STREAM_ERRORS:
+                    print(f"Failed to reopen the stream with samplerate = {samplerate}, blocksize = {blocksize}. (Restart with 'start'.)")
+                    self.stream = None
+                    self.stop_recording()
+                    self.quality.reset()
+                    return
+            self.osc_control.invalidate()
+            print(f"Now streaming at {samplerate} Hz, {blocksize} frames per block{' (the stream was reopened)' if stream is None else ''}.")
+
+    def _commit_swap(self, swap):
+        "Switch to a swap's settings, between two blocks."
+        self.swap = None
+        resampler = swap["resampler"] or self.resampler
+        internal = self.internal_rate(swap["samplerate"])
+        if internal != self.internal_samplerate:
+            # Native mode: the modules follow the new rate. (Redesigning filters and tables here, between the old
+            # stream's last block and the new one's first, lengthens the gap between them.)
+            self.set_internal_samplerate(internal)
+        if self.recording_out:
+            # A wave file has one sample rate: whichever resampler fed the recording carries on feeding it (so the
+            # file has no seam), as the stream's resampler if the stream is back at the file's rate.
+            recorder = self.recording_resampler or self.resampler
+            if recorder.sample_rate != internal:
+                # Native mode: the recording is now fed from the new internal rate.
+                rate = self.recording_out.getframerate()
+                recorder = recorder.convert(IdentityResampler if internal == rate else Resampler, internal)
+            if swap["samplerate"] == self.recording_out.getframerate():
+                resampler, self.recording_resampler = recorder, None
+            else:
+                self.recording_resampler = recorder
+        self.resampler = self.modules["resampler"] = resampler
+        self.quality.apply(self.quality.tier)
+        self.external_samplerate, self._blocksize = swap["samplerate"], swap["blocksize"]
+        self.stream = swap["stream"]
+        self.fade_in = True
+        swap["done"].set()
+
+    def open_stream(self, **settings):
+        "Open (but don't start) an output stream on the current device, whose callback runs the engine while it is `self.stream`."
+        def callback(outdata, frames, time, status):
+            self.stream_callback(stream, outdata)
+
+        if self.pcm:
+            settings = {"samplerate": self.external_samplerate, "channels": self._channels, **settings}
+            stream = PCMStream(self.pcm, callback, realtime=self.pcm_realtime, finished_callback=lambda: self.stop_stream() if self.stream is stream else None, **settings)
+        elif self.device == "virtual":
+            settings = {"samplerate": self.external_samplerate, "channels": self._channels, **settings}
+            # A stream replacing another (see `reconfigure`) carries on through the script from where it was.
+            start_time = self.stream.time if isinstance(self.stream, VirtualStream) else 0
+            stream = VirtualStream(callback, script=self.virtual_script, inject=lambda address, values: inject(self, address, values), start_time=start_time, **settings)
+        elif sd is None:
+            raise StreamError(NO_DEVICES)
+        else:
+            stream = sd.OutputStream(callback=callback, device=self.device, dither_off=True, **settings)
+        return stream
 
     def start_stream(self, device=None):
         if self.stream:
@@ -155,33 +692,89 @@ class SynthEngine:
         old_device = self.device
         if device:
             self.device = device
+        if sd is None and not self.pcm and self.device != "virtual":
+            print(NO_DEVICES)
+            self.device = old_device
+            return True
         try:
-            self.stream = sd.OutputStream(channels=1, callback=self.process, blocksize=self._blocksize, samplerate=self.external_samplerate, device=self.device, dither_off=True)
-        except sd.PortAudioError:
-            print(f"Failed with channels = 1, samplerate={self.external_samplerate}. Falling back to device defaults.")
+            self.stream = self.open_stream(channels=self._channels, blocksize=self._blocksize, samplerate=self.external_samplerate)
+        except STREAM_ERRORS:
+            print(f"Failed with channels = {self._channels}, samplerate={self.external_samplerate}. Falling back to device defaults.")
             try:
-                self.stream = sd.OutputStream(callback=self.process, blocksize=self._blocksize, device=self.device, dither_off=True)
+                self.stream = self.open_stream(blocksize=self._blocksize)
                 print(f"Now using channels = {self.stream.channels}, samplerate={self.stream.samplerate}")
                 self.external_samplerate = self.stream.samplerate
+                self._channels = self.stream.channels
                 self.setup()
-            except sd.PortAudioError:
+            except STREAM_ERRORS:
                 print("Still failed! Maybe try a different device? (List with `devices`, then run `start <index>`.)")
                 self.device = old_device
                 return True
         assert(self.stream.samplerate == self.external_samplerate)
+        self.quality.start()
         self.stream.start()
         return True
 
-    def stop_stream(self):
-        if not self.stream:
+    def start_pcm(self, target, format="int16", realtime=True):
+        """Stream raw interleaved PCM to `target` (stdout, a named pipe or file, or a local socket; see `pcm.PCMSink`)
+        instead of the audio device, paced by the clock, or with `realtime` off, by the reader."""
+        sink = PCMSink(target, format)
+        if self.stop_stream():
+            print("Stopping the stream to switch to PCM output. (This will interrupt recording.)")
+        if self.pcm:
+            self.pcm.close()
+        self.pcm, self.pcm_realtime = sink, realtime
+        self.start_stream()
+
+    def stop_pcm(self):
+        "Stop PCM output and go back to the audio device. Returns whether there was any."
+        if not self.pcm:
             return False
-        self.stream.stop()
-        self.stream = None
+        self.stop_stream()
+        self.pcm.close()
+        self.pcm = None
+        return True
+
+    def start_recording(self, filename):
+        print(f"Recording to '{filename}'. Type 'stop' to stop.")
+        self.recording_out = wave.open(filename, 'wb')
+        self.setup_wave(self.recording_out, self._channels)
+        self.start_stream()
+
+    def stop_stream(self):
+        with self.swap_lock:
+            if not self.stream:
+                return False
+            self.stream.stop()
+            self.stream = None
+            self.stop_recording()
+            self.quality.reset()
+            return True
+
+    def stop_recording(self):
         if self.recording_out:
             self.recording_out.close()
             self.recording_out = None
-        return True
+            self.recording_resampler = None
     
+    def resolve_param(self, param_spec):
+        "Map a parameter spec like 'subtractive.lpf.freq' to its (container, attribute name)."
+        module, *params = param_spec.split(".")
+        if not params:
+            raise AttributeError(f"No parameter given for module '{module}'.")
+        container = self.modules[module]
+        for param in params[:-1]:
+            container = getattr(container, param)
+        if not hasattr(container, params[-1]):
+            raise AttributeError(f"No such parameter '{params[-1]}'.")
+        return container, params[-1]
+
+    def set_param(self, param_spec, value):
+        # Automated (smoothed/ramping) parameters are updated by the automation engine, once per block.
+        if not self.automation.set(param_spec, value):
+            container, param = self.resolve_param(param_spec)
+            setattr(container, param, value)
+
     def get_param(self, params):
         module, *params = params.split(".")
         try:
@@ -203,13 +796,22 @@ class SynthEngine:
         print("  start")
         print("  stop")
         print("  record [filename, defaults to 'out.wav']")
-        print("  render <duration in seconds> [filename, defaults to 'out.wav']")
+        print("  status [report interval in seconds|off]")
+        print("  render <duration in seconds> [filename, defaults to 'out.wav'] [parallel jobs, defaults to 1] [MIDI file]")
+        print("  save [filename, defaults to 'patch.state']")
+        print("  load [filename, defaults to 'patch.state']")
+        print("  cache [info|clear]")
+        print("  sweep <module>.<param> [<value>, ...] <duration in seconds> [filename prefix, defaults to 'sweep']")
         print("  get <module>.<param>")
         print("  set <module>.<param> <value>")
         print("  plot <filter module>")
+        print("  quality [auto|<tier>]")
+        print("  response <filter module> [file.json|file.npy] [points, defaults to 2048]")
         print("  help")
+        self.automation_help()
         self.midi_help()
         self.osc_help()
+        self.pcm_help()
         if full:
             print("Modules and parameters:")
             # TODO: Recursively list parameters for embedded modules.
@@ -223,12 +825,36 @@ class SynthEngine:
                     else:
                         print(f"    {name}.{param}: {value}")
 
+    def automation_help(self):
+        print("Automation commands:")
+        print("  ramp <module>.<param> <value> <seconds> [linear|exp]")
+        print("  smooth <module>.<param> <time constant in seconds, 0 to disable>")
+        print("  automation record")
+        print("  automation stop")
+        print("  automation play [loop]")
+
+    def handle_automation_command(self, command, params):
+        if command == "record":
+            self.automation.record()
+            print("Recording parameter changes. Type 'automation stop' to stop.")
+        elif command == "stop":
+            self.automation.stop()
+        elif command == "play":
+            if not self.automation.lanes:
+                print("Nothing recorded.")
+                return
+            self.automation.play(loop=params == "loop")
+            print(f"Playing back {', '.join(self.automation.lanes)}.")
+        else:
+            self.automation_help()
+
     def midi_help(self):
         print("MIDI commands:")
         print("  midi list")
         print("  midi connect [device name or index, defaults to 0]")
         print("  midi disconnect")
         print("  midi file <filename>")
+        print("  midi stop")
 
     def handle_midi_command(self, command, params):
         if command == "list":
@@ -284,7 +910,11 @@ class SynthEngine:
         print("OSC commands:")
         print("  osc start [port, defaults to 8000]")
         print("  osc stop")
-        print("  (Responds to `/<module>/<param> <value>`; e.g. `/subtractive/freq 400`)")
+        print("  osc log [on|off]")
+        print("  osc stats")
+        print("  (Responds to `/<module>/<param> <value>`, e.g. `/subtractive/freq 400`, and to `/ramp/<module>/<param> <target> <seconds> [linear|exp]`")
+        print("   and `/smooth/<module>/<param> <seconds>`. Bundles are supported; updates are applied at the next block.")
+        print("   `/response/<filter module> [points]` is answered with the filter's frequency response.)")
     
     def stop_osc(self):
         try:
@@ -310,7 +940,9 @@ class SynthEngine:
                     print("Usage: osc start [port, defaults to 8000]")
                     return
             if not self.osc:
-                self.osc = OSCThreadServer(advanced_matching=True, default_handler=self.handle_osc_message)
+                # No addresses are bound; every message goes to the default handler.
+                self.osc = OSCThreadServer(default_handler=lambda address, *values: self.osc_control.receive(
+                    address, *values, reply=self.osc.answer))
             elif self.stop_osc():
                 print("Stopped server.")
             self.osc.listen(address='0.0.0.0', port=port, default=True)
@@ -320,20 +952,45 @@ class SynthEngine:
                 print("Stopped server.")
             else:
                 print("Not running!")
+        elif command == "log":
+            self.osc_control.log = params != "off"
+            print(f"OSC logging {'on' if self.osc_control.log else 'off'}.")
+        elif command == "stats":
+            print(self.osc_control.info())
         else:
             self.osc_help()
 
-    def handle_osc_message(self, address, value):
-        print("Received OSC message:", address, value)
-        # Set a parameter via OSC.
-        module, *params = address.decode('utf8').strip("/").split("/")
-        if module in self.modules:
-            container = self.modules[module]
-            for param in params[:-1]:
-                container = getattr(container, param)
-            setattr(container, params[-1], value)
+    def pcm_help(self):
+        print("PCM output commands:")
+        print("  pcm start <-|pipe or file path|unix:socket path> [int16|int24|float32, defaults to int16] [realtime|free]")
+        print("  pcm stop")
+        print("  pcm stats")
+        print("  (Streams raw interleaved samples instead of playing them; `start`/`stop` then resume/pause it. 'free' runs as fast as the reader reads.)")
+
+    def handle_pcm_command(self, command, params):
+        if command == "start":
+            target, *options = params.split() or [""]
+            format = options[0] if options else "int16"
+            if not target or options[1:] not in ([], ["realtime"], ["free"]):
+                print("Usage: pcm start <-|pipe or file path|unix:socket path> [int16|int24|float32] [realtime|free]")
+                return
+            try:
+                self.start_pcm(target, format, realtime=options[1:] != ["free"])
+            except (ValueError, OSError) as e:
+                print(e)
+                return
+            print(f"Streaming {format} PCM to '{target}'.")
+        elif command == "stop":
+            if not self.stop_pcm():
+                print("Not running!")
+        elif command == "stats":
+            if self.pcm:
+                late = f" {self.stream.late} blocks late." if self.stream else ""
+                print(self.pcm.info() + late)
+            else:
+                print("Not running!")
         else:
-            print(f"No module named '{module}'.")
+            self.pcm_help()
 
     def handle_command(self, command, params):
         if command == "midi":
@@ -342,15 +999,55 @@ class SynthEngine:
         elif command == "osc":
             command, *params = params.split(" ", 1)
             self.handle_osc_command(command, params[0] if params else '')
+        elif command == "pcm":
+            command, *params = params.split(" ", 1)
+            self.handle_pcm_command(command, params[0] if params else '')
+        elif command == "automation":
+            command, *params = params.split(" ", 1)
+            self.handle_automation_command(command, params[0] if params else '')
+        elif command == "ramp":
+            try:
+                param_spec, value, duration, *shape = params.split(" ")
+                value, duration = float(value), float(duration)
+            except ValueError:
+                print("Usage: ramp <module>.<param> <value> <seconds> [linear|exp]")
+                return
+            try:
+                self.automation.ramp(param_spec, value, duration, *shape[:1])
+            except ValueError as e:
+                print(e)
+            except KeyError as e:
+                print(f"No module named {e}.")
+            except AttributeError as e:
+                print(e)
+        elif command == "smooth":
+            try:
+                param_spec, time_constant = params.split(" ")
+                self.automation.smooth(param_spec, float(time_constant))
+            except ValueError:
+                print("Usage: smooth <module>.<param> <time constant in seconds>")
+            except KeyError as e:
+                print(f"No module named {e}.")
+            except AttributeError as e:
+                print(e)
         elif command == "devices":
-            print(sd.query_devices())
+            print(sd.query_devices() if sd else NO_DEVICES)
         elif command == "start":
             device = None
-            if params:
+            if params.split(" ")[0] == "virtual":
+                # A simulated device (see virtual.py), optionally playing a script of control events.
+                _, *script = params.split(" ", 1)
+                try:
+                    self.virtual_script = load_script(script[0]) if script else []
+                except (OSError, ValueError) as e:
+                    print(e)
+                    return
+                device = "virtual"
+            elif params:
                 try:
                     device = int(params)
                 except ValueError:
-                    print("Usage: start [device index]")
+                    print("Usage: start [device index | virtual [script]]")
                     return
             if not self.start_stream(device):
                 print("Already running!")
@@ -361,56 +1058,59 @@ class SynthEngine:
             filename = params or "out.wav"
             if not filename.endswith(".wav"):
                 filename += ".wav"
-            if os.path.exists(filename):
-                overwrite = input(f"File '{filename}' already exists. Overwrite? [y/N] ")
-                if not overwrite.lower().startswith('y'):
-                    print("Not overwriting.")
-                    return
-            print(f"Recording to '{filename}'. Type 'stop' to stop.")
-            self.recording_out = wave.open(filename, 'wb')
-            self.recording_out.setnchannels(1)
-            self.recording_out.setsampwidth(2)
-            self.recording_out.setframerate(self.external_samplerate)
-            self.start_stream()
+            if self.confirm_overwrite([filename]):
+                self.start_recording(filename)
         elif command == "render":
-            duration, *params = params.split(" ", 1)
+            duration, *params = params.split(" ")
             duration = float(duration)
             filename = params[0] if params else "out.wav"
+            jobs = int(params[1]) if len(params) > 1 else 1
+            midi_file = params[2] if len(params) > 2 else None
             if not filename.endswith(".wav"):
                 filename += ".wav"
-            if os.path.exists(filename):
-                overwrite = input(f"File '{filename}' already exists. Overwrite? [y/N] ")
-                if not overwrite.lower().startswith('y'):
-                    print("Not overwriting.")
-                    return
+            if not self.confirm_overwrite([filename]):
+                return
+            if midi_file and not os.path.exists(midi_file):
+                print(f"No MIDI file '{midi_file}'.")
+                return
             if self.stop_stream():
                 print("Stopping the stream to render to file. (Restart with 'start'.)")
-            with wave.open(filename, 'wb') as w:
-                w.setnchannels(1)
-                # NOTE: For simplicity, we always save a 16-bit wave file, even if the bit depth of the content (post-quantization) is lower.
-                # (Wave files can only store bit depths in multiples of 8, anyway.)
-                w.setsampwidth(2)
-                w.setframerate(self.external_samplerate)
-                # Convert duration to samples.
-                duration = int(duration * self.external_samplerate)
-                outdata = np.zeros(BLOCKSIZE)
-                start_time = time.time()
-                for block in range(duration // BLOCKSIZE):
-                    self.process(outdata)
-                    w.writeframes((outdata * np.iinfo(np.int16).max).astype(np.int16))
-                    p = int(block * BLOCKSIZE / duration * 50)
-                    progress = '=' * p + ' ' * (50 - p)
-                    print(f"{block * BLOCKSIZE / duration * 100:6.2f}% [{progress}] {block * BLOCKSIZE / self.external_samplerate:6.2f}/{duration / self.external_samplerate:.2f}", end='\r')
-                # Last block:
-                remainder = duration - (block * BLOCKSIZE)
-                if remainder:
-                    outdata = outdata[:remainder]
-                    self.process(outdata)
-                    w.writeframes((outdata * np.iinfo(np.int16).max).astype(np.int16))
-                real_time = time.time() - start_time
-                rendered_time = duration / self.external_samplerate
-                print(f"{100:6.2f}% [{'=' * 50}] {rendered_time:6.2f}/{rendered_time:.2f}")
-                print(f"Rendered {rendered_time:.2f}s to '{filename}' in {real_time:.2f}s ({rendered_time/real_time:.2f}x).")
+            self.render_file(filename, duration, jobs, midi_file)
+        elif command == "sweep":
+            try:
+                param_spec, params = params.split(" ", 1)
+                end = params.index("]") + 1
+                values = ast.literal_eval(params[:end])
+                duration, *params = params[end:].split()
+                duration = float(duration)
+            except (ValueError, SyntaxError):
+                print("Usage: sweep <module>.<param> [<value>, <value>, ...] <seconds> [filename prefix]")
+                return
+            prefix = params[0] if params else "sweep"
+            self.render_sweep(param_spec, values, duration, prefix)
+        elif command == "save":
+            filename = params or "patch.state"
+            start_time = time.time()
+            state.save(self.get_state(), filename)
+            print(f"Saved state to '{filename}' in {(time.time() - start_time)*1000:.1f}ms.")
+        elif command == "load":
+            filename = params or "patch.state"
+            start_time = time.time()
+            try:
+                snapshot = state.load(filename)
+            except (OSError, ValueError) as e:
+                print(f"Failed to load '{filename}': {e}")
+                return
+            self.set_state(snapshot)
+            print(f"Loaded state from '{filename}' in {(time.time() - start_time)*1000:.1f}ms.")
+        elif command == "cache":
+            if params == "clear":
+                cache.clear()
+                renders.clear()
+                print("Cleared the disk and render caches.")
+            else:
+                print(cache.info())
+                print(renders.info())
         elif command == "get":
             try:
                 print(self.get_param(params))
@@ -431,19 +1131,49 @@ class SynthEngine:
             except SyntaxError as e:
                 print(e)
                 return
-            if module in self.modules:
-                container = self.modules[module]
-                for param in params[:-1]:
-                    container = getattr(container, param)
-                setattr(container, params[-1], value)
-            else:
+            try:
+                self.set_param(param_spec, value)
+            except KeyError:
                 print(f"No module named '{module}'.")
+            except AttributeError as e:
+                print(e)
+        elif command == "quality":
+            if params:
+                try:
+                    self.quality.set_mode(params if params == "auto" else int(params))
+                except ValueError as e:
+                    print(e if params.isdigit() else "Usage: quality [auto|<tier>]")
+                    return
+            print(self.quality.info())
         elif command == "plot":
             try:
                 filter = self.get_param(params)
             except (KeyError, AttributeError):
                 return
             filter.visualize_filter()
+        elif command == "response":
+            spec, *params = params.split(" ")
+            try:
+                filter = self.get_param(spec)
+                points = int(params[1]) if len(params) > 1 else 2048
+            except (KeyError, AttributeError):
+                return
+            except ValueError:
+                print("Usage: response <filter module> [file.json|file.npy] [points, defaults to 2048]")
+                return
+            if not hasattr(filter, "frequency_response"):
+                print(f"'{spec}' has no frequency response.")
+                return
+            response = filter.frequency_response(points)
+            if params and params[0]:
+                utility.export_response(response, params[0])
+                print(f"Wrote {points}-point response of '{spec}' to '{params[0]}'.")
+            else:
+                freqs, magnitude, _ = response
+                peak = np.argmax(magnitude)
+                with np.errstate(divide='ignore'):
+                    print(f"Peak {20*np.log10(magnitude[peak]):.1f} dB at {freqs[peak]:.0f} Hz; "
+                          f"{20*np.log10(magnitude[0]):.1f} dB at DC, {20*np.log10(magnitude[-1]):.1f} dB near Nyquist.")
         elif command in ["exit", "quit"]:
             print("Farewell.")
             self.running = False
@@ -457,23 +1187,8 @@ class SynthEngine:
             self.help(full=False)
 
     def run(self):
-        self.running = True
-        try:
-            while self.running:
-                try:
-                    command, *params = input("> ").split(" ", 1)
-                except EOFError:
-                    # Allow Ctrl+D to exit.
-                    print()
-                    self.running = False
-                    return
-                self.handle_command(command, params[0] if params else '')
-        except KeyboardInterrupt:
-            # Allow Ctrl+C to exit.
-            print()
-
-        self.stop_stream()
-
+        "Run the interactive console (see console.py) until the user exits."
+        Console(self).run()
 
 if __name__ == '__main__':
     engine = SynthEngine()
@@ -1,10 +1,183 @@
+import importlib
+
+import numpy as np
+
+
+# State smaller than this (-400 dB) is flushed to zero at block boundaries, before decaying tails reach subnormal
+# floats: these are very slow to compute with, and rounding can keep a recursion on them forever. (0 disables it.)
+DENORMAL_THRESHOLD = 1e-20
+
+
 class Module:
 
     PARAMETERS = ("mix",)
+    # Parameters that also accept a per-sample array (one value per frame of the next block).
+    SIGNAL_PARAMETERS = ("mix",)
+    # Parameters that accept a (1, channels) array of per-channel values, for batch (sweep) rendering.
+    BATCH_PARAMETERS = ("mix",)
+    # Parameters whose setters redesign or rebuild derived data (FIR taps, grains, tables, samples), which is too slow
+    # for the audio thread: while streaming, OSC sends them to the control thread instead.
+    SLOW_PARAMETERS = ()
+    # Whether `process` works with input_buffer and output_buffer being the same array.
+    IN_PLACE = False
+    # Attributes that are scratch space or structure rather than state, left out of `get_state`.
+    TRANSIENT = ()
 
     def __init__(self, sample_rate, mix=1):
         self.sample_rate = sample_rate
         self.mix = mix
     
     def process(self, input_buffer, output_buffer):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    def advance(self, n, channels):
+        """Move time-dependent state (phases, generators) forward by `n` frames without producing output, as `process` would.
+
+        State that only depends on recent input (filters, delay lines) is restored by rendering a pre-roll instead."""
+        pass
+
+    def at_rest(self):
+        """Whether silent input gives silent output, with no tail left to ring out.
+
+        The chain skips modules at rest while their input is silent, calling `advance` instead of `process`.
+        Stateless effects can always be at rest; sources never are."""
+        return False
+
+    def set_sample_rate(self, sample_rate):
+        """Switch to `sample_rate`, keeping the parameters and as much of the state as carries over.
+
+        Nested modules follow. Modules override this to recompute what depends on the rate (coefficients, tables,
+        buffer lengths); values in seconds or Hz are converted at the current rate as they are used, so need nothing."""
+        self.sample_rate = sample_rate
+        for value in list(vars(self).values()):
+            for module in value.values() if isinstance(value, dict) else value if isinstance(value, list) else (value,):
+                if isinstance(module, Module) and module.sample_rate != sample_rate:
+                    module.set_sample_rate(sample_rate)
+
+    def get_state(self):
+        "Snapshot of the module's parameters and DSP state, as plain values, arrays and nested module states."
+        state = {name: snapshot(value) for name, value in vars(self).items() if name not in self.TRANSIENT}
+        state["class"] = f"{type(self).__module__}.{type(self).__qualname__}"
+        return state
+
+    def set_state(self, state):
+        """Restore a `get_state` snapshot.
+
+        Attributes (including derived ones, like filter coefficients or grains) are written directly, so no setters
+        run and nothing is redesigned or rebuilt. Arrays are copied, so a snapshot can be restored more than once."""
+        for name, value in state.items():
+            if name != "class":
+                self.__dict__[name] = restore(value, self.__dict__.get(name))
+
+    def set_batch(self, name, values, channels):
+        "Set one value per variant, for rendering len(values) variants of `channels` channels side by side."
+        if name not in self.BATCH_PARAMETERS:
+            raise ValueError(f"Parameter '{name}' can't be swept (options: {', '.join(self.BATCH_PARAMETERS)}).")
+        setattr(self, name, batch(values, channels))
+
+
+def control(value, shape):
+    "Broadcast a parameter value to a (frames, channels) block shape without copying."
+    # Scalars apply to every sample, 1-D arrays are per-sample (shared by all channels),
+    # and 2-D arrays are (frames or 1, channels).
+    value = np.asarray(value)
+    if value.ndim == 1 and len(shape) > 1:
+        value = value[:, None]
+    return np.broadcast_to(value, shape)
+
+
+def current(value):
+    "The latest value of a parameter that may be a per-sample or per-channel array."
+    return float(np.ravel(value)[-1])
+
+
+def interpolate(points, interval, out):
+    """Fill `out` (frames, ...) by linear interpolation between control-rate `points`, one every `interval` frames
+    from the first (so there must be at least ceil(len(out) / interval) + 1 of them)."""
+    n = len(out)
+    whole = n // interval
+    slopes = np.diff(points, axis=0)
+    slopes /= interval
+    steps = np.arange(interval).reshape((1, interval) + (1,)*(out.ndim - 1))
+    segments = out[:whole * interval].reshape((whole, interval) + out.shape[1:])
+    np.multiply(steps, slopes[:whole, None], out=segments)
+    segments += points[:whole, None]
+    if n > whole * interval:
+        np.multiply(steps[0, :n - whole * interval], slopes[whole], out=out[whole * interval:])
+        out[whole * interval:] += points[whole]
+    return out
+
+
+class LookupTable:
+    "A smooth function over [start, stop], tabulated and linearly interpolated, for coefficient maps at control rate."
+
+    def __init__(self, function, start, stop, size=4096):
+        self.start = start
+        self.size = size
+        self.scale = size / (stop - start)
+        table = function(start + np.arange(size + 1) / self.scale)
+        # (value, slope) pairs, as for the LFO's waveform tables.
+        self.values, self.slopes = table[:-1].copy(), np.diff(table)
+
+    def __call__(self, x):
+        "Values at `x` (clipped to the table's range)."
+        position = np.clip((np.asarray(x, dtype=float) - self.start) * self.scale, 0, self.size)
+        index = np.minimum(position.astype(np.intp), self.size - 1)
+        position -= index
+        position *= self.slopes[index]
+        position += self.values[index]
+        return position
+
+
+def flush(array):
+    "Zero the elements of `array` smaller than `DENORMAL_THRESHOLD`, in place."
+    array[np.abs(array) < DENORMAL_THRESHOLD] = 0
+
+
+def snapshot(value):
+    "Copy a module attribute into a state tree of plain values, arrays and nested states."
+    if isinstance(value, Module):
+        return value.get_state()
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.random.Generator):
+        return {"generator": value.bit_generator.state}
+    if isinstance(value, (list, tuple)):
+        return [snapshot(v) for v in value]
+    if isinstance(value, dict):
+        return {k: snapshot(v) for k, v in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f"Can't snapshot {type(value).__name__}; add it to the module's TRANSIENT attributes.")
+
+
+def restore(value, current=None):
+    "Rebuild an attribute from a state tree, restoring into `current` (the existing value) where possible."
+    if isinstance(value, dict) and "class" in value:
+        module_path, name = value["class"].rsplit(".", 1)
+        cls = getattr(importlib.import_module(module_path), name)
+        if type(current) is not cls:
+            current = cls.__new__(cls)
+        current.set_state(value)
+        return current
+    if isinstance(value, dict) and "generator" in value:
+        if not isinstance(current, np.random.Generator):
+            current = np.random.default_rng()
+        current.bit_generator.state = value["generator"]
+        return current
+    if isinstance(value, np.ndarray):
+        return np.array(value)
+    if isinstance(value, list):
+        current = current if isinstance(current, list) and len(current) == len(value) else [None] * len(value)
+        return [restore(v, c) for v, c in zip(value, current)]
+    if isinstance(value, dict):
+        current = current if isinstance(current, dict) else {}
+        return {k: restore(v, current.get(k)) for k, v in value.items()}
+    return value
+
+
+def batch(values, channels):
+    "Fold one value per variant into a (1, variants * channels) array, so variants render along the channel axis."
+    return np.repeat(np.asarray(values, dtype=float), channels)[None, :]
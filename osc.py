@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import numpy as np
+
+
+class OSCControl:
+    """Routes OSC messages to parameters.
+
+    Setters are resolved once per address and cached. `/<module>/<param> <value>` sets a parameter (several
+    values set a list, e.g. `/autowah/freq_range 100 2000`), `/ramp/<module>/<param> <target> <seconds> [shape]`
+    and `/smooth/<module>/<param> <seconds>` drive automation, and bundles are handled message by message.
+    `/response/<filter module> [points]` is answered with the filter's frequency response (see `respond`).
+
+    While audio is streaming (or if `coalesce` is True), updates are queued and applied at the start of the next
+    block, keeping only the latest update per address; otherwise they are applied as they arrive. Updates to slow
+    parameters (see `Module.SLOW_PARAMETERS`) are coalesced the same way but applied on the control thread
+    (`executor`, or a thread of their own), so they never stall the audio callback."""
+
+    DEFAULT_RESPONSE_POINTS = 2048
+    # NOTE: Capped so that the reply fits in a UDP packet.
+    MAX_RESPONSE_POINTS = 2048
+
+    def __init__(self, engine, log=False, coalesce="auto", executor=None):
+        self.engine = engine
+        self.log = log
+        self.coalesce = coalesce
+        self.executor = executor
+        # Address -> (setter, whether the parameter is slow).
+        self.setters = {}
+        self.pending = {}
+        # Queued updates to slow parameters, and whether the control thread has been asked to apply them.
+        self.deferred = {}
+        self.scheduled = False
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(("received", "applied", "coalesced", "errors"), 0)
+
+    def __getstate__(self):
+        # Engine copies (e.g. for parallel rendering) get empty queues and a lock (and control thread) of their own.
+        state = self.__dict__.copy()
+        state.update(setters={}, pending={}, deferred={}, scheduled=False, lock=None, executor=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        "Forget cached setters (e.g. after modules are replaced)."
+        self.setters.clear()
+
+    def _resolve(self, address):
+        kind, *parts = address.decode('utf8').strip("/").split("/")
+        if kind not in ("ramp", "smooth"):
+            kind, parts = "set", [kind] + parts
+        spec = ".".join(parts)
+        automation = self.engine.automation
+        if kind == "ramp":
+            self.engine.resolve_param(spec)
+            return (lambda target, seconds, shape="linear": automation.ramp(spec, target, seconds, shape)), False
+        if kind == "smooth":
+            self.engine.resolve_param(spec)
+            return (lambda seconds: automation.smooth(spec, seconds)), False
+        container, name = self.engine.resolve_param(spec)
+
+        def setter(value):
+            # Automated (smoothed/ramping) parameters are updated by the automation engine, once per block.
+            if not automation.set(spec, value):
+                setattr(container, name, value)
+        return setter, name in getattr(container, "SLOW_PARAMETERS", ())
+
+    def receive(self, address, *values, reply=None):
+        "Handle one OSC message (the server's default handler). `reply(address, values)` answers the sender."
+        self.stats["received"] += 1
+        if self.log:
+            print("Received OSC message:", address, *values)
+        if address.startswith(b"/response/"):
+            self.respond(address, values, reply)
+            return
+        values = [value.decode('utf8') if isinstance(value, bytes) else value for value in values]
+        # NOTE: Errors are reported here, as exceptions would stop the server's thread.
+        try:
+            entry = self.setters.get(address)
+            if entry is None:
+                entry = self.setters[address] = self._resolve(address)
+            setter, slow = entry
+            if not values:
+                raise IndexError("no value")
+            if not address.startswith((b"/ramp/", b"/smooth/")):
+                values = [values[0] if len(values) == 1 else values]
+        except KeyError as e:
+            self.stats["errors"] += 1
+            print(f"No module named {e}.")
+            return
+        except (AttributeError, IndexError, UnicodeDecodeError) as e:
+            self.stats["errors"] += 1
+            print(f"Invalid OSC message {address}: {e}")
+            return
+        coalesce = self.coalesce if self.coalesce != "auto" else self.engine.stream is not None
+        if not coalesce:
+            self._apply(address, setter, values)
+            return
+        with self.lock:
+            queue = self.deferred if slow else self.pending
+            if address in queue:
+                self.stats["coalesced"] += 1
+            queue[address] = (setter, values)
+            schedule = slow and not self.scheduled
+            if schedule:
+                self.scheduled = True
+        if schedule:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(1, thread_name_prefix="osc")
+            self.executor.submit(self.apply_deferred)
+
+    def _apply(self, address, setter, values):
+        try:
+            setter(*values)
+            self.stats["applied"] += 1
+        # NOTE: Catch everything; this may run in the audio callback.
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Invalid OSC message {address}: {e}")
+
+    def apply(self):
+        "Apply queued updates (called at the start of each block)."
+        if not self.pending:
+            return
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for address, (setter, values) in pending.items():
+            self._apply(address, setter, values)
+
+    def apply_deferred(self):
+        "Apply queued updates to slow parameters (called on the control thread)."
+        with self.lock:
+            deferred, self.deferred = self.deferred, {}
+            self.scheduled = False
+        for address, (setter, values) in deferred.items():
+            self._apply(address, setter, values)
+
+    def respond(self, address, values, reply):
+        """Answer a `/response/<filter module> [points]` query (e.g. `/response/autowah/bpf 512`).
+
+        The reply has the same address, and its arguments are the number of points followed by the frequencies (Hz),
+        magnitudes and phases (radians) as floats. `points` defaults to DEFAULT_RESPONSE_POINTS (as for the `response`
+        command) and is capped at MAX_RESPONSE_POINTS. Responses are cached, so polling them while sweeping is cheap."""
+        try:
+            if reply is None:
+                raise ValueError("nowhere to reply")
+            module, *path = address.decode('utf8')[len("/response/"):].strip("/").split("/")
+            filter = self.engine.modules[module]
+            for name in path:
+                filter = getattr(filter, name)
+            points = min(int(values[0]) if values else self.DEFAULT_RESPONSE_POINTS, self.MAX_RESPONSE_POINTS)
+            response = filter.frequency_response(points)
+        except KeyError as e:
+            self.stats["errors"] += 1
+            print(f"No module named {e}.")
+            return
+        except (AttributeError, ValueError, TypeError, UnicodeDecodeError) as e:
+            self.stats["errors"] += 1
+            print(f"Invalid OSC message {address}: {e}")
+            return
+        reply(address, [points] + np.concatenate(response).tolist())
+        self.stats["applied"] += 1
+
+    def info(self):
+        stats = ", ".join(f"{count} {name}" for name, count in self.stats.items())
+        return f"OSC messages: {stats}; logging {'on' if self.log else 'off'}."
+
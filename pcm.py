@@ -0,0 +1,234 @@
+import argparse
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+class StreamError(Exception):
+    "A stream couldn't be opened. (Raised by the stand-in streams, as sounddevice raises PortAudioError.)"
+
+
+class PCMSink:
+    """Destination for raw PCM: stdout ("-"), a named pipe or file (a path), or a local socket ("unix:<path>").
+
+    A socket is listened on, and the first client to connect reads the stream. Opening waits for the reader
+    (as a named pipe does), so it is done by the stream's own thread (see `connect`). Writes block while the
+    reader is behind: that back-pressure slows the stream down, rather than samples being dropped or queued."""
+
+    FORMATS = {"float32": np.dtype("<f4"), "int16": np.dtype("<i2"), "int24": np.dtype("<i4")}
+
+    def __init__(self, target, format="int16"):
+        if format not in self.FORMATS:
+            raise ValueError(f"Unknown PCM format '{format}' (options: {', '.join(self.FORMATS)}).")
+        self.target = target
+        self.format = format
+        self.fd = None
+        self.sock = None
+        self.listener = None
+        self.saved_stdout = None
+        # The stream currently writing here (only one at a time, see `PCMStream`).
+        self.owner = None
+        self.bytes = 0
+        self.blocked = 0.0
+        if target.startswith("unix:"):
+            path = target[len("unix:"):]
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(path)
+            self.listener.listen(1)
+
+    @property
+    def sample_width(self):
+        return 3 if self.format == "int24" else self.FORMATS[self.format].itemsize
+
+    def connect(self):
+        "Open the target, waiting for a reader if it is a pipe or socket. (Does nothing if already connected.)"
+        if self.fd is not None or self.sock is not None:
+            return
+        if self.listener:
+            self.sock, _ = self.listener.accept()
+        elif self.target == "-":
+            if self.saved_stdout is None:
+                # Keep the real stdout for the samples, and send everything else printed to stderr.
+                sys.stdout.flush()
+                self.saved_stdout = os.dup(1)
+                os.dup2(2, 1)
+            self.fd = os.dup(self.saved_stdout)
+        else:
+            self.fd = os.open(self.target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def write(self, data):
+        "Write all of `data` (a bytes-like object), blocking while the reader is behind."
+        view = memoryview(data).cast("B")
+        self.bytes += view.nbytes
+        start = time.perf_counter()
+        if self.sock:
+            self.sock.sendall(view)
+        else:
+            while view:
+                view = view[os.write(self.fd, view):]
+        self.blocked += time.perf_counter() - start
+
+    def disconnect(self):
+        "Drop the current reader (the next `connect` waits for another)."
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self):
+        self.disconnect()
+        if self.listener:
+            path = self.listener.getsockname()
+            self.listener.close()
+            self.listener = None
+            if path and os.path.exists(path):
+                os.remove(path)
+        if self.saved_stdout is not None:
+            sys.stdout.flush()
+            os.dup2(self.saved_stdout, 1)
+            os.close(self.saved_stdout)
+            self.saved_stdout = None
+
+    def info(self):
+        return f"PCM output to '{self.target}' ({self.format}): {self.bytes / 2**20:.1f} MB written, {self.blocked:.2f}s blocked on the reader."
+
+
+class PCMStream:
+    """Stands in for a sounddevice OutputStream, writing to a `PCMSink` instead of an audio device.
+
+    A thread of its own calls `callback(outdata, frames, time, status)` for each block, as PortAudio would, then
+    converts the floats to interleaved PCM in preallocated buffers and writes them without copying. With `realtime`,
+    blocks are paced by the clock; otherwise the stream runs as fast as the reader takes the samples. A sink takes
+    one stream at a time: like an exclusive device, opening a second raises `StreamError`.
+
+    `finished_callback` is called if the stream ends by itself (when the reader disconnects), from its thread."""
+
+    def __init__(self, sink, callback, samplerate, blocksize, channels=1, realtime=True, finished_callback=None, **ignored):
+        if sink.owner is not None:
+            raise StreamError(f"PCM output to '{sink.target}' is in use.")
+        sink.owner = self
+        self.sink = sink
+        self.callback = callback
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.channels = channels
+        self.realtime = realtime
+        self.finished_callback = finished_callback
+        self.thread = None
+        self.running = False
+        # Blocks that started late (the engine or the reader fell behind the clock).
+        self.late = 0
+        self.outdata = np.zeros((blocksize, channels))
+        self.scratch = np.zeros((blocksize, channels))
+        self.codes = np.zeros((blocksize, channels), dtype=sink.FORMATS[sink.format])
+        self.packed = np.zeros((blocksize, channels, 3), dtype=np.uint8)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="pcm", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread is not threading.current_thread():
+            # If the thread is still waiting on the reader, it finishes (and frees the sink) once that returns.
+            self.thread.join(1 + 4 * self.blocksize / self.samplerate)
+        if not (self.thread and self.thread.is_alive()) and self.sink.owner is self:
+            self.sink.owner = None
+
+    def close(self):
+        self.stop()
+
+    def encode(self, outdata):
+        "Convert a block of floats in [-1, 1) to the sink's format, in preallocated buffers."
+        if self.sink.format == "float32":
+            np.copyto(self.codes, outdata, casting='unsafe')
+            return self.codes
+        bits = 16 if self.sink.format == "int16" else 24
+        # Quantized floats are multiples of one LSB at the quantizer's depth, so this only rounds if it is deeper.
+        np.multiply(outdata, 2**(bits - 1), out=self.scratch)
+        np.rint(self.scratch, out=self.scratch)
+        np.clip(self.scratch, -2**(bits - 1), 2**(bits - 1) - 1, out=self.scratch)
+        np.copyto(self.codes, self.scratch, casting='unsafe')
+        if bits == 16:
+            return self.codes
+        self.packed[:] = self.codes.view(np.uint8).reshape(self.packed.shape[:-1] + (4,))[..., :3]
+        return self.packed
+
+    def run(self):
+        try:
+            self.sink.connect()
+            period = self.blocksize / self.samplerate
+            deadline = time.perf_counter()
+            while self.running:
+                if self.realtime:
+                    delay = deadline - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -period:
+                        # More than a block behind: count it and resume from now, rather than rushing to catch up.
+                        self.late += 1
+                        deadline = time.perf_counter()
+                    deadline += period
+                self.callback(self.outdata, self.blocksize, None, None)
+                if not self.running:
+                    break
+                self.sink.write(self.encode(self.outdata))
+        except OSError as e:
+            # The reader went away (or the target failed). After `stop`, this is just the sink closing.
+            if self.running:
+                print(f"PCM output to '{self.sink.target}' stopped: {e}")
+                self.sink.disconnect()
+                if self.finished_callback:
+                    self.finished_callback()
+        finally:
+            self.running = False
+            if self.sink.owner is self:
+                self.sink.owner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream the synth's output as raw interleaved PCM, with no audio device.")
+    parser.add_argument("target", help="'-' for stdout, a named pipe or file path, or unix:<path> to serve one reader on a local socket")
+    parser.add_argument("--format", default="int16", choices=PCMSink.FORMATS, help="sample format (default: int16)")
+    parser.add_argument("--samplerate", type=int, default=44100)
+    parser.add_argument("--blocksize", type=int, default=2048)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--state", help="snapshot to load first (see `save`)")
+    parser.add_argument("--free", action="store_true", help="run as fast as the reader takes samples, instead of in real time")
+    parser.add_argument("--seconds", type=float, help="stop after this long (default: until interrupted or the reader leaves)")
+    args = parser.parse_args()
+    if args.target == "-":
+        # Messages go to stderr from the start, so none end up in the samples.
+        sys.stdout = sys.stderr
+    # Imported here, as main imports this module.
+    from main import SynthEngine
+    import state
+    engine = SynthEngine()
+    if args.state:
+        engine.set_state(state.load(args.state))
+    engine.samplerate = args.samplerate
+    engine.blocksize = args.blocksize
+    engine.channels = args.channels
+    engine.start_pcm(args.target, args.format, realtime=not args.free)
+    try:
+        start = time.time()
+        while engine.stream and (args.seconds is None or time.time() - start < args.seconds):
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.stop_pcm()
+
+
+if __name__ == '__main__':
+    main()
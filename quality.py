@@ -0,0 +1,119 @@
+import collections
+import time
+
+from resample import CubicResampler, IdentityResampler, LinearResampler
+
+
+class QualityGovernor:
+    """Sheds load when the audio callback nears its deadline, stepping through `TIERS` of cheaper settings, and
+    steps back up once the load falls.
+
+    Load is processing time over the duration of the block, smoothed over a few blocks. Above `high`, the engine
+    drops a tier; below `low` for `recovery` blocks in a row, it goes back up one. After each change it holds for
+    `hold` blocks while the load settles. Tiers change between blocks, and without glitches: the resampler carries
+    its position and history over, and dropped harmonics fade out over a block.
+
+    `mode` is "auto" (adapt) or a tier number to stay at. Tiers only apply while streaming; renders run at full
+    quality."""
+
+    RESAMPLERS = {"cubic": CubicResampler, "linear": LinearResampler}
+    DEFAULTS = {"resampler": "cubic", "max_harmonics": None}
+    # Settings changed from the defaults at each tier, from full quality down.
+    TIERS = (
+        {},
+        {"resampler": "linear"},
+        {"resampler": "linear", "max_harmonics": 64},
+        {"resampler": "linear", "max_harmonics": 16},
+    )
+
+    def __init__(self, engine, tiers=TIERS, high=0.8, low=0.4, smoothing=0.2, hold=8, recovery=64):
+        self.engine = engine
+        self.tiers = tiers
+        self.high = high
+        self.low = low
+        self.smoothing = smoothing
+        self.hold = hold
+        self.recovery = recovery
+        self.mode = "auto"
+        self.tier = 0
+        # (time, from tier, to tier, smoothed load) for recent changes.
+        self.transitions = collections.deque(maxlen=32)
+        self.reset()
+
+    def reset(self):
+        "Return to full quality and clear the load statistics (when the stream stops)."
+        self.apply(0)
+        self.load = None
+        self.peak = 0
+        self.blocks = 0
+        self.late = 0
+        self.changes = 0
+        self.waiting = 0
+        self.calm = 0
+        self.seconds = [0.0] * len(self.tiers)
+
+    def start(self):
+        "Apply the starting tier (when the stream starts)."
+        self.apply(0 if self.mode == "auto" else self.mode)
+
+    def set_mode(self, mode):
+        if mode != "auto" and mode not in range(len(self.tiers)):
+            raise ValueError(f"No tier {mode} (options: auto, 0-{len(self.tiers) - 1}).")
+        # Applied by `record`, between blocks (or by `start`).
+        self.mode = mode
+
+    def apply(self, tier):
+        "Switch the engine to `tier`'s settings (between blocks)."
+        settings = dict(self.DEFAULTS, **self.tiers[tier])
+        engine = self.engine
+        resampler = self.RESAMPLERS[settings["resampler"]]
+        # (At matching rates there is no resampling to cheapen.)
+        if not isinstance(engine.resampler, IdentityResampler) and type(engine.resampler) is not resampler:
+            engine.resampler = engine.modules["resampler"] = engine.resampler.convert(resampler)
+            engine.osc_control.invalidate()
+        engine.subtractive.max_harmonics = settings["max_harmonics"]
+        self.tier = tier
+
+    def _change(self, tier):
+        self.transitions.append((time.time(), self.tier, tier, self.load))
+        self.changes += 1
+        self.apply(tier)
+        self.waiting = self.hold
+        self.calm = 0
+
+    def record(self, elapsed, period):
+        "Account for a block that took `elapsed` seconds to process and lasts `period` seconds, changing tier if needed."
+        load = elapsed / period
+        self.load = load if self.load is None else self.load + self.smoothing * (load - self.load)
+        self.peak = max(self.peak, load)
+        self.blocks += 1
+        self.late += load > 1
+        self.seconds[self.tier] += period
+        if self.mode != "auto":
+            if self.tier != self.mode:
+                self._change(self.mode)
+            return
+        if self.waiting:
+            self.waiting -= 1
+        elif self.load > self.high and self.tier < len(self.tiers) - 1:
+            self._change(self.tier + 1)
+        elif self.load < self.low and self.tier > 0:
+            self.calm += 1
+            if self.calm >= self.recovery:
+                self._change(self.tier - 1)
+        else:
+            self.calm = 0
+
+    def metrics(self):
+        return {"mode": self.mode, "tier": self.tier, "load": self.load, "peak": self.peak, "blocks": self.blocks,
+                "late": self.late, "changes": self.changes, "seconds": list(self.seconds),
+                "transitions": list(self.transitions)}
+
+    def info(self):
+        load = f"{self.load:.0%}" if self.load is not None else "-"
+        seconds = ", ".join(f"{seconds:.1f}s" for seconds in self.seconds)
+        lines = [f"Quality: tier {self.tier} of 0-{len(self.tiers) - 1} ({self.mode}); load {load} (peak {self.peak:.0%}), "
+                 f"{self.late} late of {self.blocks} blocks; {self.changes} changes; time per tier {seconds}."]
+        for when, old, new, load in list(self.transitions)[-3:]:
+            lines.append(f"    {time.strftime('%H:%M:%S', time.localtime(when))} tier {old} -> {new} at load {load:.0%}")
+        return "\n".join(lines)
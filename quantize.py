@@ -3,18 +3,117 @@ import numpy as np
 from module import Module
 
 class Quantizer(Module):
+    "Quantizes to `depth` bits with per-sample dither, optionally encoding straight to 16/24-bit PCM."
 
-    PARAMETERS = ("depth", "dither", "mix")
+    PARAMETERS = ("depth", "dither", "seed", "mix")
+    DITHERS = ("triangular", "rectangular", "highpass", "none")
+    TRANSIENT = ("noise", "scratch", "draws", "codes", "packed")
 
-    def __init__(self, depth=16, dither='triangular'):
+    def __init__(self, depth=16, dither='triangular', seed=None):
         super().__init__(None)  # NOTE: Sample rate is irrelevant for this module.
         self.depth = depth
         self.dither = dither
+        self.seed = seed
+        self.noise = None
+        self._allocate((0, 1))
+
+    @property
+    def dither(self):
+        return self._dither
+
+    @dither.setter
+    def dither(self, value):
+        if value not in self.DITHERS:
+            raise ValueError(f"Unknown dither '{value}' (options: {', '.join(self.DITHERS)}).")
+        self._dither = value
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @seed.setter
+    def seed(self, value):
+        self._seed = value
+        self.rng = np.random.default_rng(value)
+
+    @property
+    def sample_width(self):
+        "Bytes per sample of the smallest PCM container that holds `depth` bits."
+        return 2 if self.depth <= 16 else 3
+
+    def _allocate(self, shape):
+        # NOTE: `last_draw` is state (restored by `set_state`), so it is checked too.
+        if self.noise is not None and self.noise.shape[1:] == shape[1:] and len(self.noise) >= shape[0] and self.last_draw.shape == shape[1:]:
+            return
+        self.noise = np.zeros(shape)
+        self.scratch = np.zeros(shape)
+        # One extra frame carries the last draw of the previous block, for highpass dither.
+        self.draws = np.zeros((shape[0] + 1,) + shape[1:])
+        self.last_draw = np.zeros(shape[1:])
+        self.codes = {2: np.zeros(shape, dtype='<i2'), 3: np.zeros(shape, dtype='<i4')}
+        self.packed = np.zeros(shape + (3,), dtype=np.uint8)
+
+    def _quantize(self, input_buffer, output_buffer, depth):
+        "Write `input_buffer` scaled to a `depth`-bit signed integer range, dithered and rounded, to `output_buffer`."
+        n = len(input_buffer)
+        noise, draws = self.noise[:n], self.draws[:n + 1]
+        np.multiply(input_buffer, 2**(depth - 1), out=output_buffer)
+        # Dither is in units of one LSB and drawn per sample into preallocated buffers.
+        if self._dither == 'triangular':
+            self.rng.random(out=noise)
+            output_buffer += noise
+            self.rng.random(out=noise)
+            output_buffer -= noise
+        elif self._dither == 'rectangular':
+            self.rng.random(out=noise)
+            noise -= 0.5
+            output_buffer += noise
+        elif self._dither == 'highpass':
+            # Difference of successive uniform draws: triangular PDF with its noise shaped towards high
+            # frequencies, at the cost of a single draw per sample.
+            draws[0] = self.last_draw
+            self.rng.random(out=draws[1:])
+            np.subtract(draws[1:], draws[:-1], out=noise)
+            output_buffer += noise
+            self.last_draw[...] = draws[n]
+        np.rint(output_buffer, out=output_buffer)
+        np.clip(output_buffer, -2**(depth - 1), 2**(depth - 1) - 1, out=output_buffer)
+
+    def advance(self, n, channels):
+        # Skip the dither draws for `n` frames, as `process` would make them.
+        self._allocate((n, channels))
+        if self._dither == 'highpass' and n:
+            # Highpass dither carries the last draw into the next block, so that one is drawn.
+            self.rng.bit_generator.advance((n - 1) * channels)
+            self.rng.random(out=self.last_draw)
+            return
+        draws = {'triangular': 2, 'rectangular': 1, 'highpass': 1, 'none': 0}[self._dither]
+        self.rng.bit_generator.advance(draws * n * channels)
 
     def process(self, input_buffer, output_buffer):
-        buf = input_buffer * 2**self.depth
-        if self.dither == 'triangular':
-            buf += np.random.triangular(-1, 0, 1)
-        elif self.dither == 'rectangular':
-            buf += np.random.uniform(-1, 1)
-        output_buffer[:] = np.round(buf) / 2**self.depth
\ No newline at end of file
+        self._allocate(input_buffer.shape)
+        self._quantize(input_buffer, output_buffer, self.depth)
+        output_buffer *= 2**(1 - self.depth)
+
+    def encode(self, input_buffer, sample_width=None, output_buffer=None):
+        """Quantize straight to interleaved little-endian 16 or 24-bit PCM, without quantizing twice.
+
+        If `output_buffer` is given, the quantized floats are also written there (e.g. for the audio device).
+        The result is an internal buffer, valid until the next call."""
+        sample_width = sample_width or self.sample_width
+        container_bits = 8 * sample_width
+        depth = min(self.depth, container_bits)
+        n = len(input_buffer)
+        self._allocate(input_buffer.shape)
+        scratch, codes = self.scratch[:n], self.codes[sample_width][:n]
+        self._quantize(input_buffer, scratch, depth)
+        if output_buffer is not None:
+            np.multiply(scratch, 2**(1 - depth), out=output_buffer)
+        np.copyto(codes, scratch, casting='unsafe')
+        # Lower depths sit in the top bits of the container.
+        codes <<= container_bits - depth
+        if sample_width == 2:
+            return codes
+        packed = self.packed[:n]
+        packed[:] = codes.view(np.uint8).reshape(packed.shape[:-1] + (4,))[..., :3]
+        return packed
@@ -1,4 +1,3 @@
-import math
 import numpy as np
 
 from module import Module
@@ -8,15 +7,36 @@ class Resampler(Module):
     "Abstract base class for resamplers."
     LOOKAHEAD = None
     HISTORY = None
+    TRANSIENT = ("extended", "output")
 
     def __init__(self, sample_rate, target_rate):
         super().__init__(sample_rate)
         self.target_rate = target_rate
         self.source_time = -(self.HISTORY - 1)
         self.last_samples = np.zeros(self.HISTORY)
+        self.extended = np.zeros(0)
+        self.output = np.zeros(0)
 
-    def make_source_buffer(self, target_blocksize):
-        return np.zeros(int(np.ceil(self.sample_rate / self.target_rate * target_blocksize)))
+    def convert(self, cls, sample_rate=None):
+        """A resampler of class `cls` that carries on from this one's position and history, so switching doesn't glitch.
+
+        Given a new source `sample_rate`, the position and history are kept as they are (in samples), which is
+        close enough not to click."""
+        other = cls(sample_rate or self.sample_rate, self.target_rate)
+        other.set_state(dict(self.get_state(), sample_rate=other.sample_rate))
+        return other
+
+    def set_state(self, state):
+        super().set_state(state)
+        # The state may come from another class of resampler, which keeps a different amount of history.
+        # (Missing history repeats the oldest sample.)
+        n = min(self.HISTORY, len(self.last_samples))
+        history = np.repeat(self.last_samples[len(self.last_samples) - n:][:1], self.HISTORY, axis=0)
+        history[self.HISTORY - n:] = self.last_samples[len(self.last_samples) - n:]
+        self.last_samples = history
+
+    def make_source_buffer(self, target_blocksize, channels=1):
+        return np.zeros((int(np.ceil(self.sample_rate / self.target_rate * target_blocksize)), channels))
 
     def get_source_blocksize(self, target_blocksize):
         # Buffer size needed to avoid IndexError:
@@ -28,37 +48,82 @@ class Resampler(Module):
         min_samples = highest_index + 1
         return min_samples
 
+    def available(self, source_blocksize):
+        "Number of output samples the next `source_blocksize` input samples complete (the inverse of `get_source_blocksize`)."
+        n = max(0, int(np.ceil((source_blocksize - self.LOOKAHEAD - self.source_time) * self.target_rate / self.sample_rate)))
+        # Guard against rounding up past the last complete sample.
+        while n and self.get_source_blocksize(n) > source_blocksize:
+            n -= 1
+        return n
+
+    def resample(self, input_buffer):
+        """Resample all of `input_buffer`, for consumers that don't choose the block size (e.g. a second output rate).
+
+        Returns as many output samples as are complete, in an internal buffer valid until the next call."""
+        n = self.available(len(input_buffer))
+        if len(self.output) < n or self.output.shape[1:] != input_buffer.shape[1:]:
+            self.output = np.zeros((n,) + input_buffer.shape[1:])
+        output = self.output[:n]
+        self.process(input_buffer, output)
+        return output
+
+    def advance_block(self, target_blocksize):
+        "Skip one output block without reading input, returning the number of source samples it would have consumed."
+        source_blocksize = self.get_source_blocksize(target_blocksize)
+        self.source_time += target_blocksize * self.sample_rate/self.target_rate - source_blocksize
+        return source_blocksize
+
+    def _read_positions(self, input_buffer, target_blocksize):
+        """Return the input preceded by the stored history, plus integer indices into it and fractional offsets
+        for each output sample. Advances the resampler's state past `input_buffer`."""
+        shape = input_buffer.shape[1:]
+        # Per-channel history, reset when the channel layout changes.
+        if self.last_samples.shape[1:] != shape:
+            self.last_samples = np.zeros((self.HISTORY,) + shape)
+        length = self.HISTORY + len(input_buffer)
+        if len(self.extended) < length or self.extended.shape[1:] != shape:
+            self.extended = np.zeros((length,) + shape)
+        # Prepending the history means reads from before the start of this block need no special cases.
+        extended = self.extended[:length]
+        extended[:self.HISTORY] = self.last_samples
+        extended[self.HISTORY:] = input_buffer
+        source_delta = self.sample_rate/self.target_rate
+        times = self.source_time + np.arange(target_blocksize) * source_delta
+        indices = np.floor(times).astype(int)
+        fracs = (times - indices).reshape((target_blocksize,) + (1,)*len(shape))
+        indices += self.HISTORY
+        self.source_time += target_blocksize * source_delta - len(input_buffer)
+        # NOTE: The [:] here is essential, as the underlying input_buffer may be modified later.
+        self.last_samples[:] = input_buffer[-self.HISTORY:]
+        return extended, indices, fracs
+
 
 class LinearResampler(Resampler):
     LOOKAHEAD = 1
     HISTORY = 2
     
     def process(self, input_buffer, output_buffer):
-        source_time = self.source_time
-        source_delta = self.sample_rate/self.target_rate
-        # print('before', len(input_buffer), source_time)
-        for i in range(len(output_buffer)):
-            si = math.floor(source_time)
-            if source_time >= 0:
-                y0 = input_buffer[si]
-                y1 = input_buffer[si + 1]
-            elif source_time >= -1:
-                y0 = self.last_samples[-1]
-                y1 = input_buffer[si + 1]
-            elif source_time >= -2:
-                y0 = self.last_samples[-2]
-                y1 = self.last_samples[-1]
-            else:
-                # Shouldn't happen; we only want to store two samples from history.
-                assert(False)
-            output_buffer[i] = y0 + (y1 - y0) * (source_time - si)
-            source_time += source_delta
-        # print('after', source_time, source_time - len(input_buffer))
-        source_time -= len(input_buffer)
-        self.source_time = source_time
-        # NOTE: The [:] here is essential, as the underlying input_buffer may be modified later.
         # NOTE: This assumes input_buffer and output_buffer are not the same buffer, which is probably safe for a resampler.
-        self.last_samples[:] = input_buffer[-2:]
+        extended, indices, fracs = self._read_positions(input_buffer, len(output_buffer))
+        y0 = extended[indices]
+        output_buffer[:] = y0 + (extended[indices + 1] - y0) * fracs
+
+class IdentityResampler(Resampler):
+    "Passes samples straight through, for when the internal and external rates match."
+    LOOKAHEAD = 0
+    HISTORY = 1
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.source_time = 0
+
+    def process(self, input_buffer, output_buffer):
+        output_buffer[:] = input_buffer
+        # Keep the last sample, for converting to a resampler that interpolates (see `convert`).
+        if self.last_samples.shape[1:] != input_buffer.shape[1:]:
+            self.last_samples = np.zeros((self.HISTORY,) + input_buffer.shape[1:])
+        self.last_samples[:] = input_buffer[-self.HISTORY:]
+
 
 def spline(y0, y1, y2, y3, x):
     a = y3 - y2 - y0 + y1
@@ -81,47 +146,6 @@ class CubicResampler(Resampler):
     HISTORY = 4
 
     def process(self, input_buffer, output_buffer):
-        _spline = spline
-        source_time = self.source_time
-        source_delta = self.sample_rate/self.target_rate
-        last_samples = self.last_samples
-        # print('before', len(input_buffer), len(output_buffer), source_time)
-        for i in range(len(output_buffer)):
-            si = math.floor(source_time)
-            if source_time >= 1:
-                y0 = input_buffer[si - 1]
-                y1 = input_buffer[si]
-                y2 = input_buffer[si + 1]
-                y3 = input_buffer[si + 2]
-            elif source_time >= 0:
-                y0 = last_samples[-1]
-                y1 = input_buffer[si]
-                y2 = input_buffer[si + 1]
-                y3 = input_buffer[si + 2]
-            elif source_time >= -1:
-                y0 = last_samples[-2]
-                y1 = last_samples[-1]
-                y2 = input_buffer[si + 1]
-                y3 = input_buffer[si + 2]
-            elif source_time >= -2:
-                y0 = last_samples[-3]
-                y1 = last_samples[-2]
-                y2 = last_samples[-1]
-                y3 = input_buffer[si + 2]
-            elif source_time >= -3:
-                y0 = last_samples[-4]
-                y1 = last_samples[-3]
-                y2 = last_samples[-2]
-                y3 = last_samples[-1]
-            else:
-                # Shouldn't happen; we only want to store four samples from history.
-                assert(False)
-            output_buffer[i] = _spline(y0, y1, y2, y3, source_time - si)
-            source_time += source_delta
-        # print("highest index was actually", si + 2)
-        # print('after', source_time, source_time - len(input_buffer))
-        source_time -= len(input_buffer)
-        self.source_time = source_time
-        # NOTE: The [:] here is essential, as the underlying input_buffer may be modified later.
         # NOTE: This assumes input_buffer and output_buffer are not the same buffer, which is probably safe for a resampler.
-        self.last_samples[:] = input_buffer[-4:]
+        extended, indices, fracs = self._read_positions(input_buffer, len(output_buffer))
+        output_buffer[:] = spline(extended[indices - 1], extended[indices], extended[indices + 1], extended[indices + 2], fracs)
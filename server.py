@@ -0,0 +1,324 @@
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+from main import SynthEngine
+import state
+
+
+NO_WORKERS = "No render workers could be started (see the server's output)."
+
+
+def worker(connection):
+    """Worker process: build an engine once, then render the jobs received on `connection` with it, resetting it to
+    its initial state between jobs. Events go back on the same connection."""
+    engine = SynthEngine()
+    baseline = engine.get_state()
+    connection.send((None, {"event": "ready", "pid": os.getpid()}))
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        job_id = job["id"]
+        connection.send((job_id, {"event": "started", "pid": os.getpid()}))
+        last = 0
+
+        def progress(fraction):
+            # Throttle progress messages to a few per second.
+            nonlocal last
+            now = time.time()
+            if fraction == 1 or now - last > 0.25:
+                last = now
+                connection.send((job_id, {"event": "progress", "fraction": round(fraction, 4)}))
+
+        start_time = time.time()
+        try:
+            engine.set_state(baseline)
+            if job.get("state"):
+                engine.set_state(state.load(job["state"]))
+            if job.get("samplerate") and job["samplerate"] != engine.samplerate:
+                engine.samplerate = job["samplerate"]
+            if "seed" in job:
+                engine.seed = job["seed"]
+            cached = engine.render_file(job["output"], job["duration"], midi_file=job.get("midi"), progress=progress)
+        except Exception as e:
+            connection.send((job_id, {"event": "error", "message": f"{type(e).__name__}: {e}"}))
+            continue
+        connection.send((job_id, {"event": "done", "output": job["output"], "cached": cached, "seconds": time.time() - start_time}))
+
+
+class RenderServer:
+    """Queue of render jobs, run by a pool of worker processes that each keep a warm (pre-built) engine.
+
+    Jobs are dicts with "duration" (seconds) and "output" (WAV path), and optionally "state" (a snapshot saved
+    with `save`), "midi" (MIDI file path), "samplerate" and "seed" (see `SynthEngine.seed`; workers are otherwise
+    seeded differently, so only seeded jobs are repeatable across workers). Paths are resolved by the server.
+
+    Each worker has its own pipe, and is sent a job only when idle, so a worker that dies (e.g. crashes in native
+    code, or is killed) takes down only its own job: that job fails if the worker had started it (or is sent to
+    another worker if not), and the worker is replaced. Until a worker has reported ready, dead workers are not
+    replaced, as the engine probably can't be built; if they all die, queued jobs fail and new ones are refused."""
+
+    def __init__(self, workers):
+        self.context = multiprocessing.get_context("spawn")
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # Job id -> (callback for its events, job).
+        self.pending = {}
+        # Jobs not yet sent to a worker.
+        self.backlog = collections.deque()
+        # Connection to each worker -> its process, and (once it's ready) -> the id of the job it's running, or None.
+        self.workers = {}
+        self.running = {}
+        # Whether any worker has reported ready, and whether they all died before one did.
+        self.started = False
+        self.broken = False
+        self.closing = False
+        self.started_time = time.time()
+        self.metrics = {"workers": workers, "ready": 0, "queued": 0, "running": 0, "done": 0, "cached": 0, "failed": 0,
+                        "restarts": 0, "audio_seconds": 0.0, "busy_seconds": 0.0}
+        for _ in range(workers):
+            self.spawn()
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def spawn(self):
+        connection, child = self.context.Pipe()
+        process = self.context.Process(target=worker, args=(child,), daemon=True)
+        process.start()
+        # Only the worker keeps its end, so the pipe breaks when it dies.
+        child.close()
+        self.workers[connection] = process
+
+    def submit(self, job, send):
+        "Queue a job; its events are passed to `send`. Returns the job id."
+        missing = [field for field in ("duration", "output") if field not in job]
+        if missing:
+            raise ValueError(f"Missing {', '.join(missing)}.")
+        for field in ("state", "midi"):
+            if job.get(field) and not os.path.exists(job[field]):
+                raise ValueError(f"No {field} file '{job[field]}'.")
+        job = dict(job, id=next(self.ids), duration=float(job["duration"]), output=os.path.abspath(job["output"]))
+        with self.lock:
+            if self.broken:
+                raise ValueError(NO_WORKERS)
+            self.pending[job["id"]] = (send, job)
+            self.metrics["queued"] += 1
+            position = self.metrics["queued"]
+        send({"event": "queued", "id": job["id"], "position": position})
+        with self.lock:
+            # (Unless it already failed, as no worker could start.)
+            if job["id"] in self.pending:
+                self.backlog.append(job)
+                self.assign()
+        return job["id"]
+
+    def assign(self):
+        "Send queued jobs to idle workers. (Called with the lock held.)"
+        for connection, job_id in self.running.items():
+            if not self.backlog or self.closing:
+                return
+            if job_id is None:
+                job = self.backlog.popleft()
+                try:
+                    connection.send(job)
+                except OSError:
+                    # The worker just died; `dispatch` will replace it.
+                    self.backlog.appendleft(job)
+                    continue
+                self.running[connection] = job["id"]
+                self.metrics["queued"] -= 1
+                self.metrics["running"] += 1
+
+    def dispatch(self):
+        "Route events from the workers to the clients that submitted the jobs, updating the metrics, and replace dead workers."
+        while True:
+            with self.lock:
+                if not self.workers:
+                    return
+                sentinels = {process.sentinel: connection for connection, process in self.workers.items()}
+            for ready in multiprocessing.connection.wait(list(sentinels.values()) + list(sentinels)):
+                if ready in sentinels:
+                    connection = sentinels[ready]
+                    # Deliver whatever the worker sent before it died.
+                    while self.receive(connection):
+                        pass
+                    self.lost(connection)
+                elif not ready.closed:
+                    self.receive(ready)
+
+    def receive(self, connection):
+        "Handle one event from a worker, if there is one; returns False once it has none (or has died)."
+        try:
+            if not connection.poll():
+                return False
+            job_id, event = connection.recv()
+        except (EOFError, OSError):
+            return False
+        with self.lock:
+            if job_id is None:
+                self.running[connection] = None
+                self.started = True
+                self.metrics["ready"] += 1
+                self.assign()
+                return True
+            send, job = self.pending[job_id]
+            kind = event["event"]
+            if kind == "started":
+                job["started"] = True
+            elif kind in ("done", "error"):
+                del self.pending[job_id]
+                self.running[connection] = None
+                self.metrics["running"] -= 1
+                if kind == "error":
+                    self.metrics["failed"] += 1
+                else:
+                    self.metrics["done"] += 1
+                    self.metrics["cached"] += event["cached"]
+                    self.metrics["audio_seconds"] += job["duration"]
+                    self.metrics["busy_seconds"] += event["seconds"]
+                self.assign()
+        send(dict(event, id=job_id))
+        return True
+
+    def lost(self, connection):
+        "Clean up after a worker that exited: fail its job, and replace it (unless shutting down, or none ever started)."
+        failed = []
+        with self.lock:
+            process = self.workers.pop(connection)
+            connection.close()
+            process.join()
+            message = f"Render worker {process.pid} died (exit code {process.exitcode})."
+            if connection in self.running:
+                self.metrics["ready"] -= 1
+                job_id = self.running.pop(connection)
+                if job_id is not None:
+                    self.metrics["running"] -= 1
+                    job = self.pending[job_id][1]
+                    if job.get("started"):
+                        failed.append((job_id, message))
+                    else:
+                        # It died before it began the job, so the job goes to another worker.
+                        self.backlog.appendleft(job)
+                        self.metrics["queued"] += 1
+                        self.assign()
+            if not self.closing:
+                print(message)
+                if self.started:
+                    self.spawn()
+                    self.metrics["restarts"] += 1
+                elif not self.workers:
+                    print("No render worker started; refusing jobs.")
+                    self.broken = True
+                    # Nothing has run, so every pending job is queued.
+                    failed += [(job_id, NO_WORKERS) for job_id in self.pending]
+                    self.metrics["queued"] -= len(self.pending)
+                    self.backlog.clear()
+            self.metrics["failed"] += len(failed)
+            failed = [(self.pending.pop(job_id)[0], job_id, message) for job_id, message in failed]
+        for send, job_id, message in failed:
+            send({"event": "error", "id": job_id, "message": message})
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        uptime = time.time() - self.started_time
+        metrics["uptime"] = uptime
+        # Seconds of audio rendered per second, overall and per busy worker.
+        metrics["throughput"] = metrics["audio_seconds"] / uptime
+        metrics["speed"] = metrics["audio_seconds"] / metrics["busy_seconds"] if metrics["busy_seconds"] else None
+        return metrics
+
+    def close(self):
+        with self.lock:
+            # Workers exiting now are not replaced.
+            self.closing = True
+            workers = list(self.workers.items())
+        for connection, _ in workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for _, process in workers:
+            process.join()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    "One client connection: JSON requests in, JSON events out, one object per line."
+
+    def handle(self):
+        self.write_lock = threading.Lock()
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                kind = request.pop("type", "render")
+                if kind == "render":
+                    self.server.render_server.submit(request, self.send)
+                elif kind == "metrics":
+                    self.send(dict(self.server.render_server.get_metrics(), event="metrics"))
+                else:
+                    raise ValueError(f"Unknown request type '{kind}'.")
+            except (ValueError, TypeError, AttributeError) as e:
+                self.send({"event": "error", "message": str(e)})
+
+    def send(self, message):
+        with self.write_lock:
+            try:
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+                self.wfile.flush()
+            except (OSError, ValueError):
+                # The client went away; the job still runs (and its render is cached).
+                pass
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local render server: accepts JSON render jobs over a socket.")
+    parser.add_argument("--socket", default="synth.sock", help="Unix socket path (default: synth.sock)")
+    parser.add_argument("--port", type=int, help="listen on this TCP port on localhost instead of a Unix socket")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    render_server = RenderServer(args.workers)
+    if args.port:
+        server = TCPServer(("127.0.0.1", args.port), Handler)
+        address = f"127.0.0.1:{args.port}"
+    else:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixServer(args.socket, Handler)
+        address = args.socket
+    server.render_server = render_server
+    # Shut down cleanly (removing the socket) when terminated, too.
+    signal.signal(signal.SIGTERM, lambda *ignored: sys.exit(0))
+    print(f"Serving on {address} with {args.workers} workers.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        render_server.close()
+        if not args.port:
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import json
+import mmap
+import struct
+
+import numpy as np
+
+
+# Layout: MAGIC, header length (little-endian uint64), JSON header, then the raw bytes of each array,
+# aligned to ALIGNMENT. The header is the state tree with arrays replaced by {"ndarray": [offset, dtype, shape]}.
+MAGIC = b"SYNSTATE"
+ALIGNMENT = 64
+
+
+def _padding(length):
+    return b"\0" * (-length % ALIGNMENT)
+
+
+def pack(state):
+    "Serialize a state tree to a list of buffers to write in order. Array data is passed as memoryviews, without copying."
+    arrays = []
+
+    def encode(value):
+        if isinstance(value, np.ndarray):
+            # NOTE: Not np.ascontiguousarray, which turns 0-d arrays (e.g. SVF state) into 1-d ones.
+            value = value if value.flags.c_contiguous else value.copy(order="C")
+            descriptor = [None, value.dtype.str, list(value.shape)]
+            arrays.append((descriptor, value))
+            return {"ndarray": descriptor}
+        if isinstance(value, dict):
+            return {str(k): encode(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(v) for v in value]
+        return value
+
+    tree = encode(state)
+    offset = 0
+    for descriptor, array in arrays:
+        offset += -offset % ALIGNMENT
+        descriptor[0] = offset
+        offset += array.nbytes
+    header = json.dumps(tree).encode()
+    prefix = MAGIC + struct.pack("<Q", len(header)) + header
+    buffers = [prefix + _padding(len(prefix))]
+    offset = 0
+    for descriptor, array in arrays:
+        if descriptor[0] > offset:
+            buffers.append(b"\0" * (descriptor[0] - offset))
+        buffers.append(memoryview(array.reshape(-1).view(np.uint8)))
+        offset = descriptor[0] + array.nbytes
+    return buffers
+
+
+def unpack(buffer):
+    "Deserialize a packed state. Arrays are read-only views into `buffer`, not copies."
+    buffer = memoryview(buffer)
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a state snapshot.")
+    (length,) = struct.unpack("<Q", buffer[len(MAGIC):len(MAGIC) + 8])
+    start = len(MAGIC) + 8
+    tree = json.loads(bytes(buffer[start:start + length]))
+    data = start + length
+    data += -data % ALIGNMENT
+
+    def decode(value):
+        if isinstance(value, dict):
+            if "ndarray" in value:
+                offset, dtype, shape = value["ndarray"]
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape))
+                array = np.frombuffer(buffer, dtype, count, data + offset) if count else np.zeros(0, dtype)
+                array.flags.writeable = False
+                return array.reshape(shape)
+            return {k: decode(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        return value
+
+    return decode(tree)
+
+
+def write(state, f):
+    for buffer in pack(state):
+        f.write(buffer)
+
+
+def save(state, filename):
+    with open(filename, "wb") as f:
+        write(state, f)
+
+
+def load(filename):
+    "Load a state snapshot, with arrays mapped straight from the file."
+    with open(filename, "rb") as f:
+        return unpack(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
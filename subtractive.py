@@ -1,53 +1,179 @@
+import functools
+
 import numpy as np
+from scipy import signal
 
-from module import Module
+from module import Module, control
 from filter import StateVariableFilter
 
 
 class AdditiveSynth(Module):
-    def __init__(self, sample_rate, coefficients):
-        "Coefficients is a list of (freq, amplitude) pairs."
+    def __init__(self, sample_rate, coefficients, limit=None):
+        """Coefficients is a list (or an array) of (freq, amplitude) pairs.
+
+        If `limit` is set, only the first `limit` pairs are synthesized."""
         super().__init__(sample_rate)
         self.phase = 0
         self.coefficients = coefficients
-        self.freqs = np.array([c[0] for c in coefficients])[:,None]
-        self.amps = np.array([c[1] for c in coefficients])[:,None]
+        coefficients = np.asarray(coefficients, dtype=float).reshape(-1, 2)
+        self.freqs = coefficients[:, 0, None]
+        self.amps = coefficients[:, 1, None]
+        self.limit = limit
+        # Number of partials synthesized in the last block.
+        self.count = len(self.freqs) if limit is None else min(limit, len(self.freqs))
     
     def process(self, input_buffer, output_buffer):
         # for freq, amplitude in self.coefficients:
             # output_buffer[:,0] += amplitude * np.sin(2*np.pi*freq*np.arange(len(output_buffer))/self.sample_rate + self.phase*freq)
-        output_buffer[:] = np.sum(self.amps * np.sin(2*np.pi*self.freqs*np.arange(len(output_buffer))/self.sample_rate + self.phase*self.freqs), axis=0)
+        n = len(output_buffer)
+        count = len(self.freqs) if self.limit is None else min(self.limit, len(self.freqs))
+        top = max(count, self.count)
+        freqs, amps = self.freqs[:top], self.amps[:top]
+        partials = amps * np.sin(2*np.pi*freqs*np.arange(n)/self.sample_rate + self.phase*freqs)
+        if count != self.count:
+            # Fade the partials dropped (or added) by a change of `limit` over this block, so it doesn't click.
+            bottom = min(count, self.count)
+            partials[bottom:] *= np.linspace(1, 0, n) if count < self.count else np.linspace(0, 1, n)
+            self.count = count
+        mono = np.sum(partials, axis=0)
+        output_buffer[:] = control(mono, output_buffer.shape)
         self.phase += 2*np.pi*len(output_buffer)/self.sample_rate
         self.phase %= 2*np.pi
 
+    def advance(self, n, channels):
+        self.phase += 2*np.pi*n/self.sample_rate
+        self.phase %= 2*np.pi
+
 
 class NoiseSource(Module):
-    def __init__(self, sample_rate):
+    "Seeded white, pink or brown noise, generated in place."
+
+    PARAMETERS = ("color", "seed")
+    # Colored noise is white noise through a small IIR filter: (numerator, denominator).
+    # Pink: Julius O. Smith's -3dB/octave approximation; brown: a leaky integrator.
+    # Gains keep the RMS level near 0.25, so peaks stay around +/-1.
+    FILTERS = {
+        "pink": (5 * np.array([0.049922035, -0.095993537, 0.050612699, -0.004408786]),
+                 np.array([1, -2.494956002, 2.017265875, -0.522189400])),
+        "brown": (np.array([0.04]), np.array([1, -0.995])),
+    }
+
+    def __init__(self, sample_rate, color="white", seed=None):
         super().__init__(sample_rate)
-    
+        self.color = color
+        self.seed = seed
+
+    @property
+    def seed(self):
+        return self._seed
+
+    @seed.setter
+    def seed(self, value):
+        # NOTE: Setting the seed (even to the same value) restarts the sequence, so renders can be repeated exactly.
+        self._seed = value
+        self.rng = np.random.default_rng(value)
+        self.state = None
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, value):
+        if value != "white" and value not in self.FILTERS:
+            raise ValueError(f"Unknown noise color '{value}'.")
+        self._color = value
+        self.state = None
+
+    def advance(self, n, channels):
+        # Skip the draws `process` would make (one per sample and channel).
+        self.rng.bit_generator.advance(n * channels)
+
     def process(self, input_buffer, output_buffer):
-        output_buffer[:] = np.random.uniform(-1, 1, output_buffer.shape)
+        if output_buffer.flags.c_contiguous:
+            self.rng.random(out=output_buffer)
+        else:
+            output_buffer[:] = self.rng.random(output_buffer.shape)
+        output_buffer *= 2
+        output_buffer -= 1
+        if self._color in self.FILTERS:
+            b, a = self.FILTERS[self._color]
+            # Filter state per channel, reset when the color or channel layout changes.
+            if self.state is None or self.state.shape[1:] != output_buffer.shape[1:]:
+                self.state = np.zeros((len(a) - 1,) + output_buffer.shape[1:])
+            output_buffer[:], self.state = signal.lfilter(b, a, output_buffer, axis=0, zi=self.state)
+
+
+@functools.lru_cache(maxsize=256)
+def _harmonics(waveform, freq, sample_rate):
+    # NOTE: Cheap to rebuild, and set from the audio thread (e.g. by OSC), so not worth a trip to the disk cache.
+    if waveform == "sawtooth":
+        table = [(k*freq, 2/np.pi*(-1)**k/k) for k in range(1, int(sample_rate/2/freq)+1)]
+    else:
+        table = [(k*freq, 4/np.pi/k) for k in range(1, int(sample_rate/2/freq)+1, 2)]
+    table = np.array(table, dtype=float).reshape(-1, 2)
+    # Shared between callers via the cache.
+    table.flags.writeable = False
+    return table
 
 
 class SubtractiveSynth(Module):
-    "Various sources with many harmonics (sawtooth, square, noise) + a built-in low-pass filter."
+    "Various sources with many harmonics (sawtooth, square, white/pink/brown noise) + a built-in low-pass filter."
 
-    PARAMETERS = ("freq", "source", "lpf")
+    PARAMETERS = ("freq", "source", "seed", "max_harmonics", "lpf")
+    # (A new pitch rebuilds the harmonic tables.)
+    SLOW_PARAMETERS = ("freq",)
+    IN_PLACE = True
 
-    def __init__(self, sample_rate, freq=55, source="sawtooth"):
+    def __init__(self, sample_rate, freq=55, source="sawtooth", seed=None, max_harmonics=None):
         super().__init__(sample_rate)
+        # Cap on the partials of the sawtooth and square waves (None for all up to Nyquist), to save CPU.
+        self.max_harmonics = max_harmonics
+        # NOTE: Noise sources don't depend on freq, so they are built once (and keep their generator state).
+        self.noise_sources = {
+            "noise": NoiseSource(sample_rate, "white", seed),
+            "pink": NoiseSource(sample_rate, "pink", seed),
+            "brown": NoiseSource(sample_rate, "brown", seed),
+        }
         self.freq = freq
-        self.source = source  # options: "sawtooth", "square", "noise"
+        self.source = source  # options: "sawtooth", "square", "noise", "pink", "brown"
         self.lpf = StateVariableFilter(sample_rate, freq*10, 1.0)
     
     def __setattr__(self, name, value):
         super().__setattr__(name, value)
         if name == 'freq':
             self.sources = {
-                "sawtooth": AdditiveSynth(self.sample_rate, [(k*self.freq, 2/np.pi*(-1)**k/k) for k in range(1, int(self.sample_rate/2/self.freq)+1)]),
-                "square": AdditiveSynth(self.sample_rate, [(k*self.freq, 4/np.pi/k) for k in range(1, int(self.sample_rate/2/self.freq)+1, 2)]),
-                "noise": NoiseSource(self.sample_rate),
+                "sawtooth": AdditiveSynth(self.sample_rate, self._harmonics("sawtooth"), self.max_harmonics),
+                "square": AdditiveSynth(self.sample_rate, self._harmonics("square"), self.max_harmonics),
+                **self.noise_sources,
             }
+        elif name == 'max_harmonics' and hasattr(self, 'sources'):
+            self.sources["sawtooth"].limit = value
+            self.sources["square"].limit = value
+
+    def set_sample_rate(self, sample_rate):
+        super().set_sample_rate(sample_rate)
+        # The harmonic tables stop at Nyquist, so they are rebuilt, carrying on from the oscillators' phase.
+        phases = {name: self.sources[name].phase for name in ("sawtooth", "square")}
+        self.freq = self.freq
+        for name, phase in phases.items():
+            self.sources[name].phase = phase
+
+    def _harmonics(self, waveform):
+        "Table of (freq, amplitude) pairs for the band-limited waveform, cached in memory."
+        return _harmonics(waveform, float(self.freq), float(self.sample_rate))
+
+    @property
+    def seed(self):
+        return self.noise_sources["noise"].seed
+
+    @seed.setter
+    def seed(self, value):
+        for source in self.noise_sources.values():
+            source.seed = value
+
+    def advance(self, n, channels):
+        self.sources[self.source].advance(n, channels)
 
     def process(self, input_buffer, output_buffer):
         self.sources[self.source].process(input_buffer, output_buffer)
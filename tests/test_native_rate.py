@@ -0,0 +1,135 @@
+import wave
+
+import numpy as np
+import pytest
+from scipy.io import wavfile
+
+import cache
+from main import INTERNAL_SAMPLERATE, SynthEngine
+from module import current
+from resample import IdentityResampler
+
+RATES = (22050, 32000, 44100, 48000, 96000)
+FREQ = 220
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    # The granular source loads example.wav from the working directory.
+    monkeypatch.chdir(tmp_path)
+    noise = np.random.default_rng(0).uniform(-0.5, 0.5, (4800, 2))
+    wavfile.write("example.wav", 48000, (noise * 32767).astype(np.int16))
+    monkeypatch.setattr(cache.cache, "enabled", False)
+    monkeypatch.setattr(cache.renders, "enabled", False)
+    engine = SynthEngine()
+    engine.subtractive.freq = FREQ
+    return engine
+
+
+def configure(engine, rate, native):
+    engine.samplerate = rate
+    engine.native = native
+
+
+def fundamental(samples, rate):
+    "Frequency of the strongest spectral peak, interpolated between bins."
+    padded = len(samples) * 8
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples)), padded))
+    peak = np.argmax(spectrum)
+    alpha, beta, gamma = np.log(spectrum[peak - 1:peak + 2])
+    offset = (alpha - gamma) / (alpha - 2*beta + gamma) / 2
+    return (peak + offset) * rate / padded
+
+
+@pytest.mark.parametrize("rate", RATES)
+def test_native_mode_runs_at_the_device_rate(engine, rate):
+    configure(engine, rate, True)
+    assert engine.internal_samplerate == rate
+    assert isinstance(engine.resampler, IdentityResampler)
+    for name, module in engine.modules.items():
+        if module is not engine and module.sample_rate is not None:
+            assert module.sample_rate == rate, name
+
+
+@pytest.mark.parametrize("rate", RATES)
+def test_resampled_mode_passes_through_only_at_the_internal_rate(engine, rate):
+    configure(engine, rate, False)
+    assert engine.internal_samplerate == INTERNAL_SAMPLERATE
+    assert isinstance(engine.resampler, IdentityResampler) == (rate == INTERNAL_SAMPLERATE)
+
+
+@pytest.mark.parametrize("native", (True, False))
+@pytest.mark.parametrize("rate", RATES)
+def test_render_length_and_pitch(engine, rate, native):
+    configure(engine, rate, native)
+    duration = 0.5
+    engine.render_file("out.wav", duration, progress=lambda fraction: None)
+    with wave.open("out.wav") as w:
+        assert w.getframerate() == rate
+        assert w.getnframes() == int(duration * rate)
+        samples = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2') / 2**15
+    assert fundamental(samples, rate) == pytest.approx(FREQ, rel=0.005)
+
+
+# Settings in seconds and Hz are set before the rate changes, so these check that modules convert them.
+
+@pytest.mark.parametrize("rate", RATES)
+def test_delay_time(engine, rate):
+    delay = engine.modules["delay"]
+    delay.preset = "slapback"
+    delay.fixed_delay = 0.01
+    configure(engine, rate, True)
+    n = int(0.05 * rate)
+    impulse, output = np.zeros((n, 1)), np.zeros((n, 1))
+    impulse[0] = 1
+    delay.process(impulse, output)
+    # Fractional delays are interpolated between two samples, so the centroid is the delay.
+    assert np.sum(np.arange(n) * output[:, 0]) / np.sum(output) == pytest.approx(0.01 * rate)
+
+
+@pytest.mark.parametrize("rate", RATES)
+def test_filter_peaks(engine, rate):
+    # A high resonance puts the state variable filter's peak at its frequency.
+    bank = engine.modules["bank"]
+    bank.resonance = 20
+    bpf = engine.modules["autowah"].bpf
+    bpf.freq = 1000
+    bpf.resonance = 20
+    configure(engine, rate, True)
+    bank.mix = 1
+    for k, freq in enumerate(bank.freqs):
+        bank.gains = [float(j == k) for j in range(len(bank.freqs))]
+        freqs, magnitude, _ = bank.frequency_response(2**16)
+        assert freqs[np.argmax(magnitude)] == pytest.approx(freq, rel=0.02)
+    freqs, magnitude, _ = bpf.frequency_response(2**16)
+    assert freqs[np.argmax(magnitude)] == pytest.approx(1000, rel=0.02)
+
+
+@pytest.mark.parametrize("rate", RATES)
+def test_lfo_period(engine, rate):
+    tremolo = engine.modules["tremolo"]
+    configure(engine, rate, True)
+    wave = tremolo.lfo.process(rate).copy()
+    # Upward zero crossings, interpolated between samples.
+    up = np.flatnonzero((wave[:-1] < 0) & (wave[1:] >= 0))
+    crossings = up - wave[up] / (wave[up + 1] - wave[up])
+    assert np.mean(np.diff(crossings)) / rate == pytest.approx(1 / tremolo.rate, rel=1e-4)
+
+
+@pytest.mark.parametrize("native", (True, False))
+@pytest.mark.parametrize("rate", RATES)
+def test_ramp_across_native_switch(engine, rate, native):
+    configure(engine, rate, native)
+    engine.blocksize = 64
+    engine.automation.ramp("tremolo.amp", 0.2, 1.0)
+    outdata = np.zeros((engine.blocksize, 1))
+    frames = 0
+    while engine.automation.active():
+        if frames == 64 * (rate // 4 // 64):
+            # Switch a quarter of the way through.
+            engine.native = not native
+        engine.synthesize(outdata)
+        frames += len(outdata)
+    assert current(engine.modules["tremolo"].amp) == 0.2
+    # Within a couple of blocks (the resampler reads a little ahead).
+    assert frames / rate == pytest.approx(1.0, abs=2 * 64 / rate)
@@ -1,21 +1,48 @@
 import numpy as np
 
-from module import Module
+from lfo import LFO
+from module import Module, control
 
 
 class Tremolo(Module):
 
-    PARAMETERS = ("rate", "amp", "mix")
+    PARAMETERS = ("rate", "amp", "lfo", "mix")
+    SIGNAL_PARAMETERS = ("rate", "amp", "mix")
+    BATCH_PARAMETERS = ("rate", "amp", "mix")
+    IN_PLACE = True
 
     def __init__(self, sample_rate, rate=8, amp=0.73):
         super().__init__(sample_rate)
-        self.rate = rate
+        self.lfo = LFO(sample_rate, rate)
         self.amp = amp
-        self.phase = 0
+
+    @property
+    def rate(self):
+        return self.lfo.rate
+
+    @rate.setter
+    def rate(self, value):
+        self.lfo.rate = value
+
+    def advance(self, n, channels):
+        self.lfo.advance(n)
+
+    def at_rest(self):
+        return True
 
     def process(self, input_buffer, output_buffer):
-        t = np.arange(len(input_buffer))/self.sample_rate
-        # Amplitude varies from (1 - amp) to 1.
-        amp = np.sin(2*np.pi*self.rate*t + self.phase) * self.amp / 2 + (1 - self.amp / 2)
-        output_buffer[:] = input_buffer * amp
-        self.phase = (self.phase + 2*np.pi*self.rate*len(input_buffer)/self.sample_rate) % (2*np.pi)
\ No newline at end of file
+        self.process_mixed(input_buffer, output_buffer, 1)
+
+    def process_mixed(self, input_buffer, output_buffer, mix):
+        "Apply the tremolo crossfaded with the dry input, folding `mix` into the depth."
+        gain = self.lfo.process(len(input_buffer), input_buffer.shape[1:])
+        if np.ndim(self.amp) == 2 or np.ndim(mix) == 2:
+            # Per-channel depth: the gain needs a column per channel, even if the LFO doesn't.
+            gain = control(gain, input_buffer.shape).copy()
+        # Amplitude varies from (1 - amp) to 1; the dry/wet mix scales the depth the same way.
+        amp = control(self.amp, gain.shape)
+        if np.ndim(mix) or mix != 1:
+            amp = amp * control(mix, gain.shape)
+        gain *= amp / 2
+        gain += 1 - amp / 2
+        np.multiply(input_buffer, control(gain, input_buffer.shape), out=output_buffer)
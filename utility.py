@@ -1,17 +1,57 @@
-import matplotlib.pyplot as plt
+import functools
+import json
+
 import numpy as np
+from scipy import signal
+
+
+@functools.lru_cache(maxsize=256)
+def _response(b, a, sample_rate, points):
+    w, h = signal.freqz(b, a, worN=points)
+    response = (w * sample_rate / (2 * np.pi), np.abs(h), np.angle(h))
+    for array in response:
+        # Shared between callers via the cache.
+        array.flags.writeable = False
+    return response
+
+
+def frequency_response(b, a, sample_rate, points=2048, mix=1):
+    """Frequency response of the transfer function b(z)/a(z), crossfaded with the dry signal by `mix`, at `points`
+    frequencies from 0 up to Nyquist.
+
+    Returns (frequencies in Hz, magnitude, phase in radians), cached per set of coefficients."""
+    b, a = np.ravel(b).astype(float), np.ravel(a).astype(float)
+    if mix != 1:
+        # mix * b/a + (1 - mix) = (mix * b + (1 - mix) * a) / a
+        length = max(len(b), len(a))
+        b = mix * np.pad(b, (0, length - len(b))) + (1 - mix) * np.pad(a, (0, length - len(a)))
+    return _response(tuple(b.tolist()), tuple(a.tolist()), float(sample_rate), int(points))
+
+
+def export_response(response, filename):
+    "Write a frequency response to a .json ({freqs, magnitude, phase} lists) or .npy ((3, points) array) file."
+    if filename.endswith(".npy"):
+        np.save(filename, np.stack(response))
+    else:
+        with open(filename, "w") as f:
+            json.dump(dict(zip(("freqs", "magnitude", "phase"), (array.tolist() for array in response))), f)
+
 
 # SOURCE: https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.remez.html
-def plot_response(fs, w, h, title):
+def plot_response(response, title):
     "Utility function to plot response functions"
+    # NOTE: Imported here, so computing responses doesn't need matplotlib (or a display).
+    import matplotlib.pyplot as plt
 
+    freqs, magnitude, _ = response
     fig = plt.figure()
     ax = fig.add_subplot(111)
-    ax.plot(0.5*fs*w/np.pi, 20*np.log10(np.abs(h)))
+    with np.errstate(divide='ignore'):
+        ax.plot(freqs, 20*np.log10(magnitude))
     ax.set_ylim(-40, 5)
-    ax.set_xlim(0, 0.5*fs)
+    ax.set_xlim(0, freqs[-1])
     ax.grid(True)
     ax.set_xlabel('Frequency (Hz)')
     ax.set_ylabel('Gain (dB)')
     ax.set_title(title)
-    plt.show(block=False)
\ No newline at end of file
+    plt.show(block=False)
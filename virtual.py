@@ -0,0 +1,195 @@
+import argparse
+import ast
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+def parse_value(text):
+    "An OSC-style argument from a script: a Python literal, or else a string."
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def load_script(filename):
+    """Timed control events from a script, one per line: `<seconds> /<module>/<param> <values...>` (an OSC message)
+    or `<seconds> note <pitch> <velocity>` (a MIDI note). Blank lines and `#` comments are skipped.
+
+    Returns (seconds, address, values) tuples, in time order."""
+    events = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            seconds, address, *values = line.split()
+            if not (address.startswith("/") or address == "note" and len(values) == 2):
+                raise ValueError(f"{filename}:{number}: expected '<seconds> /<module>/<param> <values...>' or '<seconds> note <pitch> <velocity>'.")
+            events.append((float(seconds), address, [parse_value(value) for value in values]))
+    return sorted(events, key=lambda event: event[0])
+
+
+def inject(engine, address, values):
+    "Deliver a script event as the engine's OSC server or MIDI input would."
+    if address == "note":
+        engine.handle_midi(*values)
+    else:
+        engine.osc_control.receive(address.encode(), *values)
+
+
+def percentiles(values, scale=1000):
+    "Median, 99th percentile and maximum, scaled (by default, seconds to ms)."
+    if not len(values):
+        return "none"
+    values = np.asarray(values) * scale
+    return f"median {np.median(values):.2f}, 99th percentile {np.percentile(values, 99):.2f}, max {values.max():.2f}"
+
+
+class VirtualStream:
+    """Stands in for a sounddevice OutputStream with no audio hardware, for load testing on headless machines.
+
+    A thread of its own requests a block every blocksize / samplerate seconds, as a device would, and calls
+    `callback(outdata, frames, time, status)` for it. The block must be ready by the next request: a callback that
+    finishes later is an underrun (a dropout on a real device), after which the schedule carries on from then.
+
+    `script` events (see `load_script`) are taken off the list and passed to `inject(address, values)` before the
+    first block requested at or after their time, so a run applies them at the same points in the output however it
+    is timed. Their control latency is measured from their time in the script until the block that applied them was
+    ready. The output starts at `start_time` seconds into the script (where a stream being replaced left off)."""
+
+    def __init__(self, callback, samplerate, blocksize, channels=1, script=None, inject=None, start_time=0, finished_callback=None, **ignored):
+        self.callback = callback
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.channels = channels
+        self.script = [] if script is None else script
+        self.inject = inject
+        self.start_time = start_time
+        self.finished_callback = finished_callback
+        self.thread = None
+        self.running = False
+        self.outdata = np.zeros((blocksize, channels))
+        self.blocks = 0
+        self.underruns = 0
+        # Seconds each callback ran, and from each block's request until it was ready.
+        self.elapsed = []
+        self.latency = []
+        self.control_latency = []
+
+    @property
+    def period(self):
+        return self.blocksize / self.samplerate
+
+    @property
+    def time(self):
+        "Seconds into the script of the next block."
+        return self.start_time + self.blocks * self.period
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="virtual", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def close(self):
+        self.stop()
+
+    def run(self):
+        period, script = self.period, self.script
+        request = time.perf_counter()
+        # Wall-clock time of the script's start.
+        epoch = request - self.start_time
+        applied = []
+        while self.running:
+            delay = request - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # Events up to this block's request, in output time: like messages that arrived by then.
+            while script and script[0][0] <= self.time:
+                seconds, address, values = script.pop(0)
+                self.inject(address, values)
+                applied.append(seconds)
+            start = time.perf_counter()
+            self.callback(self.outdata, self.blocksize, None, None)
+            ready = time.perf_counter()
+            if not self.running:
+                break
+            self.elapsed.append(ready - start)
+            self.latency.append(ready - request)
+            self.control_latency += [ready - (epoch + seconds) for seconds in applied]
+            applied.clear()
+            self.blocks += 1
+            request += period
+            if ready > request:
+                self.underruns += 1
+                # The device played a gap; the next block is requested now.
+                epoch += ready - request
+                request = ready
+
+    def info(self):
+        load = np.mean(self.elapsed) / self.period * 100 if self.elapsed else 0
+        return (f"Virtual device: {self.blocks} blocks of {self.blocksize} frames at {self.samplerate} Hz, "
+                f"{self.underruns} underruns, {load:.0f}% average load.")
+
+    def report(self):
+        "Summary of the run so far: underruns and the distributions of callback time and latency."
+        return "\n".join([
+            self.info(),
+            f"  Callback time (ms): {percentiles(self.elapsed)} (deadline {self.period * 1000:.2f}).",
+            f"  Block latency, request to ready (ms): {percentiles(self.latency)}.",
+            f"  Control latency, script time to applied (ms): {percentiles(self.control_latency)} "
+            f"({len(self.control_latency)} events).",
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the engine on a simulated audio device, in real time, and report underruns and latency.")
+    parser.add_argument("script", nargs="?", help="timed OSC messages and notes to inject (see `load_script`)")
+    parser.add_argument("--midi", help="MIDI file whose notes are injected too")
+    parser.add_argument("--samplerate", type=int, default=44100)
+    parser.add_argument("--blocksize", type=int, default=2048)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=10, help="length of the run (default: 10)")
+    parser.add_argument("--state", help="snapshot to load first (see `save`)")
+    parser.add_argument("--quality", default="auto", help="quality tier to pin, or auto (default)")
+    parser.add_argument("--max-underruns", type=int, help="exit with status 1 if there are more underruns than this")
+    args = parser.parse_args()
+    # Imported here, as main imports this module.
+    from main import SynthEngine, midi_events
+    import state
+    engine = SynthEngine()
+    if args.state:
+        engine.set_state(state.load(args.state))
+    engine.samplerate = args.samplerate
+    engine.blocksize = args.blocksize
+    engine.channels = args.channels
+    engine.quality.set_mode(args.quality if args.quality == "auto" else int(args.quality))
+    script = load_script(args.script) if args.script else []
+    if args.midi:
+        engine.envelope.mix = 1
+        script = sorted(script + [(seconds, "note", [note, velocity]) for seconds, note, velocity in midi_events(args.midi)], key=lambda event: event[0])
+    engine.virtual_script = script
+    engine.start_stream("virtual")
+    try:
+        time.sleep(args.seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # (A change of sample rate or block size in the script replaces the stream.)
+        stream = engine.stream
+        engine.stop_stream()
+    print(stream.report())
+    if args.max_underruns is not None and stream.underruns > args.max_underruns:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
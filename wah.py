@@ -1,70 +1,67 @@
 import numpy as np
 
-from module import Module
+from filter import StateVariableFilter
+from lfo import LFO
+from module import LookupTable, Module, interpolate
 
 
-# TODO: Reduce duplication with StateVariableFilter?
-class ModulatedSVF(Module):
+# The SVF's frequency coefficient, 2*sin(pi * freq / sample_rate), up to Nyquist.
+F1 = LookupTable(lambda x: 2*np.sin(np.pi * x), 0, 0.5)
+
+
+class ModulatedSVF(StateVariableFilter):
+    "StateVariableFilter whose frequency is supplied per sample on each call to `process`."
 
     PARAMETERS = ("resonance", "mode", "mix")
+    SIGNAL_PARAMETERS = ("resonance", "mix")
+    BATCH_PARAMETERS = ("resonance", "mix")
 
     def __init__(self, sample_rate, resonance, mode='lpf'):
-        super().__init__(sample_rate)
-        assert (resonance >= 0.5)
-        self.resonance = resonance
-        self.prev_band, self.prev_low = 0, 0
-        self.mode = mode
-    
-    @property
-    def resonance(self):
-        return self._resonance
-    
-    @resonance.setter
-    def resonance(self, value):
-        self._resonance = value
-        self.q1 = 1/value
-
-    def process(self, freqs, input_buffer, output_buffer):
-        f1s = 2*np.sin(np.pi * freqs / self.sample_rate)
-        mode, q1, prev_band, prev_low = self.mode, self.q1, self.prev_band, self.prev_low
-        for i in range(len(input_buffer)):
-            f1 = f1s[i]
-            low = prev_low + f1 * prev_band
-            high = input_buffer[i] - low - q1*prev_band
-            band = f1 * high + prev_band
-
-            # TODO: If necessary, optimize by lifting the branch.
-            if mode == 'lpf':
-                output_buffer[i] = low
-            elif mode == 'bpf':
-                output_buffer[i] = band
-            elif mode == 'hpf':
-                output_buffer[i] = high
-            elif mode == 'notch':
-                output_buffer[i] = low + high
-
-            prev_band = band
-            prev_low = low
-        self.prev_band = prev_band
-        self.prev_low = prev_low
+        super().__init__(sample_rate, 0, resonance, mode)
+
+    def process(self, freqs, input_buffer, output_buffer, interval=1):
+        """Filter with the frequencies `freqs`, one per sample, or with an `interval`, control-rate points every `interval`
+        frames (see `module.interpolate`): their coefficients are looked up and interpolated, rather than computed per sample."""
+        if interval == 1:
+            self.freq = freqs
+        else:
+            self._freq = freqs
+            self.f1 = interpolate(F1(freqs / self.sample_rate), interval, np.empty((len(input_buffer),) + np.shape(freqs)[1:]))
+        super().process(input_buffer, output_buffer)
 
 
 class AutoWah(Module):
 
-    PARAMETERS = ("freq_range", "rate", "bpf", "mix")
+    PARAMETERS = ("freq_range", "rate", "bpf", "lfo", "mix")
+    SIGNAL_PARAMETERS = ("rate", "mix")
+    BATCH_PARAMETERS = ("rate", "mix")
+    IN_PLACE = True
 
     def __init__(self, sample_rate, freq_range, rate, resonance):
         super().__init__(sample_rate)
         self.freq_range = freq_range
-        self.rate = rate
+        self.lfo = LFO(sample_rate, rate)
         self.bpf = ModulatedSVF(sample_rate, resonance, 'bpf')
-        self.time = 0
-    
+
+    @property
+    def rate(self):
+        return self.lfo.rate
+
+    @rate.setter
+    def rate(self, value):
+        self.lfo.rate = value
+
+    def advance(self, n, channels):
+        self.lfo.advance(n)
+
+    def at_rest(self):
+        return self.bpf.at_rest()
+
     def process(self, input_buffer, output_buffer):
-        times = self.time + np.arange(len(input_buffer))/self.sample_rate
         sweep_amp = (self.freq_range[1] - self.freq_range[0])/2
         sweep_center = (self.freq_range[0] + self.freq_range[1])/2
-        # LFO:
-        freqs = np.sin(2*np.pi*times*self.rate)*sweep_amp + sweep_center
-        self.bpf.process(freqs, input_buffer, output_buffer)
-        self.time += len(input_buffer)/self.sample_rate
\ No newline at end of file
+        # The sweep and the filter's coefficients follow the LFO at its control rate.
+        freqs, interval = self.lfo.control_points(len(input_buffer), input_buffer.shape[1:])
+        freqs *= sweep_amp
+        freqs += sweep_center
+        self.bpf.process(freqs, input_buffer, output_buffer, interval)